@@ -1,548 +1,4318 @@
+from __future__ import annotations
+
 import sqlite3
 import logging
-import csv
-from telegram import Update
-from telegram.ext import Application, CommandHandler, MessageHandler, filters, CallbackContext, ConversationHandler
+import io
+import os
+import sys
+import math
+import time
+import array
+import bisect
+import struct
+import asyncio
+import itertools
+import json
+import functools
+import operator
+import queue
+import random
+import hmac
+import secrets
+import socket
+import tempfile
+import threading
+import multiprocessing
+from collections import Counter, OrderedDict, deque
+from contextlib import contextmanager
+from datetime import timedelta
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import TYPE_CHECKING
+
+# telegram, csv and argparse are imported by the functions that use them, so
+# processes that never talk to Telegram (heavy-job pool processes, "python
+# Final.py export") start without them; see "python benchmark.py startup"
+if TYPE_CHECKING:
+    from telegram import Update
+    from telegram.ext import CallbackContext
 
 # Setup logging
 logging.basicConfig(format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-# SQLite database file
+# Bot API token
+BOT_TOKEN = "token"
+
+# Bot API server; change it to use a self-hosted Bot API server
+BOT_API_URL = "https://api.telegram.org/bot"
+
+# SQLite database file. It is also the catalog (users, roster, courses,
+# enrollments) and holds the grades of the default course.
 DB_FILE = "gradebook.db"
 
-# Conversation states
-COLLEGE_ID = 0
-LOGGED_IN = {}
+# Every other course keeps its grades in its own file under SHARD_DIR
+DEFAULT_COURSE = "default"
+SHARD_DIR = "shards"
+MAX_OPEN_POOLS = 64
+
+# Worker mode ("python Final.py workers"): one process receives updates, by
+# long polling or through a webhook, and hands them to WORKER_COUNT worker
+# processes by chat id. Each worker (and the single-process bot) runs CSV
+# imports and /stats in HEAVY_WORKERS separate processes.
+WORKER_COUNT = os.cpu_count() or 1
+WORKER_QUEUE_SIZE = 1000
+HEAVY_WORKERS = 1
+# Updates the single-process bot handles at once, across chats; each chat's
+# updates are still handled one at a time, in order
+UPDATE_CONCURRENCY = 32
+# The webhook server speaks plain HTTP, so it listens on loopback behind a TLS
+# proxy. Every call must carry the secret token given to set_webhook; when
+# WEBHOOK_SECRET is None a random one is made each time the receiver starts.
+WEBHOOK_HOST = "127.0.0.1"
+WEBHOOK_PORT = 8443
+WEBHOOK_PATH = "/telegram"
+WEBHOOK_SECRET = None
+
+# Conversation states, kept per user in the bot_state table
+COLLEGE_ID = "college_id"
+
+# Rendered student views and grading logic are cached per process; in worker
+# mode a write made by another process shows up within RESPONSE_CACHE_TTL seconds
+RESPONSE_CACHE_SIZE = 20000
+RESPONSE_CACHE_TTL = 30
+
+# Serving mode: with SNAPSHOT_SERVING, /view_grades, /view_detailed_grades and
+# /view_all_grades read from an in-memory columnar snapshot of each course
+# instead of SQLite. A snapshot catches up from the grade_history log after this
+# process writes, and at least every SNAPSHOT_REFRESH_INTERVAL seconds for
+# writes made by other processes; past SNAPSHOT_RELOAD_CHANGES changes it is
+# rebuilt instead.
+SNAPSHOT_SERVING = False
+SNAPSHOT_REFRESH_INTERVAL = 1.0
+SNAPSHOT_MAX_COURSES = 16
+SNAPSHOT_RELOAD_CHANGES = 10000
+
+# Grade history: every change to detailed_grades is appended to grade_history.
+# A checkpoint (a full copy of the course's grades) is taken after every /reset
+# or recompute, and once HISTORY_CHECKPOINT_ROWS changes, and at least as many
+# changes as the last checkpoint had rows, have been logged since the previous one.
+# The check runs once per write transaction, and the checkpoint after a
+# recompute is taken in the background once the recompute has committed.
+HISTORY_CHECKPOINT_ROWS = 50000
+HISTORY_LIST_LIMIT = 15
+
+# Bot state (conversations, paging cursors) is cached per key and written back
+# at most every STATE_FLUSH_INTERVAL seconds; other processes see a change
+# within STATE_CACHE_TTL seconds
+STATE_FLUSH_INTERVAL = 1.0
+STATE_CACHE_TTL = 30
+
+# Telegram rejects messages longer than this
+TELEGRAM_MESSAGE_LIMIT = 4096
+
+# Outbound message limits: Telegram allows about 30 messages/s overall and 1/s per chat
+SEND_GLOBAL_RATE = 30
+SEND_CHAT_RATE = 1
+SEND_CHAT_BURST = 3
+SEND_CONCURRENCY = 8
+SEND_MAX_RETRIES = 5
+SEND_MAX_TRACKED_CHATS = 10000
+# Background messages (grade notifications) only go out when no reply is ready,
+# and use at most this much of SEND_GLOBAL_RATE
+SEND_BACKGROUND_RATE = 20
+
+# Grade notifications: students whose grades were added or imported get one
+# "your grades were updated" message per course, at most once every
+# NOTIFY_WINDOW seconds; changes made within the window are announced when it
+# is over. Changes are collected for NOTIFY_INTERVAL seconds and students are
+# looked up NOTIFY_BATCH_SIZE at a time.
+NOTIFY_STUDENTS = True
+NOTIFY_INTERVAL = 2.0
+NOTIFY_WINDOW = 600
+NOTIFY_BATCH_SIZE = 500
+
+# Rows fetched per /view_all_grades page
+GRADES_PAGE_SIZE = 20
+
+# Graded components, in the order they are stored and entered
+GRADE_COMPONENTS = ("homework", "quizzes", "midterm", "final", "attendance")
+STAT_COMPONENTS = GRADE_COMPONENTS + ("overall",)
+
+# /stats histogram buckets: 0-9, 10-19, ..., 90-99 and 100+
+HISTOGRAM_BUCKET_WIDTH = 10
+HISTOGRAM_BUCKETS = 10
+
+# Session cache settings
+SESSION_CACHE_SIZE = 10000
+SESSION_CACHE_TTL = 300
+
+# Metrics endpoint (set METRICS_PORT to None to disable) and latency buckets in seconds
+METRICS_HOST = "127.0.0.1"
+METRICS_PORT = 9464
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+# Fraction of calls whose payloads (result sets, rows) are logged at DEBUG
+PAYLOAD_LOG_SAMPLE_RATE = 0.01
+
+# Write-behind buffer for /add_grade: flush GRADE_FLUSH_INTERVAL seconds after the
+# first queued grade, or at GRADE_FLUSH_ROWS rows, whichever comes first. Grades
+# queued while a flush is on disk go in the next one, so with updates handled
+# concurrently the groups form without waiting. With GRADE_WRITE_FAST_ACK the
+# teacher is answered as soon as the grade is queued rather than once it is on disk.
+GRADE_FLUSH_INTERVAL = 0.0
+GRADE_FLUSH_ROWS = 500
+GRADE_FLUSH_SYNCHRONOUS = "FULL"
+GRADE_WRITE_FAST_ACK = False
+FLUSH_ROW_BUCKETS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000)
+
+# Connection pool settings
+DB_POOL_SIZE = 4
+DB_POOL_TIMEOUT = 10
+DB_PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA busy_timeout=5000",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA cache_size=-8000",
+)
+
+# Bounded pool of SQLite connections shared by all helpers
+class ConnectionPool:
+    def __init__(self, db_file, size=DB_POOL_SIZE, timeout=DB_POOL_TIMEOUT):
+        self.db_file = db_file
+        self.size = size
+        self.timeout = timeout
+        self._idle = queue.LifoQueue(maxsize=size)
+        self._created = 0
+        self._lock = threading.Lock()
+        self.closed = False
+
+    def _connect(self):
+        conn = sqlite3.connect(self.db_file, timeout=self.timeout, check_same_thread=False)
+        for pragma in DB_PRAGMAS:
+            conn.execute(pragma)
+        return conn
+
+    def acquire(self):
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+
+        with self._lock:
+            can_create = self._created < self.size
+            if can_create:
+                self._created += 1
+        if can_create:
+            try:
+                return self._connect()
+            except sqlite3.Error:
+                with self._lock:
+                    self._created -= 1
+                raise
+
+        try:
+            return self._idle.get(timeout=self.timeout)
+        except queue.Empty:
+            raise sqlite3.OperationalError(f"No database connection available for {self.db_file} after {self.timeout}s")
+
+    def release(self, conn):
+        if conn.in_transaction:
+            conn.rollback()
+        if self.closed:
+            conn.close()
+            return
+        self._idle.put_nowait(conn)
+
+    @contextmanager
+    def connection(self):
+        conn = self.acquire()
+        try:
+            yield conn
+        finally:
+            self.release(conn)
+
+    def close(self):
+        self.closed = True
+        while True:
+            try:
+                conn = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            conn.close()
+            with self._lock:
+                self._created -= 1
+
+_POOLS = OrderedDict()
+_POOLS_LOCK = threading.Lock()
+
+# Function to get (or lazily create) the pool for a database file. Only the
+# MAX_OPEN_POOLS most recently used course files keep connections open.
+def get_pool(db_file=None):
+    db_file = db_file or DB_FILE
+    evicted = []
+    with _POOLS_LOCK:
+        pool = _POOLS.get(db_file)
+        if pool is None:
+            pool = _POOLS[db_file] = ConnectionPool(db_file)
+            while len(_POOLS) > MAX_OPEN_POOLS:
+                oldest = next(iter(_POOLS))
+                if oldest == DB_FILE:
+                    _POOLS.move_to_end(oldest)
+                    oldest = next(iter(_POOLS))
+                evicted.append(_POOLS.pop(oldest))
+        _POOLS.move_to_end(db_file)
+    for old_pool in evicted:
+        old_pool.close()
+    return pool
+
+# Function to close every pooled connection (used on shutdown and in benchmarks).
+# Course routing is forgotten too, since the files behind it may change.
+def close_pools():
+    with _POOLS_LOCK:
+        pools = list(_POOLS.values())
+        _POOLS.clear()
+    for pool in pools:
+        pool.close()
+    _SHARD_FILES.clear()
+    _MIGRATED_FILES.clear()
 
 # Helper function for database connections
+@contextmanager
 def db_connection():
+    with get_pool().connection() as conn:
+        yield conn
+
+# Course id -> database file, and the files already migrated by this process
+_SHARD_FILES = {}
+_MIGRATED_FILES = set()
+
+SELECT_COURSE_FILE_SQL = "SELECT db_file FROM courses WHERE course_id = ?"
+
+# Function to find the database file holding a course's grades, or None for an unknown course
+def course_db_file(course_id):
+    db_file = _SHARD_FILES.get(course_id)
+    if db_file is None:
+        with db_connection() as conn:
+            row = conn.execute(SELECT_COURSE_FILE_SQL, (course_id,)).fetchone()
+        if row is None:
+            return None
+        db_file = _SHARD_FILES[course_id] = os.path.join(SHARD_DIR, row[0]) if row[0] else DB_FILE
+    return db_file
+
+# Connection to the database holding one course's grades
+@contextmanager
+def course_connection(course_id):
+    db_file = course_db_file(course_id)
+    if db_file is None:
+        raise sqlite3.OperationalError(f"Unknown course {course_id}")
+    with get_pool(db_file).connection() as conn:
+        if db_file not in _MIGRATED_FILES:
+            migrate(conn, catalog=db_file == DB_FILE)
+            _MIGRATED_FILES.add(db_file)
+        yield conn
+
+# Blocking database helpers run here so they never stall the event loop
+DB_EXECUTOR = ThreadPoolExecutor(max_workers=DB_POOL_SIZE, thread_name_prefix="db")
+
+# Run a blocking database helper in the DB executor and await its result
+async def run_db(func, *args, **kwargs):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(DB_EXECUTOR, functools.partial(func, *args, **kwargs))
+
+# Heavy jobs (CSV imports, /stats) run in a process pool once one is started,
+# so a long import never holds the GIL the handlers need. Progress callbacks
+# are relayed from the pool through _HEAVY_PROGRESS as (token, value), and the
+# metrics a job records come back with its result to be merged into METRICS.
+HEAVY_EXECUTOR = None
+_HEAVY_PROGRESS = None
+_HEAVY_PROGRESS_THREAD = None
+_PROGRESS_CALLBACKS = {}
+_PROGRESS_TOKENS = itertools.count()
+
+# Function to point a freshly spawned process at the same databases as its parent
+def configure_process(db_file, shard_dir, progress_queue=None):
+    global DB_FILE, SHARD_DIR, _HEAVY_PROGRESS
+    DB_FILE, SHARD_DIR, _HEAVY_PROGRESS = db_file, shard_dir, progress_queue
+
+def start_heavy_executor(workers=HEAVY_WORKERS):
+    global HEAVY_EXECUTOR, _HEAVY_PROGRESS, _HEAVY_PROGRESS_THREAD
+    context = multiprocessing.get_context("spawn")
+    _HEAVY_PROGRESS = context.Queue()
+    HEAVY_EXECUTOR = ProcessPoolExecutor(max_workers=workers, mp_context=context, initializer=configure_process,
+                                         initargs=(DB_FILE, SHARD_DIR, _HEAVY_PROGRESS))
+    _HEAVY_PROGRESS_THREAD = threading.Thread(target=forward_heavy_progress, args=(_HEAVY_PROGRESS,), name="heavy-progress", daemon=True)
+    _HEAVY_PROGRESS_THREAD.start()
+
+# The forwarder is stopped with a sentinel and joined before the queue is
+# closed, so it never reads from a queue torn down under it
+def stop_heavy_executor():
+    global HEAVY_EXECUTOR, _HEAVY_PROGRESS, _HEAVY_PROGRESS_THREAD
+    if HEAVY_EXECUTOR is not None:
+        HEAVY_EXECUTOR.shutdown(wait=True)
+        HEAVY_EXECUTOR = None
+        _HEAVY_PROGRESS.put(None)
+        _HEAVY_PROGRESS_THREAD.join()
+        _HEAVY_PROGRESS.close()
+        _HEAVY_PROGRESS.join_thread()
+        _HEAVY_PROGRESS = _HEAVY_PROGRESS_THREAD = None
+
+def forward_heavy_progress(progress_queue):
+    while True:
+        try:
+            item = progress_queue.get()
+        except (EOFError, OSError) as e:
+            # The queue's pipe went away (the pool was killed, e.g. on SIGINT)
+            logger.warning(f"Heavy job progress queue closed: {e!r}")
+            return
+        if item is None:
+            return
+        token, value = item
+        callback = _PROGRESS_CALLBACKS.get(token)
+        if callback is not None:
+            try:
+                callback(value)
+            except RuntimeError as e:
+                # The event loop the callback posts to has already closed
+                logger.warning(f"Dropped heavy job progress: {e}")
+
+def report_heavy_progress(token, value):
+    _HEAVY_PROGRESS.put((token, value))
+
+# Runs inside a pool process; returns (result, metrics recorded since the last job)
+def run_heavy_job(func, token, *args, **kwargs):
+    if token is not None:
+        kwargs["progress"] = functools.partial(report_heavy_progress, token)
     try:
-        conn = sqlite3.connect(DB_FILE)
-        return conn
+        result = func(*args, **kwargs)
+    except Exception as e:
+        e.heavy_metrics = METRICS.drain()
+        raise
+    return result, METRICS.drain()
+
+# Run a CPU-heavy helper in the heavy process pool, or in `fallback` (the DB
+# executor by default) when there is none. `progress`, if given, is called
+# (from another thread) with whatever the helper passes to its own progress callback.
+async def run_heavy(func, *args, progress=None, fallback=None, **kwargs):
+    loop = asyncio.get_running_loop()
+    if HEAVY_EXECUTOR is None:
+        if progress is not None:
+            kwargs["progress"] = progress
+        return await loop.run_in_executor(fallback or DB_EXECUTOR, functools.partial(func, *args, **kwargs))
+    token = None
+    if progress is not None:
+        token = next(_PROGRESS_TOKENS)
+        _PROGRESS_CALLBACKS[token] = progress
+    try:
+        result, metrics = await loop.run_in_executor(HEAVY_EXECUTOR, functools.partial(run_heavy_job, func, token, *args, **kwargs))
+    except Exception as e:
+        METRICS.merge(*getattr(e, "heavy_metrics", ({}, {})))
+        raise
+    finally:
+        _PROGRESS_CALLBACKS.pop(token, None)
+    METRICS.merge(*metrics)
+    return result
+
+# Prometheus-style histogram with cumulative buckets
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.count += 1
+        self.sum += value
+        for index, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[index] += 1
+                break
+
+    def merge(self, other):
+        self.count += other.count
+        self.sum += other.sum
+        self.counts = [count + other_count for count, other_count in zip(self.counts, other.counts)]
+
+# In-process metrics registry, rendered in the Prometheus text format
+class Metrics:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._histograms = {}
+        self._help = {}
+        self._collectors = []
+
+    @staticmethod
+    def _key(name, labels):
+        return name, tuple(sorted(labels.items()))
+
+    def inc(self, name, amount=1, **labels):
+        key = self._key(name, labels)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + amount
+
+    def observe(self, name, value, buckets=LATENCY_BUCKETS, **labels):
+        key = self._key(name, labels)
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = Histogram(buckets)
+            histogram.observe(value)
+
+    def describe(self, name, text):
+        self._help[name] = text
+
+    # Take everything recorded so far, leaving the registry empty; a heavy pool
+    # process sends this back to the parent, which merges it into its own
+    def drain(self):
+        with self._lock:
+            drained = self._counters, self._histograms
+            self._counters, self._histograms = {}, {}
+        return drained
+
+    def merge(self, counters, histograms):
+        with self._lock:
+            for key, amount in counters.items():
+                self._counters[key] = self._counters.get(key, 0) + amount
+            for key, histogram in histograms.items():
+                if key in self._histograms:
+                    self._histograms[key].merge(histogram)
+                else:
+                    self._histograms[key] = histogram
+
+    # Register a callable returning {gauge_name: value}, read on every scrape
+    def register_collector(self, collector):
+        self._collectors.append(collector)
+
+    @staticmethod
+    def _labels(labels, extra=()):
+        pairs = [*labels, *extra]
+        if not pairs:
+            return ""
+        escaped = ",".join(f'{key}="{str(value).replace(chr(92), chr(92) * 2).replace(chr(34), chr(92) + chr(34))}"' for key, value in pairs)
+        return "{" + escaped + "}"
+
+    def _header(self, lines, name, kind, seen):
+        if name in seen:
+            return
+        seen.add(name)
+        if name in self._help:
+            lines.append(f"# HELP {name} {self._help[name]}")
+        lines.append(f"# TYPE {name} {kind}")
+
+    def render(self):
+        lines, seen = [], set()
+        with self._lock:
+            counters = sorted(self._counters.items())
+            histograms = sorted(self._histograms.items(), key=lambda item: item[0])
+            histograms = [(key, list(h.buckets), list(h.counts), h.count, h.sum) for key, h in histograms]
+        for (name, labels), value in counters:
+            self._header(lines, name, "counter", seen)
+            lines.append(f"{name}{self._labels(labels)} {value}")
+        for (name, labels), buckets, counts, count, total in histograms:
+            self._header(lines, name, "histogram", seen)
+            cumulative = 0
+            for bound, bucket_count in zip(buckets, counts):
+                cumulative += bucket_count
+                lines.append(f"{name}_bucket{self._labels(labels, [('le', f'{bound:g}')])} {cumulative}")
+            lines.append(f"{name}_bucket{self._labels(labels, [('le', '+Inf')])} {count}")
+            lines.append(f"{name}_sum{self._labels(labels)} {total}")
+            lines.append(f"{name}_count{self._labels(labels)} {count}")
+        for collector in self._collectors:
+            for name, value in sorted(collector().items()):
+                self._header(lines, name, "gauge", seen)
+                lines.append(f"{name} {value}")
+        return "\n".join(lines) + "\n"
+
+METRICS = Metrics()
+METRICS.describe("gradebook_command_seconds", "Handler latency per command")
+METRICS.describe("gradebook_db_query_seconds", "Time spent in each database helper")
+METRICS.describe("gradebook_import_rows_total", "Rows processed by /upload_grades")
+METRICS.describe("gradebook_grade_flush_rows", "Grades written per group commit")
+METRICS.describe("gradebook_grade_flush_seconds", "Time to write and commit one batch of grades")
+
+# Decorator: record how long a database helper takes
+def timed_query(func):
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            METRICS.observe("gradebook_db_query_seconds", time.perf_counter() - start, helper=func.__name__)
+    return wrapper
+
+# Decorator: record latency and failures of a command handler
+def timed_command(func):
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return await func(*args, **kwargs)
+        except Exception:
+            METRICS.inc("gradebook_command_errors_total", command=func.__name__)
+            raise
+        finally:
+            METRICS.observe("gradebook_command_seconds", time.perf_counter() - start, command=func.__name__)
+    return wrapper
+
+# Function to log a payload (result sets, rows) lazily, for a sample of calls,
+# and only when DEBUG logging is enabled
+def log_payload(message, *args):
+    if PAYLOAD_LOG_SAMPLE_RATE and logger.isEnabledFor(logging.DEBUG) and random.random() < PAYLOAD_LOG_SAMPLE_RATE:
+        logger.debug(message, *args)
+
+# Serves METRICS.render() at /metrics
+class MetricsRequestHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = METRICS.render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+# Function to start the /metrics endpoint on a background thread
+def start_metrics_server(host=METRICS_HOST, port=METRICS_PORT):
+    server = ThreadingHTTPServer((host, port), MetricsRequestHandler)
+    threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+    logger.info(f"Metrics available at http://{host}:{server.server_port}/metrics")
+    return server
+
+# Schema migrations, applied in order at startup. Each function moves the
+# database to the next user_version; never edit one that has already shipped.
+def migration_1_base_schema(cursor):
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS users (
+        id TEXT PRIMARY KEY,
+        college_id TEXT NOT NULL,
+        role TEXT NOT NULL
+    )
+    """)
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS grades (
+        student_id TEXT NOT NULL,
+        subject TEXT NOT NULL,
+        grade REAL NOT NULL,
+        PRIMARY KEY (student_id, subject)
+    )
+    """)
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS detailed_grades (
+        student_id TEXT NOT NULL,
+        subject TEXT NOT NULL,
+        homework REAL,
+        quizzes REAL,
+        midterm REAL,
+        final REAL,
+        attendance REAL,
+        overall REAL,
+        PRIMARY KEY (student_id, subject)
+    )
+    """)
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS grading_logic (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        description TEXT
+    )
+    """)
+
+    # Databases created before user_version tracking may lack these columns
+    cursor.execute("PRAGMA table_info(detailed_grades)")
+    if "overall" not in [column[1] for column in cursor.fetchall()]:
+        cursor.execute("ALTER TABLE detailed_grades ADD COLUMN overall REAL")
+    cursor.execute("PRAGMA table_info(users)")
+    if "logged_in" not in [column[1] for column in cursor.fetchall()]:
+        cursor.execute("ALTER TABLE users ADD COLUMN logged_in INTEGER NOT NULL DEFAULT 0")
+
+    users = [
+        ("1", "1", "student"),
+        ("2", "2", "student"),
+        ("3", "3", "student"),
+        ("123", "123", "teacher")
+    ]
+    cursor.executemany("INSERT OR IGNORE INTO users (id, college_id, role) VALUES (?, ?, ?)", users)
+
+def migration_2_indexes(cursor):
+    # add_grade looks students up by college ID
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_users_college_id ON users (college_id)")
+    # Per-subject listings, in the same order as the primary key pages
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_detailed_grades_subject ON detailed_grades (subject, student_id)")
+    # view_grades reads only the overall column
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_detailed_grades_student_overall ON detailed_grades (student_id, overall)")
+
+def migration_3_grading_weights(cursor):
+    # One row per version of the structured grading logic; the latest row is current
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS grading_weights (
+        version INTEGER PRIMARY KEY AUTOINCREMENT,
+        homework REAL NOT NULL,
+        quizzes REAL NOT NULL,
+        midterm REAL NOT NULL,
+        final REAL NOT NULL,
+        attendance REAL NOT NULL,
+        created_at REAL NOT NULL
+    )
+    """)
+
+# Function to rebuild the aggregates of one component from detailed_grades
+def rebuild_component_stats(cursor, component):
+    cursor.execute(f"""
+    INSERT INTO subject_stats (subject, component, count, total, total_sq, min_value, max_value, version)
+    SELECT subject, ?, COUNT({component}), TOTAL({component}), TOTAL({component} * {component}), MIN({component}), MAX({component}), 1
+    FROM detailed_grades WHERE true GROUP BY subject
+    ON CONFLICT (subject, component) DO UPDATE SET
+        count = excluded.count,
+        total = excluded.total,
+        total_sq = excluded.total_sq,
+        min_value = excluded.min_value,
+        max_value = excluded.max_value,
+        version = subject_stats.version + 1
+    """, (component,))
+    cursor.execute("DELETE FROM subject_histogram WHERE component = ?", (component,))
+    cursor.execute(f"""
+    INSERT INTO subject_histogram (subject, component, bucket, count)
+    SELECT subject, ?, MAX(0, MIN({HISTOGRAM_BUCKETS}, CAST({component} / {HISTOGRAM_BUCKET_WIDTH} AS INTEGER))), COUNT(*)
+    FROM detailed_grades WHERE {component} IS NOT NULL GROUP BY 1, 3
+    """, (component,))
+
+def migration_4_subject_stats(cursor):
+    # Running aggregates per subject and component, maintained by every grade write.
+    # min_value/max_value are NULL while count > 0 when they need recomputing.
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS subject_stats (
+        subject TEXT NOT NULL,
+        component TEXT NOT NULL,
+        count INTEGER NOT NULL DEFAULT 0,
+        total REAL NOT NULL DEFAULT 0,
+        total_sq REAL NOT NULL DEFAULT 0,
+        min_value REAL,
+        max_value REAL,
+        version INTEGER NOT NULL DEFAULT 1,
+        PRIMARY KEY (subject, component)
+    ) WITHOUT ROWID
+    """)
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS subject_histogram (
+        subject TEXT NOT NULL,
+        component TEXT NOT NULL,
+        bucket INTEGER NOT NULL,
+        count INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (subject, component, bucket)
+    ) WITHOUT ROWID
+    """)
+    # Rankings within a subject
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_detailed_grades_subject_overall ON detailed_grades (subject, overall)")
+    for component in STAT_COMPONENTS:
+        rebuild_component_stats(cursor, component)
+
+def migration_5_courses(cursor):
+    # College IDs allowed to log in, replacing the hardcoded list in college_id()
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS roster (
+        college_id TEXT PRIMARY KEY,
+        role TEXT NOT NULL
+    )
+    """)
+    # db_file is relative to SHARD_DIR; NULL means the catalog file itself
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS courses (
+        course_id TEXT PRIMARY KEY,
+        name TEXT NOT NULL,
+        teacher_id TEXT NOT NULL,
+        db_file TEXT,
+        created_at REAL NOT NULL
+    )
+    """)
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_courses_teacher_id ON courses (teacher_id)")
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS enrollments (
+        course_id TEXT NOT NULL,
+        college_id TEXT NOT NULL,
+        PRIMARY KEY (course_id, college_id)
+    ) WITHOUT ROWID
+    """)
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_enrollments_college_id ON enrollments (college_id, course_id)")
+    cursor.execute("ALTER TABLE users ADD COLUMN course_id TEXT")
+
+    cursor.executemany("INSERT OR IGNORE INTO roster (college_id, role) VALUES (?, ?)",
+                       [("123", "teacher"), ("1", "student"), ("2", "student"), ("3", "student")])
+    cursor.execute("INSERT OR IGNORE INTO roster (college_id, role) SELECT college_id, role FROM users")
+    # Everything graded so far belongs to the default course
+    cursor.execute("INSERT OR IGNORE INTO courses (course_id, name, teacher_id, db_file, created_at) VALUES (?, 'Default course', '123', NULL, ?)",
+                   (DEFAULT_COURSE, time.time()))
+    cursor.execute("""
+    INSERT OR IGNORE INTO enrollments (course_id, college_id)
+    SELECT ?, college_id FROM roster WHERE role = 'student'
+    UNION SELECT ?, student_id FROM detailed_grades
+    """, (DEFAULT_COURSE, DEFAULT_COURSE))
+
+def migration_6_bot_state(cursor):
+    # Conversation and paging state that survives restarts; data is JSON
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS bot_state (
+        kind TEXT NOT NULL,
+        key TEXT NOT NULL,
+        data TEXT NOT NULL,
+        updated_at REAL NOT NULL,
+        PRIMARY KEY (kind, key)
+    ) WITHOUT ROWID
+    """)
+
+def migration_7_jobs(cursor):
+    # Durable queue for imports and resets; checkpoint is JSON progress of a running import
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS jobs (
+        job_id INTEGER PRIMARY KEY AUTOINCREMENT,
+        kind TEXT NOT NULL,
+        course_id TEXT NOT NULL,
+        requested_by TEXT NOT NULL,
+        chat_id INTEGER NOT NULL,
+        params TEXT NOT NULL,
+        status TEXT NOT NULL DEFAULT 'queued',
+        cancel_requested INTEGER NOT NULL DEFAULT 0,
+        checkpoint TEXT,
+        result TEXT,
+        created_at REAL NOT NULL,
+        started_at REAL,
+        heartbeat_at REAL,
+        finished_at REAL
+    )
+    """)
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_jobs_status ON jobs (status, job_id)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_jobs_requested_by ON jobs (requested_by, job_id)")
+
+def migration_8_grade_changes(cursor):
+    # Keys of changed detailed_grades rows in commit order, for the in-memory
+    # snapshots; a row with a NULL student_id means every row may have changed
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS grade_changes (
+        seq INTEGER PRIMARY KEY AUTOINCREMENT,
+        student_id TEXT,
+        subject TEXT
+    )
+    """)
+
+def migration_9_grade_history(cursor):
+    # Append-only audit log of detailed_grades, which also replaces grade_changes
+    # as the snapshots' change feed. Course-wide events (/reset, recomputed
+    # overall grades) are one row with a NULL student_id, followed by a checkpoint.
+    # Rows are never deleted, so history_id only grows. Each write is one
+    # changeset, keyed by the first history_id it logged, that records who made
+    # it, where it came from and when; grade_history itself has no index, so
+    # logging a row costs one append.
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS grade_changesets (
+        history_id INTEGER PRIMARY KEY,
+        changed_by TEXT,
+        source TEXT,
+        course_wide INTEGER NOT NULL DEFAULT 0,
+        changed_at REAL NOT NULL
+    )
+    """)
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_grade_changesets_changed_at ON grade_changesets (changed_at)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_grade_changesets_course_wide ON grade_changesets (course_wide, history_id)")
+    cursor.execute(f"""
+    CREATE TABLE IF NOT EXISTS grade_history (
+        history_id INTEGER PRIMARY KEY,
+        student_id TEXT,
+        subject TEXT,
+        {", ".join(f"{name} REAL" for name in STAT_COMPONENTS)},
+        old_values TEXT
+    )
+    """)
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS grade_checkpoints (
+        checkpoint_id INTEGER PRIMARY KEY,
+        history_id INTEGER NOT NULL,
+        row_count INTEGER NOT NULL,
+        taken_at REAL NOT NULL
+    )
+    """)
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_grade_checkpoints_taken_at ON grade_checkpoints (taken_at)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_grade_checkpoints_history_id ON grade_checkpoints (history_id)")
+    cursor.execute(f"""
+    CREATE TABLE IF NOT EXISTS grade_checkpoint_rows (
+        checkpoint_id INTEGER NOT NULL,
+        student_id TEXT NOT NULL,
+        subject TEXT NOT NULL,
+        {", ".join(f"{name} REAL" for name in STAT_COMPONENTS)},
+        PRIMARY KEY (checkpoint_id, student_id, subject)
+    ) WITHOUT ROWID
+    """)
+    # The keys changed between each checkpoint and the one before it, written
+    # when the checkpoint is taken, so /history only reads the stretches of the
+    # log where its key appears
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS grade_history_keys (
+        student_id TEXT NOT NULL,
+        subject TEXT NOT NULL,
+        checkpoint_id INTEGER NOT NULL,
+        PRIMARY KEY (student_id, subject, checkpoint_id)
+    ) WITHOUT ROWID
+    """)
+    cursor.execute("DROP TABLE IF EXISTS grade_changes")
+    # History starts with the grades as they are now
+    log_course_event(cursor.connection, "history started")
+    take_history_checkpoint(cursor.connection)
+
+def migration_10_grade_notifications(cursor):
+    # When each student was last told that their grades in a course changed
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS grade_notifications (
+        course_id TEXT NOT NULL,
+        college_id TEXT NOT NULL,
+        notified_at REAL NOT NULL,
+        PRIMARY KEY (course_id, college_id)
+    ) WITHOUT ROWID
+    """)
+
+def migration_11_job_leases(cursor):
+    # The runner that claimed a running job (host:pid) and until when it holds the job
+    cursor.execute("ALTER TABLE jobs ADD COLUMN owner TEXT")
+    cursor.execute("ALTER TABLE jobs ADD COLUMN lease_until REAL")
+
+def migration_12_drop_student_overall_index(cursor):
+    # Student views read their rows through the primary key in subject order, so
+    # this index only added a write to every grade upsert
+    cursor.execute("DROP INDEX IF EXISTS idx_detailed_grades_student_overall")
+
+MIGRATIONS = [
+    (1, migration_1_base_schema),
+    (2, migration_2_indexes),
+    (3, migration_3_grading_weights),
+    (4, migration_4_subject_stats),
+    (5, migration_5_courses),
+    (6, migration_6_bot_state),
+    (7, migration_7_jobs),
+    (8, migration_8_grade_changes),
+    (9, migration_9_grade_history),
+    (10, migration_10_grade_notifications),
+    (11, migration_11_job_leases),
+    (12, migration_12_drop_student_overall_index),
+]
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+
+# Migrations that only apply to the catalog; course files just record the version
+CATALOG_MIGRATIONS = {migration_5_courses, migration_6_bot_state, migration_7_jobs, migration_10_grade_notifications,
+                      migration_11_job_leases}
+
+# Function to bring a database up to SCHEMA_VERSION. Each migration runs in
+# its own transaction together with the user_version bump, and the version is
+# re-read under the write lock so concurrent starts never apply one twice.
+def migrate(conn, catalog=True):
+    if conn.execute("PRAGMA user_version").fetchone()[0] >= SCHEMA_VERSION:
+        return
+    for version, migration in MIGRATIONS:
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            if conn.execute("PRAGMA user_version").fetchone()[0] < version:
+                if catalog or migration not in CATALOG_MIGRATIONS:
+                    migration(conn.cursor())
+                conn.execute(f"PRAGMA user_version = {version}")
+                logger.info(f"Applied schema migration {version}: {migration.__name__}")
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+
+# Function to initialize the database
+def init_db():
+    try:
+        with db_connection() as conn:
+            migrate(conn)
+        _MIGRATED_FILES.add(DB_FILE)
+        logger.info("Database initialized successfully.")
+    except sqlite3.Error as e:
+        logger.error(f"Error initializing database: {e}")
+
+# Size-bounded LRU cache with a TTL, keyed by Telegram user id.
+# None is a valid cached value (user known to be logged out).
+class SessionCache:
+    def __init__(self, maxsize=SESSION_CACHE_SIZE, ttl=SESSION_CACHE_TTL):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._generation = 0
+        self._lock = threading.Lock()
+
+    # Returns (found, value)
+    def get(self, key):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                expires, value = entry
+                if expires > now:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return True, value
+                del self._entries[key]
+            self.misses += 1
+            return False, None
+
+    def _store(self, key, value):
+        self._entries[key] = (time.monotonic() + self.ttl, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def put(self, key, value):
+        with self._lock:
+            self._generation += 1
+            self._store(key, value)
+
+    # Load a missing entry; the result is only cached if nothing was
+    # invalidated while the loader ran, so a stale read never wins
+    def load(self, key, loader):
+        with self._lock:
+            generation = self._generation
+        value = loader(key)
+        with self._lock:
+            if self._generation == generation:
+                self._store(key, value)
+        return value
+
+    def get_or_load(self, key, loader):
+        found, value = self.get(key)
+        return value if found else self.load(key, loader)
+
+    def invalidate(self, key):
+        with self._lock:
+            self._generation += 1
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._generation += 1
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": len(self._entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+            }
+
+# Read-through cache for rendered responses. Keys carry the versions of what
+# they were built from: a course's grades, one student's grades, or a course's
+# grading logic. Writers bump those versions after they commit, so later keys
+# miss and stale entries simply age out of the LRU.
+class ResponseCache:
+    def __init__(self, maxsize=RESPONSE_CACHE_SIZE, ttl=RESPONSE_CACHE_TTL):
+        self._entries = SessionCache(maxsize=maxsize, ttl=ttl)
+        self._versions = Counter()
+        self._lock = threading.Lock()
+
+    def student_key(self, kind, course_id, student_id):
+        with self._lock:
+            return kind, course_id, student_id, self._versions[("grades", course_id)], self._versions[("student", course_id, student_id)]
+
+    def logic_key(self, kind, course_id):
+        with self._lock:
+            return kind, course_id, self._versions[("logic", course_id)]
+
+    def invalidate_students(self, course_id, student_ids):
+        with self._lock:
+            for student_id in student_ids:
+                self._versions[("student", course_id, student_id)] += 1
+
+    def invalidate_grades(self, course_id):
+        with self._lock:
+            self._versions[("grades", course_id)] += 1
+
+    def invalidate_logic(self, course_id):
+        with self._lock:
+            self._versions[("logic", course_id)] += 1
+
+    def get(self, key):
+        return self._entries.get(key)
+
+    def put(self, key, value):
+        self._entries.put(key, value)
+
+    def stats(self):
+        return self._entries.stats()
+
+RESPONSES = ResponseCache()
+
+# Logged-in sessions: Telegram user id -> (college_id, role, course_id), or None when logged out
+SESSIONS = SessionCache()
+
+SELECT_STATE_SQL = "SELECT data FROM bot_state WHERE kind = ? AND key = ?"
+UPSERT_STATE_SQL = """
+INSERT INTO bot_state (kind, key, data, updated_at) VALUES (?, ?, ?, ?)
+ON CONFLICT (kind, key) DO UPDATE SET data = excluded.data, updated_at = excluded.updated_at
+"""
+
+# Persistent per-user bot state in the catalog's bot_state table. Nothing is
+# read at startup: each (kind, key) is loaded on first use and cached. Writes
+# land in the cache at once and are coalesced, so a key changed many times
+# between flushes costs one row write; the last value wins.
+class StateStore:
+    def __init__(self, interval=STATE_FLUSH_INTERVAL, ttl=STATE_CACHE_TTL):
+        self.interval = interval
+        self._cache = SessionCache(ttl=ttl)
+        self._dirty = {}
+        self._lock = threading.Lock()
+        self._task = None
+        self.metrics = {"writes": 0, "flushes": 0, "rows_flushed": 0}
+
+    # Returns (found, value) without touching the database
+    def peek(self, kind, key):
+        return self._cache.get((kind, key))
+
+    @timed_query
+    def _load(self, cache_key):
+        with self._lock:
+            if cache_key in self._dirty:
+                return self._dirty[cache_key]
+        with db_connection() as conn:
+            row = conn.execute(SELECT_STATE_SQL, cache_key).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def get(self, kind, key):
+        return self._cache.get_or_load((kind, key), self._load)
+
+    # None deletes the key
+    def set(self, kind, key, value):
+        with self._lock:
+            self._dirty[(kind, key)] = value
+            self.metrics["writes"] += 1
+        self._cache.put((kind, key), value)
+
+    def delete(self, kind, key):
+        self.set(kind, key, None)
+
+    @timed_query
+    def flush(self):
+        with self._lock:
+            dirty, self._dirty = self._dirty, {}
+        if not dirty:
+            return 0
+        now = time.time()
+        try:
+            with db_connection() as conn, conn:
+                conn.executemany("DELETE FROM bot_state WHERE kind = ? AND key = ?", [key for key, value in dirty.items() if value is None])
+                conn.executemany(UPSERT_STATE_SQL, [(*key, json.dumps(value), now) for key, value in dirty.items() if value is not None])
+        except sqlite3.Error:
+            # Keep the writes for the next flush unless they were overwritten meanwhile
+            with self._lock:
+                self._dirty = {**dirty, **self._dirty}
+            raise
+        self.metrics["flushes"] += 1
+        self.metrics["rows_flushed"] += len(dirty)
+        return len(dirty)
+
+    def start(self):
+        self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            self._task = None
+        await run_db(self.flush)
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await run_db(self.flush)
+            except sqlite3.Error as e:
+                logger.error(f"Error saving bot state: {e}")
+
+    def stats(self):
+        with self._lock:
+            pending = len(self._dirty)
+        return {**self.metrics, "pending": pending, **{f"cache_{k}": v for k, v in self._cache.stats().items()}}
+
+STATE = StateStore()
+
+# Function to read one piece of bot state; a cache hit never touches the database
+async def get_state(kind, key):
+    found, value = STATE.peek(kind, key)
+    if not found:
+        value = await run_db(STATE.get, kind, key)
+    return value
+
+SELECT_SESSION_SQL = f"SELECT college_id, role, COALESCE(course_id, '{DEFAULT_COURSE}') FROM users WHERE id = ? AND logged_in = 1"
+
+# Function to load a session from the users table
+@timed_query
+def load_session(user_id):
+    try:
+        with db_connection() as conn:
+            return conn.execute(SELECT_SESSION_SQL, (user_id,)).fetchone()
     except sqlite3.Error as e:
-        logger.error(f"Database connection error: {e}")
+        logger.error(f"Error loading session for {user_id}: {e}")
         return None
 
-# Function to initialize the database
-def init_db():
-    conn = db_connection()
-    if conn:
+# Function to fetch a user's session, returning (college_id, role, course_id) or (None, None, None)
+async def authorize(user_id):
+    found, session = SESSIONS.get(user_id)
+    if not found:
+        session = await run_db(SESSIONS.load, user_id, load_session)
+    return tuple(session) if session else (None, None, None)
+
+# Function to check a user's role; a cache hit never touches the database
+async def has_role(user_id, role):
+    _, user_role, _ = await authorize(user_id)
+    return user_role == role
+
+# Function to return the current course of a logged-in teacher, or None
+async def teacher_course(user_id):
+    _, role, course_id = await authorize(user_id)
+    return course_id if role == "teacher" else None
+
+# Function to return a logged-in teacher's college ID and current course, or
+# (None, None). Writers record the college ID as who made the change.
+async def teacher_session(user_id):
+    college_id, role, course_id = await authorize(user_id)
+    return (college_id, course_id) if role == "teacher" else (None, None)
+
+# Function to add a user and log them in to a course
+@timed_query
+def add_user(user_id, college_id, role, course_id=DEFAULT_COURSE):
+    try:
+        with db_connection() as conn, conn:
+            conn.execute("""
+            INSERT INTO users (id, college_id, role, logged_in, course_id) VALUES (?, ?, ?, 1, ?)
+            ON CONFLICT (id) DO UPDATE SET college_id = excluded.college_id, role = excluded.role, logged_in = 1, course_id = excluded.course_id
+            """, (user_id, college_id, role, course_id))
+        SESSIONS.put(user_id, (college_id, role, course_id))
+        logger.debug("User %s added successfully with role %s.", user_id, role)
+        return True
+    except sqlite3.Error as e:
+        SESSIONS.invalidate(user_id)
+        logger.error(f"Error adding user {user_id}: {e}")
+        return False
+
+# Function to log a user out, returning whether they were logged in
+@timed_query
+def logout_user(user_id):
+    try:
+        with db_connection() as conn, conn:
+            cursor = conn.execute("UPDATE users SET logged_in = 0 WHERE id = ? AND logged_in = 1", (user_id,))
+        SESSIONS.put(user_id, None)
+        return cursor.rowcount > 0
+    except sqlite3.Error as e:
+        SESSIONS.invalidate(user_id)
+        logger.error(f"Error logging out user {user_id}: {e}")
+        return False
+
+# Function to switch a logged-in user to another course
+@timed_query
+def set_current_course(user_id, college_id, role, course_id):
+    with db_connection() as conn, conn:
+        conn.execute("UPDATE users SET course_id = ? WHERE id = ?", (course_id, user_id))
+    SESSIONS.put(user_id, (college_id, role, course_id))
+
+# Function to look up the role a college ID may log in with, or None
+@timed_query
+def get_roster_role(college_id):
+    with db_connection() as conn:
+        row = conn.execute("SELECT role FROM roster WHERE college_id = ?", (college_id,)).fetchone()
+    return row[0] if row else None
+
+SELECT_TEACHER_COURSES_SQL = "SELECT course_id, name FROM courses WHERE teacher_id = ? ORDER BY course_id"
+SELECT_STUDENT_COURSES_SQL = "SELECT c.course_id, c.name FROM enrollments e JOIN courses c ON c.course_id = e.course_id WHERE e.college_id = ? ORDER BY c.course_id"
+
+# Function to list the (course_id, name) pairs a teacher teaches or a student is enrolled in
+@timed_query
+def list_courses(college_id, role):
+    with db_connection() as conn:
+        return conn.execute(SELECT_TEACHER_COURSES_SQL if role == "teacher" else SELECT_STUDENT_COURSES_SQL, (college_id,)).fetchall()
+
+# Function to pick the course a user lands in after logging in
+def default_course_for(college_id, role):
+    courses = list_courses(college_id, role)
+    return courses[0][0] if courses else DEFAULT_COURSE
+
+# Function to create a course with its own database file, returning False if the ID is taken
+@timed_query
+def create_course(course_id, name, teacher_id):
+    db_file = f"{course_id}.db"
+    with db_connection() as conn, conn:
+        cursor = conn.execute("INSERT OR IGNORE INTO courses (course_id, name, teacher_id, db_file, created_at) VALUES (?, ?, ?, ?, ?)",
+                              (course_id, name, teacher_id, db_file, time.time()))
+    if cursor.rowcount == 0:
+        return False
+    os.makedirs(SHARD_DIR, exist_ok=True)
+    with course_connection(course_id):
+        pass
+    logger.info(f"Course {course_id} created in {os.path.join(SHARD_DIR, db_file)}.")
+    return True
+
+# Cached roster: (course_id, college_id) -> True. Enrollments are only ever
+# added, so positive answers never go stale; misses are not cached, so an
+# /enroll handled by another worker process is seen straight away.
+ENROLLMENTS = SessionCache()
+
+# Function to add college IDs to the roster as students and enroll them, returning how many were new
+@timed_query
+def enroll_students(course_id, college_ids):
+    with db_connection() as conn, conn:
+        conn.executemany("INSERT OR IGNORE INTO roster (college_id, role) VALUES (?, 'student')", [(c,) for c in college_ids])
+        students = [c for c in college_ids if conn.execute("SELECT role FROM roster WHERE college_id = ?", (c,)).fetchone()[0] == "student"]
+        before = conn.total_changes
+        conn.executemany("INSERT OR IGNORE INTO enrollments (course_id, college_id) VALUES (?, ?)", [(course_id, c) for c in students])
+        added = conn.total_changes - before
+    for college_id in students:
+        ENROLLMENTS.put((course_id, college_id), True)
+    return added
+
+STUDENT_EXISTS_SQL = "SELECT 1 FROM enrollments WHERE course_id = ? AND college_id = ?"
+
+# Function to load one enrollment from the database
+@timed_query
+def load_enrollment(key):
+    with db_connection() as conn:
+        return conn.execute(STUDENT_EXISTS_SQL, key).fetchone() is not None
+
+# Function to check if a student with the given college ID is enrolled in a course
+def student_exists(college_id, course_id=DEFAULT_COURSE):
+    found, enrolled = ENROLLMENTS.get((course_id, college_id))
+    if found:
+        return enrolled
+    try:
+        enrolled = load_enrollment((course_id, college_id))
+        if enrolled:
+            ENROLLMENTS.put((course_id, college_id), True)
+        return enrolled
+    except sqlite3.Error as e:
+        logger.error(f"Error checking student {college_id}: {e}")
+        return False
+
+UPSERT_DETAILED_GRADE_SQL = """
+INSERT INTO detailed_grades (student_id, subject, homework, quizzes, midterm, final, attendance, overall)
+VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+ON CONFLICT (student_id, subject) DO UPDATE SET
+    homework = excluded.homework,
+    quizzes = excluded.quizzes,
+    midterm = excluded.midterm,
+    final = excluded.final,
+    attendance = excluded.attendance,
+    overall = excluded.overall
+"""
+
+UPSERT_SUBJECT_STATS_SQL = """
+INSERT INTO subject_stats (subject, component, count, total, total_sq, min_value, max_value)
+VALUES (:subject, :component, :count, :total, :total_sq, :min_value, :max_value)
+ON CONFLICT (subject, component) DO UPDATE SET
+    count = subject_stats.count + excluded.count,
+    total = subject_stats.total + excluded.total,
+    total_sq = subject_stats.total_sq + excluded.total_sq,
+    min_value = CASE
+        WHEN subject_stats.count = 0 THEN excluded.min_value
+        WHEN subject_stats.min_value IS NULL OR :removed_min <= subject_stats.min_value THEN NULL
+        ELSE MIN(subject_stats.min_value, COALESCE(excluded.min_value, subject_stats.min_value))
+    END,
+    max_value = CASE
+        WHEN subject_stats.count = 0 THEN excluded.max_value
+        WHEN subject_stats.max_value IS NULL OR :removed_max >= subject_stats.max_value THEN NULL
+        ELSE MAX(subject_stats.max_value, COALESCE(excluded.max_value, subject_stats.max_value))
+    END,
+    version = subject_stats.version + 1
+"""
+
+UPSERT_SUBJECT_HISTOGRAM_SQL = """
+INSERT INTO subject_histogram (subject, component, bucket, count) VALUES (?, ?, ?, ?)
+ON CONFLICT (subject, component, bucket) DO UPDATE SET count = subject_histogram.count + excluded.count
+"""
+
+# Function to group rows into the non-null values of each (subject, component)
+def group_component_values(rows):
+    by_subject = {}
+    for row in rows:
+        by_subject.setdefault(row[1], []).append(row)
+    for subject, subject_rows in by_subject.items():
+        for index, component in enumerate(STAT_COMPONENTS, 2):
+            values = [row[index] for row in subject_rows if row[index] is not None]
+            if values:
+                yield subject, component, values
+
+# Function to fold replaced rows out of and new rows into the subject aggregates.
+# Rows are (student_id, subject, homework, quizzes, midterm, final, attendance, overall);
+# each (subject, component) is summarised a whole column at a time.
+def apply_stats_delta(conn, old_rows, new_rows):
+    deltas = {}
+    histogram = Counter()
+    for sign, rows in ((-1, old_rows), (1, new_rows)):
+        for subject, component, values in group_component_values(rows):
+            delta = deltas.get((subject, component))
+            if delta is None:
+                delta = deltas[(subject, component)] = {"subject": subject, "component": component, "count": 0, "total": 0.0, "total_sq": 0.0,
+                                                        "min_value": None, "max_value": None, "removed_min": None, "removed_max": None}
+            delta["count"] += sign * len(values)
+            delta["total"] += sign * sum(values)
+            delta["total_sq"] += sign * sum(map(operator.mul, values, values))
+            low, high = ("min_value", "max_value") if sign > 0 else ("removed_min", "removed_max")
+            delta[low] = min(values)
+            delta[high] = max(values)
+            for bucket, count in Counter([int(value // HISTOGRAM_BUCKET_WIDTH) for value in values]).items():
+                histogram[(subject, component, max(0, min(HISTOGRAM_BUCKETS, bucket)))] += sign * count
+
+    conn.executemany(UPSERT_SUBJECT_STATS_SQL, deltas.values())
+    conn.executemany(UPSERT_SUBJECT_HISTOGRAM_SQL, [(*key, count) for key, count in histogram.items() if count])
+
+SELECT_KEYS_DETAILED_GRADES_SQL = """
+SELECT d.student_id, d.subject, d.homework, d.quizzes, d.midterm, d.final, d.attendance, d.overall
+FROM (VALUES {}) AS keys JOIN detailed_grades d ON d.student_id = keys.column1 AND d.subject = keys.column2
+"""
+FETCH_KEYS_BATCH = 500
+
+# Function to fetch the current rows for a set (or dict) of (student_id, subject)
+# keys, one primary key lookup per key but one query per FETCH_KEYS_BATCH keys
+def fetch_detailed_grades(conn, keys):
+    keys = list(keys)
+    rows = []
+    for offset in range(0, len(keys), FETCH_KEYS_BATCH):
+        batch = keys[offset:offset + FETCH_KEYS_BATCH]
+        rows += conn.execute(SELECT_KEYS_DETAILED_GRADES_SQL.format(", ".join("(?, ?)" for _ in batch)),
+                             [value for key in batch for value in key]).fetchall()
+    return rows
+
+INSERT_CHANGESET_SQL = "INSERT INTO grade_changesets (history_id, changed_by, source, course_wide, changed_at) VALUES (?, ?, ?, ?, ?)"
+INSERT_GRADE_HISTORY_SQL = f"""
+INSERT INTO grade_history (student_id, subject, {", ".join(STAT_COMPONENTS)}, old_values)
+VALUES (?, ?, {", ".join("?" for _ in STAT_COMPONENTS)}, ?)
+"""
+SELECT_LAST_HISTORY_SQL = "SELECT COALESCE(MAX(history_id), 0) FROM grade_history"
+SELECT_LAST_CHECKPOINT_SQL = "SELECT history_id, row_count FROM grade_checkpoints WHERE checkpoint_id = (SELECT MAX(checkpoint_id) FROM grade_checkpoints)"
+SELECT_EVENT_AFTER_SQL = "SELECT 1 FROM grade_changesets WHERE course_wide = 1 AND history_id > ? LIMIT 1"
+INSERT_HISTORY_KEYS_SQL = """
+INSERT OR IGNORE INTO grade_history_keys (student_id, subject, checkpoint_id)
+SELECT student_id, subject, ? FROM grade_history WHERE history_id > ? AND history_id <= ? AND student_id IS NOT NULL
+"""
+
+# Function to open a changeset for the history rows about to be logged; they
+# get consecutive IDs from the returned one, since only one writer holds the lock
+def start_changeset(conn, changed_by, source, course_wide=False):
+    history_id = conn.execute(SELECT_LAST_HISTORY_SQL).fetchone()[0] + 1
+    conn.execute(INSERT_CHANGESET_SQL, (history_id, changed_by, source, int(course_wide), time.time()))
+    return history_id
+
+# Function to append changed rows to grade_history, with the values they replace
+def log_grade_history(conn, old_rows, new_rows, changed_by=None, source=None):
+    if not new_rows:
+        return
+    start_changeset(conn, changed_by, source)
+    if old_rows:
+        old_values = {row[:2]: json.dumps(row[2:]) for row in old_rows}
+        conn.executemany(INSERT_GRADE_HISTORY_SQL, [(*row, old_values.get(row[:2])) for row in new_rows])
+    else:
+        conn.executemany(INSERT_GRADE_HISTORY_SQL, [(*row, None) for row in new_rows])
+
+# Function to record the course's current grades as a checkpoint of the history
+# so far, along with the keys changed since the previous checkpoint
+@timed_query
+def take_history_checkpoint(conn, taken_at=None):
+    last = conn.execute(SELECT_LAST_CHECKPOINT_SQL).fetchone()
+    history_id = conn.execute(SELECT_LAST_HISTORY_SQL).fetchone()[0]
+    checkpoint_id = conn.execute("INSERT INTO grade_checkpoints (history_id, row_count, taken_at) VALUES (?, 0, ?)",
+                                 (history_id, taken_at or time.time())).lastrowid
+    conn.execute(INSERT_HISTORY_KEYS_SQL, (checkpoint_id, last[0] if last else 0, history_id))
+    row_count = conn.execute(f"INSERT INTO grade_checkpoint_rows SELECT ?, student_id, subject, {', '.join(STAT_COMPONENTS)} FROM detailed_grades ORDER BY student_id, subject",
+                             (checkpoint_id,)).rowcount
+    conn.execute("UPDATE grade_checkpoints SET row_count = ? WHERE checkpoint_id = ?", (row_count, checkpoint_id))
+    return checkpoint_id
+
+# Function to take a checkpoint after a course-wide event, or once enough history
+# has built up since the last one, so replaying from a checkpoint never costs more
+# than reading the next one would. Writers call it once per transaction.
+def checkpoint_history_if_due(conn):
+    last = conn.execute(SELECT_LAST_CHECKPOINT_SQL).fetchone()
+    history_id, row_count = last if last else (0, 0)
+    if (conn.execute(SELECT_LAST_HISTORY_SQL).fetchone()[0] - history_id >= max(HISTORY_CHECKPOINT_ROWS, row_count)
+            or conn.execute(SELECT_EVENT_AFTER_SQL, (history_id,)).fetchone()):
+        take_history_checkpoint(conn)
+
+# Function to run checkpoint_history_if_due in a transaction of its own, for
+# writers that leave the checkpoint until after they have committed: imports,
+# and recomputes, whose copy of the course would cost as much as the recompute
+def checkpoint_course_history(course_id):
+    try:
+        with course_connection(course_id) as conn, conn:
+            conn.execute("BEGIN IMMEDIATE")
+            checkpoint_history_if_due(conn)
+    except sqlite3.Error as e:
+        logger.error(f"Error checkpointing the grade history of course {course_id}: {e}")
+
+# Function to log a change to the whole course, which every snapshot treats as a
+# reason to reload. History cannot replay it, so the caller must make sure a
+# checkpoint follows (get_grades_as_of undoes any changes logged in between).
+def log_course_event(conn, source, changed_by=None):
+    start_changeset(conn, changed_by, source, course_wide=True)
+    conn.execute(INSERT_GRADE_HISTORY_SQL, (None, None, *(None for _ in STAT_COMPONENTS), None))
+
+# Function to upsert detailed grade rows and keep the subject aggregates and
+# grade history in step. Runs inside the caller's transaction; later rows win
+# when a key repeats.
+@timed_query
+def upsert_detailed_grades(conn, rows, changed_by=None, source=None):
+    latest = {(row[0], row[1]): tuple(row) for row in rows}
+    old_rows = fetch_detailed_grades(conn, latest)
+    unchanged = {row[:2] for row in old_rows if latest[row[:2]] == row}
+    changed_old = [row for row in old_rows if row[:2] not in unchanged]
+    changed_new = [row for key, row in latest.items() if key not in unchanged]
+    conn.executemany(UPSERT_DETAILED_GRADE_SQL, latest.values())
+    apply_stats_delta(conn, changed_old, changed_new)
+    log_grade_history(conn, changed_old, changed_new, changed_by, source)
+    return len(latest)
+
+# Function to add detailed grade components to the database
+@timed_query
+def add_detailed_grade_to_db(student_id, subject, homework, quizzes, midterm, final, attendance, overall, course_id=DEFAULT_COURSE,
+                             changed_by=None, source=None):
+    try:
+        with course_connection(course_id) as conn, conn:
+            upsert_detailed_grades(conn, [(student_id, subject, homework, quizzes, midterm, final, attendance, overall)], changed_by, source)
+            checkpoint_history_if_due(conn)
+        RESPONSES.invalidate_students(course_id, [student_id])
+        SNAPSHOTS.mark_stale(course_id)
+        log_payload("Detailed grades added for student %s: %s - Homework: %s, Quizzes: %s, Midterm: %s, Final: %s, Attendance: %s, Overall: %s",
+                    student_id, subject, homework, quizzes, midterm, final, attendance, overall)
+        return True
+    except sqlite3.Error as e:
+        logger.error(f"Error adding detailed grades for {student_id}: {e}")
+        return False
+
+# Buffers /add_grade writes and commits them in groups, one transaction per
+# course per flush, so concurrent teachers share a single fsync instead of
+# each paying for their own. submit() returns a future that resolves to True
+# once the grade is committed, or False if its batch failed.
+class GradeWriteBuffer:
+    def __init__(self, interval=GRADE_FLUSH_INTERVAL, max_rows=GRADE_FLUSH_ROWS):
+        self.interval = interval
+        self.max_rows = max_rows
+        self._pending = []
+        self._ready = None
+        self._full = None
+        self._task = None
+        self._closing = False
+        self.metrics = {"submitted": 0, "written": 0, "failed": 0, "flushes": 0, "max_batch": 0,
+                        "last_batch": 0, "last_flush_seconds": 0.0, "max_flush_seconds": 0.0}
+
+    @property
+    def depth(self):
+        return len(self._pending)
+
+    def start(self):
+        self._ready = asyncio.Event()
+        self._full = asyncio.Event()
+        self._closing = False
+        self._task = asyncio.get_running_loop().create_task(self._run())
+
+    # Flush whatever is queued and stop
+    async def stop(self):
+        if self._task is None:
+            return
+        self._closing = True
+        self._ready.set()
+        self._full.set()
+        await self._task
+        self._task = None
+
+    # changed_by and source are recorded in the grade history
+    def submit(self, course_id, row, changed_by=None, source=None):
+        loop = asyncio.get_running_loop()
+        if self._task is None or self._task.done() or self._task.get_loop() is not loop:
+            self.start()
+        future = loop.create_future()
+        self._pending.append((course_id, tuple(row), future, (changed_by, source)))
+        self.metrics["submitted"] += 1
+        self._ready.set()
+        if len(self._pending) >= self.max_rows:
+            self._full.set()
+        return future
+
+    async def _run(self):
+        while self._pending or not self._closing:
+            await self._ready.wait()
+            if not self._closing:
+                try:
+                    await asyncio.wait_for(self._full.wait(), timeout=self.interval)
+                except asyncio.TimeoutError:
+                    pass
+            await self._flush()
+
+    async def _flush(self):
+        batch, self._pending = self._pending, []
+        self._ready.clear()
+        self._full.clear()
+        if not batch:
+            return
+        start = time.perf_counter()
+        try:
+            failed = await run_db(self._write, batch)
+        except Exception as e:
+            # Anything but a database error is a bug; fail the whole batch rather
+            # than the flush task, which would leave every future unresolved
+            logger.error(f"Error flushing {len(batch)} grades: {e}", exc_info=True)
+            failed = {course_id for course_id, _, _, _ in batch}
+        elapsed = time.perf_counter() - start
+
+        changed = {}
+        for course_id, row, future, _ in batch:
+            if not future.done():
+                future.set_result(course_id not in failed)
+            if course_id not in failed:
+                changed.setdefault(course_id, set()).add(row[0])
+        for course_id, students in changed.items():
+            NOTIFIER.notify(course_id, students)
+        written = sum(course_id not in failed for course_id, _, _, _ in batch)
+        self.metrics["written"] += written
+        self.metrics["failed"] += len(batch) - written
+        self.metrics["flushes"] += 1
+        self.metrics["last_batch"] = len(batch)
+        self.metrics["max_batch"] = max(self.metrics["max_batch"], len(batch))
+        self.metrics["last_flush_seconds"] = elapsed
+        self.metrics["max_flush_seconds"] = max(self.metrics["max_flush_seconds"], elapsed)
+        METRICS.observe("gradebook_grade_flush_rows", len(batch), buckets=FLUSH_ROW_BUCKETS)
+        METRICS.observe("gradebook_grade_flush_seconds", elapsed)
+        logger.debug("Flushed %s grades in %.1f ms", len(batch), elapsed * 1000)
+
+    # Write one batch in the DB executor; returns the courses whose transaction failed.
+    # Rows are applied in submission order, one changeset per run of rows that
+    # share who made them, so a later grade for a key always wins.
+    @staticmethod
+    def _write(batch):
+        by_course = {}
+        for course_id, row, _, audit in batch:
+            by_course.setdefault(course_id, []).append((audit, row))
+        failed = set()
+        for course_id, audited_rows in by_course.items():
+            rows = [row for _, row in audited_rows]
+            try:
+                with course_connection(course_id) as conn:
+                    conn.execute(f"PRAGMA synchronous={GRADE_FLUSH_SYNCHRONOUS}")
+                    try:
+                        with conn:
+                            for (changed_by, source), run in itertools.groupby(audited_rows, key=operator.itemgetter(0)):
+                                upsert_detailed_grades(conn, [row for _, row in run], changed_by, source)
+                            checkpoint_history_if_due(conn)
+                    finally:
+                        conn.execute("PRAGMA synchronous=NORMAL")
+                RESPONSES.invalidate_students(course_id, {row[0] for row in rows})
+                SNAPSHOTS.mark_stale(course_id)
+                log_payload("Flushed %s grades to course %s: %s", len(rows), course_id, rows)
+            except sqlite3.Error as e:
+                failed.add(course_id)
+                logger.error(f"Error writing {len(rows)} grades to course {course_id}: {e}")
+        return failed
+
+    def stats(self):
+        return {"depth": self.depth, **self.metrics}
+
+GRADE_WRITES = GradeWriteBuffer()
+
+SELECT_OVERALL_GRADES_SQL = "SELECT overall FROM detailed_grades WHERE student_id = ? ORDER BY subject"
+SELECT_DETAILED_GRADES_SQL = "SELECT subject, homework, quizzes, midterm, final, attendance, overall FROM detailed_grades WHERE student_id = ? ORDER BY subject"
+
+# Function to fetch the overall grades for a student
+@timed_query
+def get_overall_grades_for_student(student_id, course_id=DEFAULT_COURSE):
+    with course_connection(course_id) as conn:
+        grades = conn.execute(SELECT_OVERALL_GRADES_SQL, (student_id,)).fetchall()
+        log_payload("Grades fetched for student %s: %s", student_id, grades)
+        return grades
+
+# Function to fetch detailed grades for a student
+@timed_query
+def get_detailed_grades_for_student(student_id, course_id=DEFAULT_COURSE):
+    with course_connection(course_id) as conn:
+        grades = conn.execute(SELECT_DETAILED_GRADES_SQL, (student_id,)).fetchall()
+        log_payload("Detailed grades fetched for student %s: %s", student_id, grades)
+        return grades
+
+# Function to build the keyset query for one page of detailed grades
+def detailed_grades_page_query(after=None, before=None, subject=None, student_id=None, limit=GRADES_PAGE_SIZE):
+    conditions, params = [], []
+    if subject:
+        conditions.append("subject = ?")
+        params.append(subject)
+    if student_id:
+        conditions.append("student_id = ?")
+        params.append(student_id)
+    if after:
+        conditions.append("(student_id, subject) > (?, ?)")
+        params.extend(after)
+    if before:
+        conditions.append("(student_id, subject) < (?, ?)")
+        params.extend(before)
+    where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+    order = "DESC" if before else "ASC"
+    params.append(limit + 1)
+    return f"SELECT student_id, subject, homework, quizzes, midterm, final, attendance, overall FROM detailed_grades {where} ORDER BY student_id {order}, subject {order} LIMIT ?", params
+
+# Function to fetch one keyset page of detailed grades ordered by (student_id, subject).
+# Returns the rows in ascending order and whether more rows exist past the page.
+@timed_query
+def get_detailed_grades_page(after=None, before=None, subject=None, student_id=None, limit=GRADES_PAGE_SIZE, course_id=DEFAULT_COURSE):
+    sql, params = detailed_grades_page_query(after, before, subject, student_id, limit)
+    with course_connection(course_id) as conn:
+        rows = conn.execute(sql, params).fetchall()
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    if before:
+        rows.reverse()
+    return rows, has_more
+
+SELECT_GRADE_CHANGES_SQL = "SELECT history_id, student_id, subject FROM grade_history WHERE history_id > ? ORDER BY history_id LIMIT ?"
+
+# Compact in-memory copy of one course's detailed_grades. Student and subject
+# IDs are interned, the six grade columns are float64 arrays with NaN for NULL,
+# and row numbers are kept in (student_id, subject) order, so each student's
+# rows are one contiguous run, and per subject. Only the event loop thread reads
+# or changes a snapshot; its database work (load, read_changes) runs in the DB executor.
+class GradeSnapshot:
+    def __init__(self, course_id):
+        self.course_id = course_id
+        self.seq = 0
+        self.refreshed_at = 0.0
+        self.students, self.student_index = [], {}
+        self.subjects, self.subject_index = [], {}
+        self.row_student = array.array("I")
+        self.row_subject = array.array("I")
+        self.columns = tuple(array.array("d") for _ in STAT_COMPONENTS)
+        self.order = array.array("I")
+        self.by_subject = {}
+
+    # Function to build a snapshot from one consistent read of the course
+    @classmethod
+    @timed_query
+    def load(cls, course_id):
+        snapshot = cls(course_id)
+        with course_connection(course_id) as conn:
+            conn.execute("BEGIN")
+            try:
+                snapshot.seq = conn.execute(SELECT_LAST_HISTORY_SQL).fetchone()[0]
+                # Rows arrive in (student_id, subject) order, so appending keeps every index sorted
+                for rows in iter_grade_batches(conn):
+                    snapshot._extend(rows)
+            finally:
+                conn.rollback()
+        return snapshot
+
+    # Reads the rows changed since this snapshot was taken, as (from_seq, to_seq, rows),
+    # or returns None when the snapshot has to be rebuilt instead
+    @timed_query
+    def read_changes(self):
+        seq = self.seq
+        with course_connection(self.course_id) as conn:
+            conn.execute("BEGIN")
+            try:
+                changes = conn.execute(SELECT_GRADE_CHANGES_SQL, (seq, SNAPSHOT_RELOAD_CHANGES + 1)).fetchall()
+                if not changes:
+                    return seq, seq, []
+                # Too many changes, or a change to the whole course
+                if len(changes) > SNAPSHOT_RELOAD_CHANGES or any(student_id is None for _, student_id, _ in changes):
+                    return None
+                keys = dict.fromkeys((student_id, subject) for _, student_id, subject in changes)
+                rows = fetch_detailed_grades(conn, keys)
+            finally:
+                conn.rollback()
+        # A logged row that is gone was deleted
+        if len(rows) != len(keys):
+            return None
+        return seq, changes[-1][0], rows
+
+    # Applies read_changes() output unless another refresh got there first
+    def apply(self, from_seq, to_seq, rows):
+        if from_seq != self.seq:
+            return False
+        for row in rows:
+            index = bisect.bisect_left(self.order, row[:2], key=self.key)
+            if index == len(self.order) or self.key(self.order[index]) != row[:2]:
+                position, _, subject = self._append(row)
+                self.order.insert(index, position)
+                bisect.insort(self.by_subject.setdefault(subject, array.array("I")), position, key=self.key)
+            else:
+                for column, value in zip(self.columns, row[2:]):
+                    column[self.order[index]] = math.nan if value is None else value
+        self.seq = to_seq
+        return True
+
+    def key(self, position):
+        return self.students[self.row_student[position]], self.subjects[self.row_subject[position]]
+
+    def row(self, position):
+        values = [column[position] for column in self.columns]
+        return (*self.key(position), *[None if value != value else value for value in values])
+
+    def __len__(self):
+        return len(self.row_student)
+
+    def _intern(self, value, values, index):
+        number = index.get(value)
+        if number is None:
+            number = index[value] = len(values)
+            values.append(value)
+        return number
+
+    def _intern_all(self, values, names, index):
+        for value in dict.fromkeys(values):
+            if value not in index:
+                index[value] = len(names)
+                names.append(value)
+        return list(map(index.__getitem__, values))
+
+    # Appends a batch of new rows that sort after every existing row
+    def _extend(self, rows):
+        start = len(self.row_student)
+        columns = list(zip(*rows))
+        self.row_student.extend(self._intern_all(columns[0], self.students, self.student_index))
+        subjects = self._intern_all(columns[1], self.subjects, self.subject_index)
+        self.row_subject.extend(subjects)
+        for column, values in zip(self.columns, columns[2:]):
+            try:
+                column.extend(array.array("d", values))
+            except TypeError:
+                column.extend([math.nan if value is None else value for value in values])
+        positions = range(start, start + len(rows))
+        self.order.extend(positions)
+        for subject, group in itertools.groupby(sorted(zip(subjects, positions)), key=operator.itemgetter(0)):
+            self.by_subject.setdefault(subject, array.array("I")).extend(map(operator.itemgetter(1), group))
+
+    def _append(self, row):
+        position = len(self.row_student)
+        student = self._intern(row[0], self.students, self.student_index)
+        subject = self._intern(row[1], self.subjects, self.subject_index)
+        self.row_student.append(student)
+        self.row_subject.append(subject)
+        for column, value in zip(self.columns, row[2:]):
+            column.append(math.nan if value is None else value)
+        return position, student, subject
+
+    # A student's rows in subject order
+    def _student_rows(self, student_id):
+        student = self.student_index.get(student_id)
+        if student is None:
+            return ()
+        start = end = bisect.bisect_left(self.order, (student_id,), key=self.key)
+        while end < len(self.order) and self.row_student[self.order[end]] == student:
+            end += 1
+        return self.order[start:end]
+
+    # Same results as get_overall_grades_for_student / get_detailed_grades_for_student
+    def overall_grades(self, student_id):
+        return [self.row(position)[-1:] for position in self._student_rows(student_id)]
+
+    def detailed_grades(self, student_id):
+        return [self.row(position)[1:] for position in self._student_rows(student_id)]
+
+    # Same results as get_detailed_grades_page
+    def page(self, after=None, before=None, subject=None, student_id=None, limit=GRADES_PAGE_SIZE):
+        if student_id:
+            ordered = self._student_rows(student_id)
+            if subject:
+                subject_number = self.subject_index.get(subject)
+                ordered = [position for position in ordered if self.row_subject[position] == subject_number]
+        elif subject:
+            ordered = self.by_subject.get(self.subject_index.get(subject), ())
+        else:
+            ordered = self.order
+
+        if before:
+            end = bisect.bisect_left(ordered, tuple(before), key=self.key)
+            chosen = ordered[max(0, end - limit - 1):end]
+            has_more = len(chosen) > limit
+            chosen = chosen[len(chosen) - limit:] if has_more else chosen
+        else:
+            start = bisect.bisect_right(ordered, tuple(after), key=self.key) if after else 0
+            chosen = ordered[start:start + limit + 1]
+            has_more = len(chosen) > limit
+            chosen = chosen[:limit]
+        return [self.row(position) for position in chosen], has_more
+
+    # Approximate memory held by the snapshot, in bytes
+    def nbytes(self):
+        arrays = [self.row_student, self.row_subject, *self.columns, self.order, *self.by_subject.values()]
+        containers = [self.students, self.subjects, self.student_index, self.subject_index, self.by_subject]
+        return sum(map(sys.getsizeof, itertools.chain(arrays, containers, self.students, self.subjects)))
+
+# In-memory snapshots per course for serving mode, least recently used evicted first
+class SnapshotStore:
+    def __init__(self, max_courses=SNAPSHOT_MAX_COURSES, refresh_interval=SNAPSHOT_REFRESH_INTERVAL):
+        self.max_courses = max_courses
+        self.refresh_interval = refresh_interval
+        self._snapshots = OrderedDict()
+        self._stale = set()
+        self._refreshing = {}
+        self.metrics = {"loads": 0, "refreshes": 0, "rows_refreshed": 0}
+
+    # Called by writers in this process after they commit; may run in any thread
+    def mark_stale(self, course_id):
+        self._stale.add(course_id)
+
+    async def get(self, course_id):
+        snapshot = self._snapshots.get(course_id)
+        if snapshot is not None:
+            self._snapshots.move_to_end(course_id)
+            if course_id not in self._stale and time.monotonic() - snapshot.refreshed_at < self.refresh_interval:
+                return snapshot
+
+        # Concurrent readers share one refresh
+        refresh = self._refreshing.get(course_id)
+        if refresh is None:
+            refresh = self._refreshing[course_id] = asyncio.ensure_future(self._refresh(course_id, snapshot))
+            refresh.add_done_callback(lambda _: self._refreshing.pop(course_id, None))
+        return await asyncio.shield(refresh)
+
+    async def _refresh(self, course_id, snapshot):
+        # Writes committed after this point mark the course stale again
+        self._stale.discard(course_id)
+        refreshed_at = time.monotonic()
+        changes = None
+        if snapshot is not None:
+            changes = await run_db(snapshot.read_changes)
+            if changes is not None and snapshot.apply(*changes):
+                self.metrics["refreshes"] += 1
+                self.metrics["rows_refreshed"] += len(changes[2])
+        if changes is None:
+            fresh = await run_db(GradeSnapshot.load, course_id)
+            self.metrics["loads"] += 1
+            current = self._snapshots.get(course_id)
+            if current is None or current.seq <= fresh.seq:
+                self._snapshots[course_id] = current = fresh
+                while len(self._snapshots) > self.max_courses:
+                    self._snapshots.popitem(last=False)
+            snapshot = current
+        snapshot.refreshed_at = max(snapshot.refreshed_at, refreshed_at)
+        return snapshot
+
+    def stats(self):
+        return {**self.metrics, "courses": len(self._snapshots), "rows": sum(map(len, self._snapshots.values())),
+                "bytes": sum(snapshot.nbytes() for snapshot in self._snapshots.values())}
+
+SNAPSHOTS = SnapshotStore()
+
+# Functions for the student and teacher views: from the course snapshot in serving mode, otherwise from SQLite
+async def load_overall_grades(student_id, course_id):
+    if SNAPSHOT_SERVING:
+        return (await SNAPSHOTS.get(course_id)).overall_grades(student_id)
+    return await run_db(get_overall_grades_for_student, student_id, course_id)
+
+async def load_detailed_grades(student_id, course_id):
+    if SNAPSHOT_SERVING:
+        return (await SNAPSHOTS.get(course_id)).detailed_grades(student_id)
+    return await run_db(get_detailed_grades_for_student, student_id, course_id)
+
+async def load_grades_page(after, before, subject, student_id, course_id):
+    if SNAPSHOT_SERVING:
+        return (await SNAPSHOTS.get(course_id)).page(after, before, subject, student_id)
+    return await run_db(get_detailed_grades_page, after, before, subject, student_id, course_id=course_id)
+
+# Function to parse "homework=20 quizzes=10 ..." into weights, or None if the
+# arguments are a free-text description instead
+def parse_grading_weights(args):
+    weights = dict.fromkeys(GRADE_COMPONENTS, 0.0)
+    for arg in args:
+        name, sep, value = arg.partition("=")
+        name = name.strip().lower()
+        if not sep or name not in weights:
+            return None
+        try:
+            weights[name] = float(value.rstrip("%"))
+        except ValueError:
+            return None
+        if not math.isfinite(weights[name]) or weights[name] < 0:
+            return None
+    return weights if sum(weights.values()) > 0 else None
+
+# Function to describe weights the way a teacher would write them
+def describe_grading_weights(weights):
+    total = sum(weights[name] for name in GRADE_COMPONENTS)
+    return ", ".join(f"{name.capitalize()} {weights[name] / total * 100:g}%" for name in GRADE_COMPONENTS if weights[name])
+
+# Function to compute one overall grade as the weighted mean of its components
+def compute_overall(weights, components):
+    total = sum(weights[name] for name in GRADE_COMPONENTS)
+    return round(sum(weights[name] * (value or 0.0) for name, value in zip(GRADE_COMPONENTS, components)) / total, 2)
+
+RECOMPUTE_OVERALL_SQL = f"""
+UPDATE detailed_grades SET overall = ROUND(({" + ".join(f"COALESCE({name}, 0) * :{name}" for name in GRADE_COMPONENTS)}) / :total, 2)
+"""
+
+# Function to recompute overall for every row of the course in one set-based
+# UPDATE, so SQLite does the arithmetic over the whole table in a single pass
+@timed_query
+def recompute_overall(conn, weights):
+    params = {name: weights[name] for name in GRADE_COMPONENTS}
+    params["total"] = sum(params.values())
+    updated = conn.execute(RECOMPUTE_OVERALL_SQL, params).rowcount
+    rebuild_component_stats(conn, "overall")
+    return updated
+
+# Function to read the current grading weights on an open connection
+def fetch_grading_weights(conn):
+    row = conn.execute(f"SELECT version, {', '.join(GRADE_COMPONENTS)} FROM grading_weights ORDER BY version DESC LIMIT 1").fetchone()
+    if row is None:
+        return None
+    return {"version": row[0], **dict(zip(GRADE_COMPONENTS, row[1:]))}
+
+# Function to fetch the current grading weights, or None if only free text is defined
+@timed_query
+def get_grading_weights(course_id=DEFAULT_COURSE):
+    with course_connection(course_id) as conn:
+        return fetch_grading_weights(conn)
+
+# Function to store a new version of the grading weights and recompute every overall grade
+@timed_query
+def define_grading_weights(weights, course_id=DEFAULT_COURSE, changed_by=None):
+    description = describe_grading_weights(weights)
+    with course_connection(course_id) as conn, conn:
+        cursor = conn.execute(f"INSERT INTO grading_weights ({', '.join(GRADE_COMPONENTS)}, created_at) VALUES ({', '.join('?' for _ in GRADE_COMPONENTS)}, ?)",
+                              (*(weights[name] for name in GRADE_COMPONENTS), time.time()))
+        version = cursor.lastrowid
+        conn.execute("INSERT INTO grading_logic (description) VALUES (?)", (f"{description} (version {version})",))
+        updated = recompute_overall(conn, weights)
+        log_course_event(conn, f"/grading_logic version {version}", changed_by)
+    DB_EXECUTOR.submit(checkpoint_course_history, course_id)
+    RESPONSES.invalidate_grades(course_id)
+    SNAPSHOTS.mark_stale(course_id)
+    RESPONSES.invalidate_logic(course_id)
+    logger.info(f"Grading weights version {version} defined; recomputed {updated} overall grades.")
+    return version, updated
+
+# Function to define grading logic
+@timed_query
+def define_grading_logic(description, course_id=DEFAULT_COURSE):
+    try:
+        with course_connection(course_id) as conn, conn:
+            conn.execute("INSERT INTO grading_logic (description) VALUES (?)", (description,))
+        RESPONSES.invalidate_logic(course_id)
+        logger.info("Grading logic defined successfully.")
+    except sqlite3.Error as e:
+        logger.error(f"Error defining grading logic: {e}")
+
+# Function to delete all grades and grading logic
+@timed_query
+def reset_gradebook(course_id=DEFAULT_COURSE, changed_by=None):
+    with course_connection(course_id) as conn, conn:
+        conn.execute("DELETE FROM grades")
+        conn.execute("DELETE FROM detailed_grades")
+        conn.execute("DELETE FROM grading_logic")
+        conn.execute("DELETE FROM grading_weights")
+        conn.execute("UPDATE subject_stats SET count = 0, total = 0, total_sq = 0, min_value = NULL, max_value = NULL, version = version + 1")
+        conn.execute("DELETE FROM subject_histogram")
+        log_course_event(conn, "/reset", changed_by)
+        take_history_checkpoint(conn)
+    RESPONSES.invalidate_grades(course_id)
+    SNAPSHOTS.mark_stale(course_id)
+    RESPONSES.invalidate_logic(course_id)
+    logger.info(f"Grades and grading logic of course {course_id} reset successfully.")
+
+# Function to reset grades and grading logic
+@timed_command
+async def reset(update: Update, context: CallbackContext):
+    user_id = str(update.message.from_user.id)
+
+    college_id, course_id = await teacher_session(user_id)
+    if course_id is None:
+        reply(update, "You are not authorized to reset grades and grading logic.")
+        return
+
+    await submit_job(update, "reset", course_id, user_id, {"changed_by": college_id})
+
+# Grade history queries
+HISTORY_COLUMNS = ", ".join(STAT_COMPONENTS)
+SELECT_KEY_HISTORY_SQL = f"""
+SELECT history_id, old_values, {HISTORY_COLUMNS} FROM grade_history
+WHERE history_id > ? AND history_id <= ? AND student_id = ? AND subject = ? ORDER BY history_id DESC LIMIT ?
+"""
+SELECT_KEY_CHECKPOINTS_SQL = """
+SELECT c.checkpoint_id, c.history_id FROM grade_history_keys k JOIN grade_checkpoints c USING (checkpoint_id)
+WHERE k.student_id = ? AND k.subject = ? ORDER BY k.checkpoint_id DESC
+"""
+SELECT_PREVIOUS_CHECKPOINT_SQL = "SELECT history_id FROM grade_checkpoints WHERE checkpoint_id < ? ORDER BY checkpoint_id DESC LIMIT 1"
+SELECT_CHANGESET_SQL = "SELECT changed_at, changed_by, source FROM grade_changesets WHERE history_id <= ? ORDER BY history_id DESC LIMIT 1"
+SELECT_COURSE_EVENTS_SQL = """
+SELECT history_id, changed_at, changed_by, source FROM grade_changesets
+WHERE course_wide = 1 AND history_id > ? ORDER BY history_id DESC LIMIT ?
+"""
+SELECT_CHECKPOINT_AS_OF_SQL = "SELECT checkpoint_id, history_id FROM grade_checkpoints WHERE taken_at <= ? ORDER BY taken_at DESC LIMIT 1"
+SELECT_CHECKPOINT_ROWS_SQL = f"SELECT student_id, subject, {HISTORY_COLUMNS} FROM grade_checkpoint_rows WHERE checkpoint_id = ?"
+SELECT_STUDENT_CHECKPOINT_ROWS_SQL = f"SELECT student_id, subject, {HISTORY_COLUMNS} FROM grade_checkpoint_rows WHERE checkpoint_id = ? AND student_id = ?"
+SELECT_HISTORY_CUT_SQL = "SELECT history_id - 1 FROM grade_changesets WHERE changed_at > ? ORDER BY changed_at LIMIT 1"
+SELECT_HISTORY_SINCE_SQL = f"""
+SELECT student_id, subject, {HISTORY_COLUMNS} FROM grade_history
+WHERE history_id > ? AND history_id <= ? ORDER BY history_id
+"""
+SELECT_STUDENT_HISTORY_SINCE_SQL = f"""
+SELECT student_id, subject, {HISTORY_COLUMNS} FROM grade_history
+WHERE history_id > ? AND history_id <= ? AND student_id = ? ORDER BY history_id
+"""
+SELECT_LAST_EVENT_SINCE_SQL = "SELECT MAX(history_id) FROM grade_changesets WHERE course_wide = 1 AND history_id > ? AND history_id <= ?"
+SELECT_CHECKPOINT_AFTER_SQL = "SELECT checkpoint_id, history_id FROM grade_checkpoints WHERE history_id >= ? ORDER BY history_id LIMIT 1"
+SELECT_HISTORY_UNDO_SQL = """
+SELECT student_id, subject, old_values FROM grade_history
+WHERE history_id > ? AND history_id <= ? ORDER BY history_id DESC
+"""
+
+# Function to fetch the latest changes to one student's grade in one subject, newest
+# first, together with the course-wide events (/reset, recomputes) in between.
+# Only the log since the last checkpoint, and the stretches before it where the
+# key changed, are read.
+@timed_query
+def get_grade_history(student_id, subject, limit=HISTORY_LIST_LIMIT, course_id=DEFAULT_COURSE):
+    with course_connection(course_id) as conn:
+        conn.execute("BEGIN")
+        try:
+            last = conn.execute(SELECT_LAST_CHECKPOINT_SQL).fetchone()
+            ranges = [(last[0] if last else 0, conn.execute(SELECT_LAST_HISTORY_SQL).fetchone()[0])]
+            for checkpoint_id, history_id in conn.execute(SELECT_KEY_CHECKPOINTS_SQL, (student_id, subject)).fetchall():
+                previous = conn.execute(SELECT_PREVIOUS_CHECKPOINT_SQL, (checkpoint_id,)).fetchone()
+                ranges.append((previous[0] if previous else 0, history_id))
+            entries = []
+            for after, upto in ranges:
+                entries += conn.execute(SELECT_KEY_HISTORY_SQL, (after, upto, student_id, subject, limit - len(entries))).fetchall()
+                if len(entries) >= limit:
+                    break
+            if not entries:
+                return []
+            entries = [(history_id, *conn.execute(SELECT_CHANGESET_SQL, (history_id,)).fetchone(), *values)
+                       for history_id, *values in entries]
+            events = conn.execute(SELECT_COURSE_EVENTS_SQL, (entries[-1][0], limit)).fetchall()
+        finally:
+            conn.rollback()
+    return sorted(entries + events, key=operator.itemgetter(0), reverse=True)[:limit]
+
+# Function to read a checkpoint's rows (all of them, or one student's) keyed by (student_id, subject)
+def checkpoint_rows(conn, checkpoint_id, student_id=None):
+    if student_id is None:
+        base = conn.execute(SELECT_CHECKPOINT_ROWS_SQL, (checkpoint_id,))
+    else:
+        base = conn.execute(SELECT_STUDENT_CHECKPOINT_ROWS_SQL, (checkpoint_id, student_id))
+    return {row[:2]: row for row in base}
+
+# Function to rebuild detailed grades (all of them, or one student's) as they were
+# at `as_of`: the last checkpoint taken by then, plus the changes logged after it.
+# A course-wide event cannot be replayed, so when one falls in between, the
+# checkpoint that follows it is used instead, undoing any changes logged before
+# that checkpoint was taken. Returns None when `as_of` is older than the history
+# (or when an event's checkpoint has not been taken yet).
+@timed_query
+def get_grades_as_of(as_of, student_id=None, course_id=DEFAULT_COURSE):
+    with course_connection(course_id) as conn:
+        conn.execute("BEGIN")
+        try:
+            checkpoint = conn.execute(SELECT_CHECKPOINT_AS_OF_SQL, (as_of,)).fetchone()
+            if checkpoint is None:
+                return None
+            checkpoint_id, history_id = checkpoint
+            # The last history entry logged by `as_of`
+            cut = conn.execute(SELECT_HISTORY_CUT_SQL, (as_of,)).fetchone()
+            cut = cut[0] if cut else conn.execute(SELECT_LAST_HISTORY_SQL).fetchone()[0]
+            event_id = conn.execute(SELECT_LAST_EVENT_SINCE_SQL, (history_id, cut)).fetchone()[0]
+            if event_id is None:
+                rows = checkpoint_rows(conn, checkpoint_id, student_id)
+                if student_id is None:
+                    changes = conn.execute(SELECT_HISTORY_SINCE_SQL, (history_id, cut))
+                else:
+                    changes = conn.execute(SELECT_STUDENT_HISTORY_SINCE_SQL, (history_id, cut, student_id))
+                for row in changes:
+                    if row[0] is not None:
+                        rows[row[:2]] = row
+            else:
+                checkpoint = conn.execute(SELECT_CHECKPOINT_AFTER_SQL, (event_id,)).fetchone()
+                if checkpoint is None:
+                    return None
+                checkpoint_id, history_id = checkpoint
+                rows = checkpoint_rows(conn, checkpoint_id, student_id)
+                for changed_student, subject, old_values in conn.execute(SELECT_HISTORY_UNDO_SQL, (cut, history_id)):
+                    if changed_student is None:
+                        return None
+                    if student_id is not None and changed_student != student_id:
+                        continue
+                    if old_values is None:
+                        rows.pop((changed_student, subject), None)
+                    else:
+                        rows[(changed_student, subject)] = (changed_student, subject, *json.loads(old_values))
+        finally:
+            conn.rollback()
+    return [rows[key] for key in sorted(rows)]
+
+def format_timestamp(timestamp):
+    return time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(timestamp))
+
+# Function to parse "YYYY-MM-DD" (meaning the end of that day) or "YYYY-MM-DDTHH:MM" into a timestamp, or None
+def parse_as_of(text):
+    try:
+        return time.mktime(time.strptime(text, "%Y-%m-%dT%H:%M"))
+    except ValueError:
+        pass
+    try:
+        day = time.strptime(text, "%Y-%m-%d")
+    except ValueError:
+        return None
+    return time.mktime((day.tm_year, day.tm_mon, day.tm_mday + 1, 0, 0, 0, 0, 0, -1)) - 0.001
+
+# Function to describe one /history entry
+def describe_history_entry(entry):
+    if len(entry) == 4:
+        _, changed_at, changed_by, source = entry
+        return f"{format_timestamp(changed_at)} {source} by {changed_by or 'system'} (whole course)"
+    _, changed_at, changed_by, source, old_values, *values = entry
+    if old_values:
+        changes = ", ".join(f"{name} {old} → {new}" for name, old, new in zip(STAT_COMPONENTS, json.loads(old_values), values) if old != new)
+    else:
+        changes = "added " + ", ".join(f"{name} {value}" for name, value in zip(STAT_COMPONENTS, values))
+    return f"{format_timestamp(changed_at)} {source or 'unknown'} by {changed_by or 'unknown'}: {changes}"
+
+# Teacher: Changes to one student's grade in one subject
+@timed_command
+async def history(update: Update, context: CallbackContext):
+    user_id = str(update.message.from_user.id)
+
+    course_id = await teacher_course(user_id)
+    if course_id is None:
+        reply(update, "You are not authorized to view grade history.")
+        return
+
+    if len(context.args) < 2:
+        reply(update, "Usage: /history <student_college_id> <subject>")
+        return
+
+    student_id, subject = context.args[0], " ".join(context.args[1:])
+    try:
+        entries = await run_db(get_grade_history, student_id, subject, course_id=course_id)
+    except sqlite3.Error as e:
+        logger.error(f"Error fetching grade history: {e}")
+        reply(update, "Error fetching grade history.")
+        return
+
+    if not entries:
+        reply(update, f"No history for {student_id} in {subject}.")
+        return
+    lines = "\n".join(describe_history_entry(entry) for entry in entries)
+    reply(update, f"History of {student_id} in {subject} ({course_id}), newest first:\n{lines}"[:TELEGRAM_MESSAGE_LIMIT])
+
+# Teacher: A student's grades as they were at a point in time
+@timed_command
+async def grades_as_of(update: Update, context: CallbackContext):
+    user_id = str(update.message.from_user.id)
+
+    course_id = await teacher_course(user_id)
+    if course_id is None:
+        reply(update, "You are not authorized to view grade history.")
+        return
+
+    as_of = parse_as_of(context.args[0]) if len(context.args) == 2 else None
+    if as_of is None:
+        reply(update, "Usage: /grades_as_of <YYYY-MM-DD or YYYY-MM-DDTHH:MM> <student_college_id>")
+        return
+
+    student_id = context.args[1]
+    try:
+        grades = await run_db(get_grades_as_of, as_of, student_id, course_id)
+    except sqlite3.Error as e:
+        logger.error(f"Error fetching grades as of {context.args[0]}: {e}")
+        reply(update, "Error fetching grade history.")
+        return
+
+    if grades is None:
+        reply(update, f"Grade history of course {course_id} starts after {context.args[0]}.")
+    elif not grades:
+        reply(update, f"No grades for {student_id} as of {context.args[0]}.")
+    else:
+        grade_list = "\n".join(f"Subject: {subject}, Homework: {homework}, Quizzes: {quizzes}, Midterm: {midterm}, Final: {final}, Attendance: {attendance}, Overall: {overall}"
+                               for _, subject, homework, quizzes, midterm, final, attendance, overall in grades)
+        reply(update, f"Grades of {student_id} as of {context.args[0]}:\n{grade_list}"[:TELEGRAM_MESSAGE_LIMIT])
+
+# Function to fetch the aggregates for one subject, or for every subject.
+# Extremes invalidated by a removed grade are recomputed here, for that subject only.
+@timed_query
+def get_subject_stats(subject=None, course_id=DEFAULT_COURSE):
+    with course_connection(course_id) as conn, conn:
+        where, params = ("WHERE subject = ? AND count > 0", (subject,)) if subject else ("WHERE count > 0", ())
+        rows = conn.execute(f"SELECT subject, component, count, total, total_sq, min_value, max_value, version FROM subject_stats {where} ORDER BY subject", params).fetchall()
+        stats = []
+        for subject_, component, count, total, total_sq, min_value, max_value, version in rows:
+            if min_value is None or max_value is None:
+                min_value, max_value = conn.execute(f"SELECT MIN({component}), MAX({component}) FROM detailed_grades WHERE subject = ?", (subject_,)).fetchone()
+                conn.execute("UPDATE subject_stats SET min_value = ?, max_value = ? WHERE subject = ? AND component = ?", (min_value, max_value, subject_, component))
+            mean = total / count
+            variance = max(0.0, total_sq / count - mean * mean)
+            stats.append({"subject": subject_, "component": component, "count": count, "mean": mean, "stddev": math.sqrt(variance),
+                          "min": min_value, "max": max_value, "version": version})
+        return stats
+
+# Function to fetch the histogram of one subject component as {bucket: count}
+@timed_query
+def get_subject_histogram(subject, component="overall", course_id=DEFAULT_COURSE):
+    with course_connection(course_id) as conn:
+        rows = conn.execute("SELECT bucket, count FROM subject_histogram WHERE subject = ? AND component = ? AND count > 0 ORDER BY bucket", (subject, component)).fetchall()
+    return dict(rows)
+
+# Function to fetch the top students of a subject by overall grade
+@timed_query
+def get_subject_ranking(subject, limit=5, course_id=DEFAULT_COURSE):
+    with course_connection(course_id) as conn:
+        return conn.execute(SELECT_SUBJECT_RANKING_SQL, (subject, limit)).fetchall()
+
+SELECT_SUBJECT_RANKING_SQL = "SELECT student_id, overall FROM detailed_grades WHERE subject = ? AND overall IS NOT NULL ORDER BY overall DESC LIMIT ?"
+
+# Sorted grade snapshots for exact percentiles: (course_id, subject, component) -> (stats version, values)
+SORTED_SNAPSHOTS = SessionCache(maxsize=256, ttl=3600)
+
+# Function to compute exact percentiles from a cached sorted snapshot, rebuilt
+# only when the aggregate's version moves
+def get_percentiles(subject, component, version, percentiles=(50, 90), course_id=DEFAULT_COURSE):
+    found, snapshot = SORTED_SNAPSHOTS.get((course_id, subject, component))
+    if not found or snapshot[0] != version:
+        with course_connection(course_id) as conn:
+            values = [row[0] for row in conn.execute(f"SELECT {component} FROM detailed_grades WHERE subject = ? AND {component} IS NOT NULL ORDER BY {component}", (subject,))]
+        snapshot = (version, values)
+        SORTED_SNAPSHOTS.put((course_id, subject, component), snapshot)
+    values = snapshot[1]
+    result = {}
+    for p in percentiles:
+        if not values:
+            result[p] = None
+            continue
+        position = (len(values) - 1) * p / 100
+        lower = int(position)
+        upper = min(lower + 1, len(values) - 1)
+        result[p] = values[lower] + (values[upper] - values[lower]) * (position - lower)
+    return result
+
+# Function to format /stats for every subject (overall grades only) or for one subject in detail
+def format_subject_stats(subject=None, course_id=DEFAULT_COURSE):
+    stats = get_subject_stats(subject, course_id)
+    if not stats:
+        return None
+    if subject is None:
+        lines = [f"{s['subject']}: n={s['count']}, mean {s['mean']:.2f}, sd {s['stddev']:.2f}, min {s['min']:g}, max {s['max']:g}"
+                 for s in stats if s["component"] == "overall"]
+        return "Overall grades by subject:\n" + "\n".join(lines)
+
+    lines = [f"Statistics for {subject}:"]
+    for s in sorted(stats, key=lambda s: STAT_COMPONENTS.index(s["component"])):
+        p = get_percentiles(subject, s["component"], s["version"], course_id=course_id)
+        lines.append(f"{s['component'].capitalize()}: n={s['count']}, mean {s['mean']:.2f}, sd {s['stddev']:.2f}, min {s['min']:g}, median {p[50]:.2f}, p90 {p[90]:.2f}, max {s['max']:g}")
+    histogram = get_subject_histogram(subject, course_id=course_id)
+    if histogram:
+        lines.append("Overall distribution:")
+        lines.extend(f"{bucket * HISTOGRAM_BUCKET_WIDTH}{'+' if bucket == HISTOGRAM_BUCKETS else f'-{bucket * HISTOGRAM_BUCKET_WIDTH + HISTOGRAM_BUCKET_WIDTH - 1}'}: {count}"
+                     for bucket, count in histogram.items())
+    ranking = get_subject_ranking(subject, course_id=course_id)
+    if ranking:
+        lines.append("Top students:")
+        lines.extend(f"{rank}. {student_id}: {overall:g}" for rank, (student_id, overall) in enumerate(ranking, 1))
+    return "\n".join(lines)
+
+# Function to fetch grading logic
+@timed_query
+def get_grading_logic(course_id=DEFAULT_COURSE):
+    try:
+        with course_connection(course_id) as conn:
+            logic = conn.execute("SELECT description FROM grading_logic").fetchall()
+            log_payload("Grading logic fetched: %s", logic)
+            return logic
+    except sqlite3.Error as e:
+        logger.error(f"Error fetching grading logic: {e}")
+        return []
+
+# Functions to read a course's grading logic and weights through the response cache
+async def cached_grading_logic(course_id):
+    key = RESPONSES.logic_key("grading_logic", course_id)
+    found, logic = RESPONSES.get(key)
+    if not found:
+        logic = await run_db(get_grading_logic, course_id)
+        RESPONSES.put(key, logic)
+    return logic
+
+async def cached_grading_weights(course_id):
+    key = RESPONSES.logic_key("grading_weights", course_id)
+    found, weights = RESPONSES.get(key)
+    if not found:
+        weights = await run_db(get_grading_weights, course_id)
+        RESPONSES.put(key, weights)
+    return weights
+
+# Function to split text into chunks that fit in one Telegram message,
+# preferring line boundaries
+def split_message(text, limit=TELEGRAM_MESSAGE_LIMIT):
+    if len(text) <= limit:
+        return [text]
+    chunks, current = [], ""
+    for line in text.split("\n"):
+        while len(line) > limit:
+            if current:
+                chunks.append(current)
+                current = ""
+            chunks.append(line[:limit])
+            line = line[limit:]
+        if current and len(current) + 1 + len(line) > limit:
+            chunks.append(current)
+            current = line
+        else:
+            current = f"{current}\n{line}" if current else line
+    if current:
+        chunks.append(current)
+    return chunks
+
+# Token bucket: `rate` sends per second with bursts of up to `burst`
+class TokenBucket:
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+
+    def _refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    # Seconds until a token is available
+    def delay(self, now):
+        self._refill(now)
+        if now < self.blocked_until:
+            return self.blocked_until - now
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self, now):
+        self._refill(now)
+        self.tokens -= 1
+
+    def block(self, seconds):
+        self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+
+# Outbound message queue. Handlers enqueue and return; a background task sends
+# in per-chat order under a global and a per-chat token bucket, merging queued
+# texts for the same chat and splitting anything over the message limit.
+# Background messages wait in a queue of their own that is only served when no
+# reply is ready, under a further `background_rate` bucket.
+class MessageDispatcher:
+    def __init__(self, global_rate=SEND_GLOBAL_RATE, chat_rate=SEND_CHAT_RATE, chat_burst=SEND_CHAT_BURST, concurrency=SEND_CONCURRENCY,
+                 background_rate=SEND_BACKGROUND_RATE):
+        self.bot = None
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.concurrency = concurrency
+        self._global = TokenBucket(global_rate, global_rate)
+        self._background_bucket = TokenBucket(background_rate, background_rate)
+        self._chat_buckets = {}
+        self._pending = OrderedDict()
+        self._background = OrderedDict()
+        self._depth = 0
+        self._in_flight = set()
+        self._wakeup = None
+        self._task = None
+        self._sends = set()
+        self.metrics = {"enqueued": 0, "background": 0, "sent": 0, "coalesced": 0, "split": 0, "retries": 0, "failed": 0,
+                        "throttled": 0, "max_depth": 0, "wait_seconds_total": 0.0, "max_wait_seconds": 0.0}
+
+    @property
+    def depth(self):
+        return self._depth
+
+    def _push(self, chat_id, item, pending=None):
+        (self._pending if pending is None else pending).setdefault(chat_id, deque()).append(item)
+        self._depth += 1
+        self.metrics["enqueued"] += 1
+        self.metrics["max_depth"] = max(self.metrics["max_depth"], self._depth)
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    def enqueue(self, chat_id, text, reply_markup=None):
+        chunks = split_message(text)
+        self.metrics["split"] += len(chunks) - 1
+        for index, chunk in enumerate(chunks):
+            markup = reply_markup if index == len(chunks) - 1 else None
+            self._push(chat_id, {"text": chunk, "reply_markup": markup, "enqueued": time.monotonic(), "attempts": 0})
+
+    def enqueue_document(self, chat_id, document, filename):
+        self._push(chat_id, {"document": document, "filename": filename, "enqueued": time.monotonic(), "attempts": 0})
+
+    def enqueue_background(self, chat_id, text):
+        self.metrics["background"] += 1
+        self._push(chat_id, {"text": text, "reply_markup": None, "background": True, "enqueued": time.monotonic(), "attempts": 0}, self._background)
+
+    def start(self, bot):
+        self.bot = bot
+        self._wakeup = asyncio.Event()
+        self._task = asyncio.get_running_loop().create_task(self._run())
+
+    # Stop after draining what is queued, giving up after `timeout` seconds
+    async def stop(self, timeout=10):
+        deadline = time.monotonic() + timeout
+        while (self._pending or self._background or self._sends) and time.monotonic() < deadline:
+            await asyncio.sleep(0.05)
+        if self._task:
+            self._task.cancel()
+            self._task = None
+
+    # Merge consecutive plain texts for a chat into one message under the limit
+    def _next_item(self, pending, chat_id):
+        items = pending[chat_id]
+        item = items.popleft()
+        self._depth -= 1
+        while ("text" in item and item["reply_markup"] is None and items and "text" in items[0]
+               and len(item["text"]) + 2 + len(items[0]["text"]) <= TELEGRAM_MESSAGE_LIMIT):
+            following = items.popleft()
+            self._depth -= 1
+            item = {**item, "text": f"{item['text']}\n\n{following['text']}", "reply_markup": following["reply_markup"]}
+            self.metrics["coalesced"] += 1
+        if not items:
+            del pending[chat_id]
+        return item
+
+    # First chat in `pending` whose bucket allows a send now, as (chat_id, None),
+    # or (None, seconds until one does; None if no chat is waiting on its bucket)
+    def _ready_chat(self, pending, now):
+        wait = None
+        for chat_id in pending:
+            if chat_id in self._in_flight:
+                continue
+            bucket = self._chat_buckets.get(chat_id)
+            if bucket is None:
+                bucket = self._chat_buckets[chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+            chat_delay = bucket.delay(now)
+            if chat_delay > 0:
+                wait = chat_delay if wait is None else min(wait, chat_delay)
+                continue
+            return chat_id, None
+        return None, wait
+
+    async def _run(self):
+        while True:
+            self._wakeup.clear()
+            now = time.monotonic()
+            global_delay = self._global.delay(now)
+            if global_delay == 0 and len(self._in_flight) < self.concurrency:
+                pending = self._pending
+                chat_id, wait = self._ready_chat(pending, now)
+                if chat_id is None and self._background:
+                    background_delay = self._background_bucket.delay(now)
+                    if background_delay == 0:
+                        pending = self._background
+                        chat_id, background_wait = self._ready_chat(pending, now)
+                    else:
+                        background_wait = background_delay
+                    if background_wait is not None:
+                        wait = background_wait if wait is None else min(wait, background_wait)
+                if chat_id is None:
+                    if (self._pending or self._background) and wait is not None:
+                        self.metrics["throttled"] += 1
+                    try:
+                        await asyncio.wait_for(self._wakeup.wait(), timeout=wait)
+                    except asyncio.TimeoutError:
+                        pass
+                    continue
+                self._chat_buckets[chat_id].take(now)
+                self._global.take(now)
+                if pending is self._background:
+                    self._background_bucket.take(now)
+                item = self._next_item(pending, chat_id)
+                if len(self._chat_buckets) > SEND_MAX_TRACKED_CHATS:
+                    self._prune_buckets(now)
+                self._in_flight.add(chat_id)
+                send = asyncio.get_running_loop().create_task(self._send(chat_id, item))
+                self._sends.add(send)
+                send.add_done_callback(self._sends.discard)
+                continue
+            if global_delay > 0:
+                self.metrics["throttled"] += 1
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=global_delay or None)
+            except asyncio.TimeoutError:
+                pass
+
+    # A document is closed once it has been sent or given up on, so temporary
+    # files (exports) release their descriptor and disk space
+    async def _send(self, chat_id, item):
+        from telegram.error import NetworkError, RetryAfter, TelegramError
+        retried = False
+        try:
+            if "document" in item:
+                if hasattr(item["document"], "seek"):
+                    item["document"].seek(0)
+                await self.bot.send_document(chat_id=chat_id, document=item["document"], filename=item["filename"])
+            else:
+                await self.bot.send_message(chat_id=chat_id, text=item["text"], reply_markup=item["reply_markup"])
+            waited = time.monotonic() - item["enqueued"]
+            self.metrics["sent"] += 1
+            self.metrics["wait_seconds_total"] += waited
+            self.metrics["max_wait_seconds"] = max(self.metrics["max_wait_seconds"], waited)
+        except RetryAfter as e:
+            # Flood control: hold this chat (and everyone, since the limit may be global) and retry
+            retry_after = e.retry_after.total_seconds() if isinstance(e.retry_after, timedelta) else e.retry_after
+            self._chat_buckets[chat_id].block(retry_after)
+            self._global.block(retry_after)
+            retried = self._retry(chat_id, item)
+        except NetworkError as e:
+            logger.warning(f"Network error sending to chat {chat_id}: {e}")
+            retried = self._retry(chat_id, item)
+        except TelegramError as e:
+            self.metrics["failed"] += 1
+            logger.error(f"Failed to send message to chat {chat_id}: {e}")
+        finally:
+            if not retried and hasattr(item.get("document"), "close"):
+                item["document"].close()
+            self._in_flight.discard(chat_id)
+            self._wakeup.set()
+
+    # Forget idle chats whose buckets are full again
+    def _prune_buckets(self, now):
+        for chat_id, bucket in list(self._chat_buckets.items()):
+            if (chat_id not in self._pending and chat_id not in self._background and chat_id not in self._in_flight
+                    and bucket.delay(now) == 0 and bucket.tokens >= bucket.burst):
+                del self._chat_buckets[chat_id]
+
+    # Requeue an item at the front of its chat, returning False once it has used up its retries
+    def _retry(self, chat_id, item):
+        item["attempts"] += 1
+        if item["attempts"] > SEND_MAX_RETRIES:
+            self.metrics["failed"] += 1
+            logger.error(f"Giving up on message to chat {chat_id} after {SEND_MAX_RETRIES} retries")
+            return False
+        self.metrics["retries"] += 1
+        pending = self._background if item.get("background") else self._pending
+        pending.setdefault(chat_id, deque()).appendleft(item)
+        pending.move_to_end(chat_id, last=False)
+        self._depth += 1
+        return True
+
+    def stats(self):
+        sent = self.metrics["sent"]
+        return {**self.metrics, "depth": self.depth, "chats_pending": len(self._pending), "chats_pending_background": len(self._background),
+                "in_flight": len(self._in_flight),
+                "avg_wait_seconds": self.metrics["wait_seconds_total"] / sent if sent else 0.0}
+
+DISPATCHER = MessageDispatcher()
+
+NOTIFY_TEXT = "Your grades in course {course_id} were updated. Use /view_grades to see them."
+SELECT_CHANGED_STUDENTS_SQL = "SELECT student_id FROM grade_history WHERE history_id > ? AND history_id <= ?"
+SELECT_NOTIFY_CHATS_SQL = "SELECT id, college_id FROM users WHERE college_id IN ({}) AND role = 'student' AND logged_in = 1"
+SELECT_LAST_NOTIFIED_SQL = "SELECT college_id, notified_at FROM grade_notifications WHERE course_id = ? AND college_id IN ({})"
+UPSERT_NOTIFIED_SQL = """
+INSERT INTO grade_notifications (course_id, college_id, notified_at) VALUES (?, ?, ?)
+ON CONFLICT (course_id, college_id) DO UPDATE SET notified_at = excluded.notified_at
+"""
+
+# Function to list the students whose grades changed between two history IDs.
+# Course-wide events are skipped.
+@timed_query
+def get_changed_students(course_id, after, upto):
+    with course_connection(course_id) as conn:
+        changed = {student_id for (student_id,) in conn.execute(SELECT_CHANGED_STUDENTS_SQL, (after, upto))}
+    changed.discard(None)
+    return changed
+
+# Function to decide which students to tell about their changed grades now.
+# `changes` maps college IDs to when their grades last changed. Students who
+# are not logged in are dropped, as are those told since the change; those told
+# within the last `window` seconds come back in `deferred` with the time they
+# may be told again. Everyone else is marked as told at `now` and their chats
+# are returned. Runs under the write lock so two workers never both claim one.
+@timed_query
+def claim_grade_notifications(course_id, changes, now, window=NOTIFY_WINDOW):
+    college_ids = list(changes)
+    placeholders = ", ".join("?" for _ in college_ids)
+    chats, deferred = [], {}
+    with db_connection() as conn:
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            recipients = conn.execute(SELECT_NOTIFY_CHATS_SQL.format(placeholders), college_ids).fetchall()
+            last_notified = dict(conn.execute(SELECT_LAST_NOTIFIED_SQL.format(placeholders), (course_id, *college_ids)))
+            claimed = set()
+            for chat_id, college_id in recipients:
+                last = last_notified.get(college_id)
+                if last is not None and last >= changes[college_id]:
+                    continue
+                if last is not None and last > now - window:
+                    deferred[college_id] = last + window
+                    continue
+                chats.append(chat_id)
+                claimed.add(college_id)
+            conn.executemany(UPSERT_NOTIFIED_SQL, [(course_id, college_id, now) for college_id in claimed])
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+    return chats, deferred
+
+# Tells students when their grades change. Writers report the changed students
+# and return; every NOTIFY_INTERVAL seconds the changes collected so far are
+# claimed in batches and each student gets one message per course through the
+# dispatcher's background queue, however many of their rows were written.
+class GradeNotifier:
+    def __init__(self, interval=NOTIFY_INTERVAL, window=NOTIFY_WINDOW, batch_size=NOTIFY_BATCH_SIZE):
+        self.interval = interval
+        self.window = window
+        self.batch_size = batch_size
+        # (course_id, college_id) -> [latest change, earliest time to notify]
+        self._pending = {}
+        self._task = None
+        self.metrics = {"changes": 0, "notified": 0, "deferred": 0, "skipped": 0, "flushes": 0, "last_flush_seconds": 0.0}
+
+    # `students` is an iterable of college IDs or a {college_id: changed_at} dict
+    def notify(self, course_id, students, changed_at=None):
+        if not NOTIFY_STUDENTS:
+            return
+        now = changed_at or time.time()
+        if not isinstance(students, dict):
+            students = dict.fromkeys(students, now)
+        for college_id, student_changed_at in students.items():
+            entry = self._pending.get((course_id, college_id))
+            if entry is None:
+                self._pending[(course_id, college_id)] = [student_changed_at, 0]
+            else:
+                entry[0] = max(entry[0], student_changed_at)
+        self.metrics["changes"] += len(students)
+
+    async def flush(self, now=None):
+        now = now or time.time()
+        due = {}
+        for key, (changed_at, not_before) in list(self._pending.items()):
+            if not_before <= now:
+                due.setdefault(key[0], {})[key[1]] = changed_at
+                del self._pending[key]
+        if not due:
+            return 0
+        start = time.perf_counter()
+        sent = 0
+        for course_id, changes in due.items():
+            college_ids = list(changes)
+            for offset in range(0, len(college_ids), self.batch_size):
+                batch = {college_id: changes[college_id] for college_id in college_ids[offset:offset + self.batch_size]}
+                try:
+                    chats, deferred = await run_db(claim_grade_notifications, course_id, batch, now, self.window)
+                except sqlite3.Error as e:
+                    logger.error(f"Error claiming grade notifications for course {course_id}: {e}")
+                    for college_id, changed_at in batch.items():
+                        self._pending.setdefault((course_id, college_id), [changed_at, now + self.interval])
+                    continue
+                for college_id, not_before in deferred.items():
+                    entry = self._pending.setdefault((course_id, college_id), [batch[college_id], not_before])
+                    entry[1] = max(entry[1], not_before)
+                text = NOTIFY_TEXT.format(course_id=course_id)
+                for chat_id in chats:
+                    DISPATCHER.enqueue_background(chat_id, text)
+                sent += len(chats)
+                self.metrics["notified"] += len(chats)
+                self.metrics["deferred"] += len(deferred)
+                self.metrics["skipped"] += len(batch) - len(chats) - len(deferred)
+        self.metrics["flushes"] += 1
+        self.metrics["last_flush_seconds"] = time.perf_counter() - start
+        return sent
+
+    def start(self):
+        self._task = asyncio.get_running_loop().create_task(self._run())
+
+    # Changes still inside their window are dropped; the next start has no record of them
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            self._task = None
+        await self.flush()
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.flush()
+            except Exception as e:
+                logger.error(f"Error sending grade notifications: {e}")
+
+    def stats(self):
+        return {**self.metrics, "pending": len(self._pending)}
+
+NOTIFIER = GradeNotifier()
+
+# Cache and outbound queue figures, read on every /metrics scrape
+def collect_runtime_metrics():
+    metrics = {}
+    for prefix, values in (("gradebook_session_cache", SESSIONS.stats()), ("gradebook_percentile_cache", SORTED_SNAPSHOTS.stats()),
+                           ("gradebook_outbound", DISPATCHER.stats()),
+                           ("gradebook_enrollment_cache", ENROLLMENTS.stats()), ("gradebook_grade_writes", GRADE_WRITES.stats()),
+                           ("gradebook_bot_state", STATE.stats()), ("gradebook_notifications", NOTIFIER.stats()),
+                           ("gradebook_response_cache", RESPONSES.stats()), ("gradebook_jobs", JOBS.stats()),
+                           ("gradebook_snapshots", SNAPSHOTS.stats())):
+        for key, value in values.items():
+            metrics[f"{prefix}_{key}"] = value
+    return metrics
+
+METRICS.register_collector(collect_runtime_metrics)
+
+# Function to queue a reply to the chat an update came from
+def reply(update: Update, text, reply_markup=None):
+    DISPATCHER.enqueue(update.effective_chat.id, text, reply_markup)
+
+# Application hooks: start the dispatcher with the bot and drain it on shutdown
+async def post_init(application):
+    DISPATCHER.start(application.bot)
+    STATE.start()
+    JOBS.start()
+    NOTIFIER.start()
+
+async def post_shutdown(application):
+    await JOBS.stop()
+    logger.info(f"Background jobs: {JOBS.stats()}")
+    await STATE.stop()
+    logger.info(f"Bot state: {STATE.stats()}")
+    await GRADE_WRITES.stop()
+    logger.info(f"Grade write buffer: {GRADE_WRITES.stats()}")
+    await NOTIFIER.stop()
+    logger.info(f"Grade notifications: {NOTIFIER.stats()}")
+    await DISPATCHER.stop()
+    logger.info(f"Message dispatcher: {DISPATCHER.stats()}")
+
+# Command: Show Available Commands
+async def show_commands(role):
+    if role == "teacher":
+        return """
+Available commands for teachers:
+/courses - List your courses.
+/course <course_id> - Switch to another of your courses.
+/create_course <course_id> <name> - Create a course you teach.
+/enroll <student_college_id> [...] - Enroll students in the current course.
+/add_grade <student_college_id> <subject> <homework> <quizzes> <midterm> <final> <attendance> <overall> - Add a grade for a student (overall is computed when weights are defined).
+/upload_grades <csv_file_path> - Upload grades from a CSV file (or send the .csv file itself).
+/jobs - List your recent imports and resets.
+/cancel <job_id> - Cancel a queued or running job.
+/export_grades [csv|columnar] - Download every grade of the current course.
+/view_all_grades [subject=<subject>] [student=<student_college_id>] - View all grades, one page at a time.
+/grading_logic <description> - Define grading logic.
+/grading_logic homework=<w> quizzes=<w> midterm=<w> final=<w> attendance=<w> - Define weights and recompute every overall grade.
+/view_grading_logic - View current grading logic.
+/stats [subject] - Class averages, spread and distribution per subject.
+/history <student_college_id> <subject> - Every change to a student's grade in a subject, with who made it.
+/grades_as_of <YYYY-MM-DD> <student_college_id> - A student's grades as they were on a date.
+/reset - Reset grades and grading logic of the current course.
+/logout - Log out.
+"""
+    else:  # role is "student"
+        return """
+Available commands for students:
+/view_grades - View your grades.
+/view_detailed_grades - View detailed grades during the term.
+/view_grading_logic - View current grading logic defined by the teacher.
+/courses - List your courses.
+/course <course_id> - Switch to another of your courses.
+/logout - Log out.
+"""
+
+# Command: Start and prompt for college ID
+@timed_command
+async def start(update: Update, context: CallbackContext):
+    user_id = str(update.message.from_user.id)
+    _, role, _ = await authorize(user_id)
+    if role:
+        reply(update, "You are already logged in. Use /logout to log out.")
+    else:
+        STATE.set("conversation", user_id, COLLEGE_ID)
+        reply(update, "Welcome! Please enter your college ID to proceed.")
+
+# Handle college ID and determine user role
+@timed_command
+async def college_id(update: Update, context: CallbackContext):
+    user_id = str(update.message.from_user.id)
+    if await get_state("conversation", user_id) != COLLEGE_ID:
+        return
+    STATE.delete("conversation", user_id)
+    college_id = update.message.text.strip()
+
+    # Determine role from the roster
+    try:
+        role = await run_db(get_roster_role, college_id)
+        course_id = await run_db(default_course_for, college_id, role) if role else None
+    except sqlite3.Error as e:
+        logger.error(f"Error looking up college ID {college_id}: {e}")
+        reply(update, "Error logging you in. Please try again.")
+        return
+    if role is None:
+        reply(update, "Access denied. Invalid college ID.")
+        return
+
+    # Add user to database and log them in
+    if not await run_db(add_user, user_id, college_id, role, course_id):
+        reply(update, "Error logging you in. Please try again.")
+        return
+
+    commands = await show_commands(role)
+    reply(update, f"College ID verified! You are logged in as a {role} (course {course_id}).\n{commands}")
+
+# Command: Logout
+@timed_command
+async def logout(update: Update, context: CallbackContext):
+    user_id = str(update.message.from_user.id)
+    if await run_db(logout_user, user_id):
+        reply(update, "You have been logged out.")
+    else:
+        reply(update, "You are not logged in.")
+
+# Command: List the courses of the logged-in user
+@timed_command
+async def courses(update: Update, context: CallbackContext):
+    user_id = str(update.message.from_user.id)
+    college_id, role, current = await authorize(user_id)
+    if not role:
+        reply(update, "Please log in first using /start.")
+        return
+
+    try:
+        rows = await run_db(list_courses, college_id, role)
+    except sqlite3.Error as e:
+        logger.error(f"Error listing courses for {college_id}: {e}")
+        reply(update, "Error fetching your courses.")
+        return
+    if not rows:
+        reply(update, "You have no courses.")
+        return
+    lines = [f"{'* ' if course_id == current else ''}{course_id}: {name}" for course_id, name in rows]
+    reply(update, "Your courses:\n" + "\n".join(lines))
+
+# Command: Switch the current course
+@timed_command
+async def course(update: Update, context: CallbackContext):
+    user_id = str(update.message.from_user.id)
+    college_id, role, _ = await authorize(user_id)
+    if not role:
+        reply(update, "Please log in first using /start.")
+        return
+    if len(context.args) != 1:
+        reply(update, "Usage: /course <course_id>")
+        return
+
+    course_id = context.args[0]
+    try:
+        if course_id not in [row[0] for row in await run_db(list_courses, college_id, role)]:
+            reply(update, f"You are not part of course {course_id}.")
+            return
+        await run_db(set_current_course, user_id, college_id, role, course_id)
+    except sqlite3.Error as e:
+        logger.error(f"Error switching {user_id} to course {course_id}: {e}")
+        reply(update, "Error switching course.")
+        return
+    STATE.delete("view_all_grades", user_id)
+    reply(update, f"Switched to course {course_id}.")
+
+# Teacher: Create a course with its own grade store
+@timed_command
+async def new_course(update: Update, context: CallbackContext):
+    user_id = str(update.message.from_user.id)
+    college_id, role, _ = await authorize(user_id)
+    if role != "teacher":
+        reply(update, "You are not authorized to create courses.")
+        return
+    if len(context.args) < 2 or not context.args[0].replace("_", "").replace("-", "").isalnum():
+        reply(update, "Usage: /create_course <course_id> <name> (letters, digits, - and _ only in the ID)")
+        return
+
+    course_id, name = context.args[0], " ".join(context.args[1:])
+    try:
+        created = await run_db(create_course, course_id, name, college_id)
+    except (sqlite3.Error, OSError) as e:
+        logger.error(f"Error creating course {course_id}: {e}")
+        reply(update, "Error creating course.")
+        return
+    if not created:
+        reply(update, f"Course {course_id} already exists.")
+        return
+    reply(update, f"Course {course_id} created. Use /course {course_id} to switch to it.")
+
+# Teacher: Enroll students in the current course
+@timed_command
+async def enroll(update: Update, context: CallbackContext):
+    user_id = str(update.message.from_user.id)
+    course_id = await teacher_course(user_id)
+    if course_id is None:
+        reply(update, "You are not authorized to enroll students.")
+        return
+    if not context.args:
+        reply(update, "Usage: /enroll <student_college_id> [...]")
+        return
+
+    try:
+        added = await run_db(enroll_students, course_id, list(context.args))
+    except sqlite3.Error as e:
+        logger.error(f"Error enrolling students in {course_id}: {e}")
+        reply(update, "Error enrolling students.")
+        return
+    reply(update, f"Enrolled {added} new student(s) in course {course_id}.")
+
+# Teacher: Add Grade (continued)
+@timed_command
+async def add_grade(update: Update, context: CallbackContext):
+    user_id = str(update.message.from_user.id)
+
+    college_id, course_id = await teacher_session(user_id)
+    if course_id is None:
+        reply(update, "You are not authorized to add grades.")
+        return
+
+    # Check if grading logic is defined
+    logic = await cached_grading_logic(course_id)
+    if not logic:
+        reply(update, "Please set a grading logic before adding grades.")
+        return
+
+    # With structured weights the overall grade is computed, not typed in
+    weights = await cached_grading_weights(course_id)
+    if len(context.args) < (7 if weights else 8):  # Student, subject, 5 grading components and, without weights, the overall grade
+        overall_usage = "[overall]" if weights else "<overall>"
+        reply(update, f"Usage: /add_grade <student_college_id> <subject> <homework> <quizzes> <midterm> <final> <attendance> {overall_usage}")
+        return
+
+    student_id, subject, homework, quizzes, midterm, final, attendance = context.args[0], context.args[1], context.args[2], context.args[3], context.args[4], context.args[5], context.args[6]
+    overall = context.args[7] if len(context.args) > 7 else None
+    
+    try:
+        homework = float(homework)
+        quizzes = float(quizzes)
+        midterm = float(midterm)
+        final = float(final)
+        attendance = float(attendance)
+        if weights:
+            overall = compute_overall(weights, (homework, quizzes, midterm, final, attendance))
+        else:
+            overall = float(overall)
+        # float() accepts "nan" and "inf", which no grade can be
+        if not all(map(math.isfinite, (homework, quizzes, midterm, final, attendance, overall))):
+            raise ValueError("non-finite grade")
+    except ValueError:
+        reply(update, "Invalid grade. Please provide numbers for all grading components.")
+        return
+
+    # Check enrollment against the cached roster; only a miss touches the database
+    found, enrolled = ENROLLMENTS.get((course_id, student_id))
+    if not found:
+        enrolled = await run_db(student_exists, student_id, course_id)
+    if not enrolled:
+        reply(update, f"Student with college ID {student_id} is not enrolled in course {course_id}.")
+        return
+
+    # Queue detailed grades and overall grade for the next group commit
+    written = GRADE_WRITES.submit(course_id, (student_id, subject, homework, quizzes, midterm, final, attendance, overall), college_id, "/add_grade")
+    if GRADE_WRITE_FAST_ACK:
+        written.add_done_callback(lambda done: done.result() or reply(update, f"Error saving grades for {student_id}. Please try again."))
+        reply(update, f"Grades queued: {student_id}, {subject} - Overall: {overall}")
+        return
+    if not await written:
+        reply(update, f"Error saving grades for {student_id}. Please try again.")
+        return
+    reply(update, f"Grades added: {student_id}, {subject} - Homework: {homework}, Quizzes: {quizzes}, Midterm: {midterm}, Final: {final}, Attendance: {attendance}, Overall: {overall}")
+
+# Teacher: Define Grading Logic
+@timed_command
+async def grading_logic(update: Update, context: CallbackContext):
+    user_id = str(update.message.from_user.id)
+
+    college_id, course_id = await teacher_session(user_id)
+    if course_id is None:
+        reply(update, "You are not authorized to define grading logic.")
+        return
+
+    if len(context.args) < 1:
+        reply(update, "Usage: /grading_logic <description>, or /grading_logic homework=<w> quizzes=<w> midterm=<w> final=<w> attendance=<w>")
+        return
+
+    weights = parse_grading_weights(context.args)
+    if weights:
+        try:
+            version, updated = await run_db(define_grading_weights, weights, course_id, college_id)
+        except sqlite3.Error as e:
+            logger.error(f"Error defining grading weights: {e}")
+            reply(update, "Error defining grading logic.")
+            return
+        reply(update, f"Grading logic version {version} defined: {describe_grading_weights(weights)}. Recomputed {updated} overall grades.")
+        return
+
+    description = " ".join(context.args)
+    await run_db(define_grading_logic, description, course_id)
+    reply(update, "Grading logic defined.")
+
+# Bulk import settings
+IMPORT_CHUNK_SIZE = 5000
+IMPORT_CHECKPOINT_CHUNKS = 10
+IMPORT_PROGRESS_ROWS = 10000
+IMPORT_ERROR_PREVIEW = 20
+IMPORT_COLUMNS = ("student_id", "subject", "homework", "quizzes", "midterm", "final", "attendance", "overall")
+
+# Result of a bulk import: counts plus one (row number, reason, raw row) entry per rejected row
+class ImportReport:
+    def __init__(self, source):
+        self.source = source
+        self.rows_read = 0
+        self.rows_imported = 0
+        self.errors = []
+        self.rejected_before = 0
+        self.elapsed = 0.0
+        # grade_history IDs before and after the import, to find the students it changed
+        self.history_from = None
+        self.history_to = None
+
+    @property
+    def rows_per_sec(self):
+        return self.rows_read / self.elapsed if self.elapsed else 0.0
+
+    # Rejected rows including those of earlier runs of a resumed import
+    @property
+    def rows_rejected(self):
+        return self.rejected_before + len(self.errors)
+
+# Function to convert one CSV row, returning (row, None) or (None, reason)
+def parse_grade_row(row):
+    if len(row) != len(IMPORT_COLUMNS):
+        return None, f"expected {len(IMPORT_COLUMNS)} columns, got {len(row)}"
+    student_id, subject = row[0].strip(), row[1].strip()
+    if not student_id or not subject:
+        return None, "missing student ID or subject"
+    values = []
+    for name, value in zip(IMPORT_COLUMNS[2:], row[2:]):
+        try:
+            number = float(value)
+        except ValueError:
+            return None, f"invalid {name} value {value!r}"
+        if not math.isfinite(number):
+            return None, f"invalid {name} value {value!r}"
+        values.append(number)
+    return (student_id, subject, *values), None
+
+# Function to validate a whole chunk of CSV rows at once
+def validate_grade_rows(rows, first_row_number):
+    # Fast path: convert each grade column in one pass and only fall back to
+    # row-by-row checks when something in the chunk is malformed
+    try:
+        if all(len(row) == len(IMPORT_COLUMNS) for row in rows):
+            columns = list(zip(*rows))
+            student_ids = [value.strip() for value in columns[0]]
+            subjects = [value.strip() for value in columns[1]]
+            numbers = [list(map(float, column)) for column in columns[2:]]
+            if all(student_ids) and all(subjects) and all(math.isfinite(sum(column)) for column in numbers):
+                return list(zip(student_ids, subjects, *numbers)), []
+    except ValueError:
+        pass
+
+    valid, errors = [], []
+    for offset, row in enumerate(rows):
+        parsed, reason = parse_grade_row(row)
+        if parsed is None:
+            errors.append((first_row_number + offset, reason, row))
+        else:
+            valid.append(parsed)
+    return valid, errors
+
+# Function to check whether a CSV row is a header rather than grades
+def is_header_row(row):
+    return len(row) == len(IMPORT_COLUMNS) and row[2].strip().lower() == "homework"
+
+# Function to stream a CSV file into detailed_grades in checkpointed, batched transactions.
+# `checkpoint`, if given, is called with the report after every commit; `resume`
+# is a checkpoint of an earlier run whose rows are skipped instead of re-read.
+@timed_query
+def bulk_import_grades(csvfile, source, progress=None, chunk_size=IMPORT_CHUNK_SIZE, course_id=DEFAULT_COURSE,
+                       checkpoint=None, checkpoint_chunks=IMPORT_CHECKPOINT_CHUNKS, resume=None, changed_by=None):
+    import csv
+    report = ImportReport(source)
+    start = time.perf_counter()
+    reader = csv.reader(csvfile)
+    row_number = 1
+    if resume and resume["rows_read"]:
+        report.rows_read = resume["rows_read"]
+        report.rows_imported = resume["rows_imported"]
+        report.rejected_before = resume["rows_rejected"]
+        header = is_header_row(next(reader, []))
+        skip = report.rows_read - (0 if header else 1)
+        next(itertools.islice(reader, skip, skip), None)
+        row_number = report.rows_read + 1 + header
+    next_progress = report.rows_read + IMPORT_PROGRESS_ROWS
+
+    with course_connection(course_id) as conn:
+        try:
+            report.history_from = (resume or {}).get("history_from") or conn.execute(SELECT_LAST_HISTORY_SQL).fetchone()[0]
+            # With structured weights the CSV overall column is replaced by the computed one
+            weights = fetch_grading_weights(conn)
+            chunks_since_commit = 0
+            while True:
+                rows = list(itertools.islice(reader, chunk_size))
+                if not rows:
+                    break
+                if row_number == 1 and is_header_row(rows[0]):
+                    rows = rows[1:]
+                    row_number = 2
+
+                valid, errors = validate_grade_rows(rows, row_number)
+                row_number += len(rows)
+                report.rows_read += len(rows)
+                report.errors.extend(errors)
+                if valid:
+                    if weights:
+                        valid = [(*row[:7], compute_overall(weights, row[2:7])) for row in valid]
+                    upsert_detailed_grades(conn, valid, changed_by, f"import {source}")
+                    report.rows_imported += len(valid)
+
+                chunks_since_commit += 1
+                if chunks_since_commit >= checkpoint_chunks:
+                    conn.commit()
+                    RESPONSES.invalidate_grades(course_id)
+                    SNAPSHOTS.mark_stale(course_id)
+                    chunks_since_commit = 0
+                    if checkpoint:
+                        checkpoint(report)
+
+                if progress and report.rows_read >= next_progress:
+                    progress(report)
+                    next_progress += IMPORT_PROGRESS_ROWS
+
+            # Weights redefined while the import ran
+            current = fetch_grading_weights(conn)
+            if current and report.rows_imported and current != weights:
+                recompute_overall(conn, current)
+                log_course_event(conn, f"import {source}, recomputed with version {current['version']}", changed_by)
+            conn.commit()
+            report.history_to = conn.execute(SELECT_LAST_HISTORY_SQL).fetchone()[0]
+            RESPONSES.invalidate_grades(course_id)
+            SNAPSHOTS.mark_stale(course_id)
+        except Exception:
+            conn.rollback()
+            raise
+
+    report.elapsed = time.perf_counter() - start
+    METRICS.inc("gradebook_import_rows_total", report.rows_imported, result="imported")
+    METRICS.inc("gradebook_import_rows_total", len(report.errors), result="rejected")
+    logger.info(f"Imported {report.rows_imported}/{report.rows_read} rows from {source} in {report.elapsed:.2f}s ({report.rows_rejected} rejected)")
+    return report
+
+# Function to import a CSV file from a server path
+def import_grades_file(csv_file_path, progress=None, course_id=DEFAULT_COURSE):
+    with open(csv_file_path, newline='', encoding='utf-8-sig') as csvfile:
+        report = bulk_import_grades(csvfile, csv_file_path, progress, course_id=course_id)
+    checkpoint_course_history(course_id)
+    return report
+
+# Function to format the row-level error report as CSV text
+def format_import_errors(errors):
+    import csv
+    output = io.StringIO()
+    writer = csv.writer(output)
+    writer.writerow(["row", "error", "raw"])
+    for row_number, reason, row in errors:
+        writer.writerow([row_number, reason, ",".join(row)])
+    return output.getvalue()
+
+# Background job settings. Imports and resets run from the jobs table, so a
+# handler only records the request. A running job belongs to the runner that
+# claimed it (JOB_OWNER) and is leased for JOB_LEASE_SECONDS; the process doing
+# the work renews the lease every JOB_HEARTBEAT_INTERVAL seconds. A job is
+# requeued once its owner has exited or its lease has run out, and an import
+# resumes from its last checkpoint.
+JOB_DIR = "jobs"
+JOB_WORKERS = 1
+JOB_POLL_INTERVAL = 5
+JOB_LEASE_SECONDS = 60
+JOB_HEARTBEAT_INTERVAL = 10
+JOB_OWNER = f"{socket.gethostname()}:{os.getpid()}"
+JOB_CHECKPOINT_CHUNKS = 2
+JOB_THROTTLE_SECONDS = 0.05
+JOB_LIST_LIMIT = 10
+
+INSERT_JOB_SQL = "INSERT INTO jobs (kind, course_id, requested_by, chat_id, params, created_at) VALUES (?, ?, ?, ?, ?, ?)"
+CLAIM_JOB_SQL = """
+UPDATE jobs SET status = 'running', started_at = COALESCE(started_at, :now), heartbeat_at = :now,
+    owner = :owner, lease_until = :now + :lease
+WHERE job_id = (SELECT job_id FROM jobs WHERE status = 'queued' ORDER BY job_id LIMIT 1)
+RETURNING job_id, kind, course_id, requested_by, chat_id, params, checkpoint, owner
+"""
+REQUEUE_EXPIRED_JOBS_SQL = "UPDATE jobs SET status = 'queued', owner = NULL WHERE status = 'running' AND (lease_until IS NULL OR lease_until < ?)"
+SELECT_RUNNING_JOBS_SQL = "SELECT job_id, owner FROM jobs WHERE status = 'running'"
+REQUEUE_JOB_SQL = "UPDATE jobs SET status = 'queued', owner = NULL WHERE job_id = ? AND status = 'running' AND owner = ?"
+HEARTBEAT_JOB_SQL = """
+UPDATE jobs SET heartbeat_at = :now, lease_until = :now + :lease
+WHERE job_id = :job_id AND status = 'running' AND owner = :owner RETURNING cancel_requested
+"""
+CHECKPOINT_JOB_SQL = """
+UPDATE jobs SET checkpoint = :checkpoint, heartbeat_at = :now, lease_until = :now + :lease
+WHERE job_id = :job_id AND status = 'running' AND owner = :owner RETURNING cancel_requested
+"""
+FINISH_JOB_SQL = "UPDATE jobs SET status = ?, result = ?, finished_at = ? WHERE job_id = ?"
+# Only imports have checkpoints to stop at; a running reset always completes
+CANCEL_JOB_SQL = """
+UPDATE jobs SET cancel_requested = CASE WHEN status = 'queued' OR kind = 'import' THEN 1 ELSE cancel_requested END,
+    status = CASE status WHEN 'queued' THEN 'cancelled' ELSE status END,
+    finished_at = CASE status WHEN 'queued' THEN :now ELSE finished_at END
+WHERE job_id = :job_id AND requested_by = :requested_by AND status IN ('queued', 'running')
+RETURNING status, kind
+"""
+SELECT_JOBS_SQL = """
+SELECT job_id, kind, course_id, status, params, checkpoint, result FROM jobs
+WHERE requested_by = ? ORDER BY job_id DESC LIMIT ?
+"""
+
+# Raised from an import checkpoint once /cancel has been requested; any
+# arguments after the job ID say what the job left behind
+class JobCancelled(Exception):
+    pass
+
+# Raised from a checkpoint or heartbeat once the job's lease has been lost to another runner
+class JobLost(Exception):
+    pass
+
+# Function to queue a job, returning its ID
+@timed_query
+def create_job(kind, course_id, requested_by, chat_id, params):
+    with db_connection() as conn, conn:
+        cursor = conn.execute(INSERT_JOB_SQL, (kind, course_id, requested_by, chat_id, json.dumps(params), time.time()))
+    return cursor.lastrowid
+
+# Function to atomically take the oldest queued job, so two runners never get the same one
+@timed_query
+def claim_job(owner=JOB_OWNER):
+    with db_connection() as conn, conn:
+        row = conn.execute(CLAIM_JOB_SQL, {"now": time.time(), "owner": owner, "lease": JOB_LEASE_SECONDS}).fetchone()
+    if row is None:
+        return None
+    job_id, kind, course_id, requested_by, chat_id, params, checkpoint, owner = row
+    return {"job_id": job_id, "kind": kind, "course_id": course_id, "requested_by": requested_by, "chat_id": chat_id,
+            "params": json.loads(params), "checkpoint": json.loads(checkpoint) if checkpoint else None, "owner": owner}
+
+# Function to tell whether the runner owning a job has exited. Only owners on
+# this host can be checked; for the others the lease decides.
+def job_owner_gone(owner):
+    if owner is None:
+        return True
+    host, _, pid = owner.rpartition(":")
+    if host != socket.gethostname() or os.name != "posix":
+        return False
+    try:
+        os.kill(int(pid), 0)
+    except ProcessLookupError:
+        return True
+    except (PermissionError, ValueError):
+        return False
+    return False
+
+# Function to hand running jobs back to the queue once their lease has run out
+# or their owner has exited. A job whose owner is alive and still renewing its
+# lease is never taken from it.
+@timed_query
+def requeue_stale_jobs():
+    with db_connection() as conn, conn:
+        requeued = conn.execute(REQUEUE_EXPIRED_JOBS_SQL, (time.time(),)).rowcount
+        for job_id, owner in conn.execute(SELECT_RUNNING_JOBS_SQL).fetchall():
+            if job_owner_gone(owner):
+                requeued += conn.execute(REQUEUE_JOB_SQL, (job_id, owner)).rowcount
+    if requeued:
+        logger.info(f"Requeued {requeued} interrupted jobs.")
+    return requeued
+
+# Function to renew a running job's lease; returns whether /cancel was requested
+# and raises JobLost once the job has been requeued or claimed by another runner
+def heartbeat_job(job_id, owner=JOB_OWNER):
+    with db_connection() as conn, conn:
+        row = conn.execute(HEARTBEAT_JOB_SQL, {"now": time.time(), "lease": JOB_LEASE_SECONDS, "job_id": job_id, "owner": owner}).fetchone()
+    if row is None:
+        raise JobLost(job_id)
+    return bool(row[0])
+
+# Renews a job's lease every JOB_HEARTBEAT_INTERVAL seconds from the process
+# doing the work, for as long as the block runs, so that a long step such as a
+# reset or the recompute at the end of an import keeps the job.
+@contextmanager
+def job_heartbeat(job_id, owner=JOB_OWNER):
+    stop = threading.Event()
+
+    def beat():
+        while not stop.wait(JOB_HEARTBEAT_INTERVAL):
+            try:
+                heartbeat_job(job_id, owner)
+            except JobLost:
+                logger.warning(f"Job #{job_id} was taken over by another runner.")
+                return
+            except sqlite3.Error as e:
+                logger.warning(f"Error renewing the lease of job #{job_id}: {e}")
+
+    thread = threading.Thread(target=beat, name=f"job-{job_id}-heartbeat", daemon=True)
+    thread.start()
+    try:
+        yield
+    finally:
+        stop.set()
+        thread.join()
+
+# Function to record how far an import got, renewing the job's lease. Raises
+# JobCancelled if /cancel was requested and JobLost if another runner has the job.
+def record_job_checkpoint(job_id, report, owner=JOB_OWNER):
+    checkpoint = {"rows_read": report.rows_read, "rows_imported": report.rows_imported, "rows_rejected": report.rows_rejected,
+                  "history_from": report.history_from}
+    with db_connection() as conn, conn:
+        row = conn.execute(CHECKPOINT_JOB_SQL, {"checkpoint": json.dumps(checkpoint), "now": time.time(), "lease": JOB_LEASE_SECONDS,
+                                                "job_id": job_id, "owner": owner}).fetchone()
+    if row is None:
+        raise JobLost(job_id)
+    if row[0]:
+        raise JobCancelled(job_id, f"The {report.rows_imported} rows imported before it stopped have been kept.")
+
+@timed_query
+def finish_job(job_id, status, result):
+    with db_connection() as conn, conn:
+        conn.execute(FINISH_JOB_SQL, (status, result, time.time(), job_id))
+
+# Function to cancel one of a teacher's jobs, returning (status afterwards, kind) or None.
+# A queued job is cancelled straight away; a running import stops at its next
+# checkpoint, and a running reset is left to complete.
+@timed_query
+def cancel_job(job_id, requested_by):
+    with db_connection() as conn, conn:
+        row = conn.execute(CANCEL_JOB_SQL, {"now": time.time(), "job_id": job_id, "requested_by": requested_by}).fetchone()
+    return tuple(row) if row else None
+
+@timed_query
+def list_jobs(requested_by, limit=JOB_LIST_LIMIT):
+    with db_connection() as conn:
+        return conn.execute(SELECT_JOBS_SQL, (requested_by, limit)).fetchall()
+
+# Import job body; runs in the heavy process pool when there is one. Every
+# checkpoint is recorded in the jobs table, then the import pauses briefly
+# so interactive writers get the write lock between chunks. The history
+# checkpoint is taken once the import has committed (or failed part way).
+def import_job(job_id, csv_file_path, source, course_id=DEFAULT_COURSE, resume=None, progress=None, changed_by=None, owner=JOB_OWNER):
+    def checkpoint(report):
+        record_job_checkpoint(job_id, report, owner)
+        time.sleep(JOB_THROTTLE_SECONDS)
+
+    with job_heartbeat(job_id, owner):
         try:
-            cursor = conn.cursor()
-            cursor.execute("""
-            CREATE TABLE IF NOT EXISTS users (
-                id TEXT PRIMARY KEY,
-                college_id TEXT NOT NULL,
-                role TEXT NOT NULL
-            )
-            """)
-            cursor.execute("""
-            CREATE TABLE IF NOT EXISTS grades (
-                student_id TEXT NOT NULL,
-                subject TEXT NOT NULL,
-                grade REAL NOT NULL,
-                PRIMARY KEY (student_id, subject)
-            )
-            """)
-            cursor.execute("""
-            CREATE TABLE IF NOT EXISTS detailed_grades (
-                student_id TEXT NOT NULL,
-                subject TEXT NOT NULL,
-                homework REAL,
-                quizzes REAL,
-                midterm REAL,
-                final REAL,
-                attendance REAL,
-                overall REAL,
-                PRIMARY KEY (student_id, subject)
-            )
-            """)
-
-            # Check if the columns exist
-            cursor.execute("PRAGMA table_info(detailed_grades)")
-            columns = cursor.fetchall()
-            column_names = [column[1] for column in columns]
-            if "overall" not in column_names:
-                cursor.execute("ALTER TABLE detailed_grades ADD COLUMN overall REAL")
-
-            cursor.execute("""
-            CREATE TABLE IF NOT EXISTS grading_logic (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                description TEXT
-            )
-            """)
-
-            users = [
-                ("1", "1", "student"),
-                ("2", "2", "student"),
-                ("3", "3", "student"),
-                ("123", "123", "teacher")
-            ]
-            cursor.executemany("INSERT OR IGNORE INTO users (id, college_id, role) VALUES (?, ?, ?)", users)
-            conn.commit()
-            logger.info("Database initialized successfully.")
-        except sqlite3.Error as e:
-            logger.error(f"Error initializing database: {e}")
+            with open(csv_file_path, newline='', encoding='utf-8-sig') as csvfile:
+                return bulk_import_grades(csvfile, source, progress, course_id=course_id, checkpoint=checkpoint,
+                                          checkpoint_chunks=JOB_CHECKPOINT_CHUNKS, resume=resume, changed_by=changed_by)
         finally:
-            conn.close()
+            checkpoint_course_history(course_id)
 
-# Function to add a user
-def add_user(user_id, college_id, role):
-    conn = db_connection()
-    if conn:
-        try:
-            cursor = conn.cursor()
-            cursor.execute("INSERT OR IGNORE INTO users (id, college_id, role) VALUES (?, ?, ?)", (user_id, college_id, role))
-            conn.commit()
-            logger.info(f"User {user_id} added successfully with role {role}.")
-        except sqlite3.Error as e:
-            logger.error(f"Error adding user {user_id}: {e}")
-        finally:
-            conn.close()
+# Reset job body; runs in the heavy process pool when there is one
+def reset_job(job_id, course_id, changed_by=None, owner=JOB_OWNER):
+    with job_heartbeat(job_id, owner):
+        reset_gradebook(course_id, changed_by=changed_by)
 
-# Function to check if a user is a teacher
-def is_teacher(user_id):
-    conn = db_connection()
-    if conn:
+# Function to remove an uploaded CSV once its import job is over
+def discard_job_file(params):
+    if params.get("owned"):
         try:
-            cursor = conn.cursor()
-            cursor.execute("SELECT role FROM users WHERE id = ?", (user_id,))
-            result = cursor.fetchone()
-            return result and result[0] == "teacher"
-        except sqlite3.Error as e:
-            logger.error(f"Error checking user role for {user_id}: {e}")
-            return False
-        finally:
-            conn.close()
-    return False
+            os.remove(params["path"])
+        except OSError as e:
+            logger.warning(f"Could not remove {params['path']}: {e}")
 
-# Function to add detailed grade components to the database
-def add_detailed_grade_to_db(student_id, subject, homework, quizzes, midterm, final, attendance, overall):
-    conn = db_connection()
-    if conn:
-        try:
-            cursor = conn.cursor()
-            cursor.execute("INSERT OR REPLACE INTO detailed_grades (student_id, subject, homework, quizzes, midterm, final, attendance, overall) VALUES (?, ?, ?, ?, ?, ?, ?, ?)", 
-                           (student_id, subject, homework, quizzes, midterm, final, attendance, overall))
-            conn.commit()
-            logger.info(f"Detailed grades added for student {student_id}: {subject} - Homework: {homework}, Quizzes: {quizzes}, Midterm: {midterm}, Final: {final}, Attendance: {attendance}, Overall: {overall}")
-        except sqlite3.Error as e:
-            logger.error(f"Error adding detailed grades for {student_id}: {e}")
-        finally:
-            conn.close()
+async def run_import_job(runner, job):
+    job_id, chat_id, course_id, params = job["job_id"], job["chat_id"], job["course_id"], job["params"]
+    source = params["source"]
+    loop = asyncio.get_running_loop()
 
-# Function to fetch grades for a student
-def get_grades_for_student(student_id):
-    conn = db_connection()
-    if conn:
-        try:
-            cursor = conn.cursor()
-            cursor.execute("SELECT subject, grade FROM grades WHERE student_id = ?", (student_id,))
-            grades = cursor.fetchall()
-            logger.info(f"Grades fetched for student {student_id}: {grades}")
-            return grades
-        except sqlite3.Error as e:
-            logger.error(f"Error fetching grades for student {student_id}: {e}")
-            return []
-        finally:
-            conn.close()
-    return []
+    def progress(report):
+        loop.call_soon_threadsafe(DISPATCHER.enqueue, chat_id, f"Job #{job_id}: importing {source}, {report.rows_read} rows processed...")
 
-# Function to fetch detailed grades for a student
-def get_detailed_grades_for_student(student_id):
-    conn = db_connection()
-    if conn:
+    try:
+        report = await runner.call(import_job, job_id, params["path"], source, course_id, job["checkpoint"],
+                                   progress=progress, changed_by=params.get("changed_by"), owner=job["owner"])
+    except JobLost:
+        raise
+    except Exception:
+        discard_job_file(params)
+        raise
+    finally:
+        # The import may have run (and committed) in another process
+        RESPONSES.invalidate_grades(course_id)
+        SNAPSHOTS.mark_stale(course_id)
+    discard_job_file(params)
+    if NOTIFY_STUDENTS and report.rows_imported:
         try:
-            cursor = conn.cursor()
-            cursor.execute("SELECT subject, homework, quizzes, midterm, final, attendance, overall FROM detailed_grades WHERE student_id = ?", (student_id,))
-            grades = cursor.fetchall()
-            logger.info(f"Detailed grades fetched for student {student_id}: {grades}")
-            return grades
+            NOTIFIER.notify(course_id, await run_db(get_changed_students, course_id, report.history_from, report.history_to))
         except sqlite3.Error as e:
-            logger.error(f"Error fetching detailed grades for student {student_id}: {e}")
-            return []
-        finally:
-            conn.close()
-    return []
+            logger.error(f"Error finding the students changed by job #{job_id}: {e}")
 
-# Function to fetch the college ID of a user
-def get_college_id(user_id):
-    conn = db_connection()
-    if conn:
-        try:
-            cursor = conn.cursor()
-            cursor.execute("SELECT college_id FROM users WHERE id = ?", (user_id,))
-            result = cursor.fetchone()
-            logger.info(f"Fetched college_id {result} for user_id {user_id}")
-            return result[0] if result else None
-        except sqlite3.Error as e:
-            logger.error(f"Error fetching college ID for user {user_id}: {e}")
-            return None
-        finally:
-            conn.close()
-    return None
+    summary = f"Job #{job_id}: grades uploaded from {source} to course {course_id}: {report.rows_imported} of {report.rows_read} rows imported in {report.elapsed:.1f}s."
+    if report.rows_rejected:
+        preview = "\n".join(f"Row {row_number}: {reason}" for row_number, reason, _ in report.errors[:IMPORT_ERROR_PREVIEW])
+        summary += f"\n{report.rows_rejected} rows rejected:\n{preview}"
+    if len(report.errors) > IMPORT_ERROR_PREVIEW:
+        error_report = io.BytesIO(format_import_errors(report.errors).encode("utf-8"))
+        DISPATCHER.enqueue_document(chat_id, error_report, "import_errors.csv")
+    return summary
 
-# Function to define grading logic
-def define_grading_logic(description):
-    conn = db_connection()
-    if conn:
-        try:
-            cursor = conn.cursor()
-            cursor.execute("INSERT INTO grading_logic (description) VALUES (?)", (description,))
-            conn.commit()
-            logger.info("Grading logic defined successfully.")
-        except sqlite3.Error as e:
-            logger.error(f"Error defining grading logic: {e}")
-        finally:
-            conn.close()
+async def run_reset_job(runner, job):
+    try:
+        await runner.call(reset_job, job["job_id"], job["course_id"], changed_by=job["params"].get("changed_by"), owner=job["owner"])
+    finally:
+        RESPONSES.invalidate_grades(job["course_id"])
+        SNAPSHOTS.mark_stale(job["course_id"])
+        RESPONSES.invalidate_logic(job["course_id"])
+    return f"Job #{job['job_id']}: grades and grading logic of course {job['course_id']} have been reset."
 
-# Function to reset grades and grading logic
-async def reset(update: Update, context: CallbackContext):
-    user_id = str(update.message.from_user.id)
+JOB_KINDS = {"import": run_import_job, "reset": run_reset_job}
 
-    if not is_teacher(user_id):
-        await update.message.reply_text("You are not authorized to reset grades and grading logic.")
-        return
+# Claims queued jobs and runs up to `workers` of them at once, each in the heavy
+# process pool or, without one, in its own thread pool so the DB executor
+# stays free for handlers. The outcome is sent to the chat that queued the job.
+class JobRunner:
+    def __init__(self, workers=JOB_WORKERS, poll_interval=JOB_POLL_INTERVAL):
+        self.workers = workers
+        self.poll_interval = poll_interval
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="job")
+        self._running = set()
+        self._wakeup = None
+        self._task = None
+        self.metrics = {"claimed": 0, "done": 0, "failed": 0, "cancelled": 0, "lost": 0}
 
-    conn = db_connection()
-    if conn:
-        try:
-            cursor = conn.cursor()
-            cursor.execute("DELETE FROM grades")
-            cursor.execute("DELETE FROM detailed_grades")
-            cursor.execute("DELETE FROM grading_logic")
-            conn.commit()
-            logger.info("Grades and grading logic reset successfully.")
-            await update.message.reply_text("Grades and grading logic have been reset.")
-        except sqlite3.Error as e:
-            logger.error(f"Error resetting grades and grading logic: {e}")
-            await update.message.reply_text("Error resetting grades and grading logic.")
-        finally:
-            conn.close()
+    def start(self):
+        self._wakeup = asyncio.Event()
+        self._task = asyncio.get_running_loop().create_task(self._run())
 
-# Function to fetch grading logic
-def get_grading_logic():
-    conn = db_connection()
-    if conn:
+    # Jobs still running are left as they are; another runner requeues them once this process has exited or their lease has run out
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            self._task = None
+        for task in list(self._running):
+            task.cancel()
+
+    # Called after a job is queued so it starts without waiting for the next poll
+    def notify(self):
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    async def call(self, func, *args, progress=None, **kwargs):
+        return await run_heavy(func, *args, progress=progress, fallback=self._executor, **kwargs)
+
+    async def _run(self):
+        while True:
+            self._wakeup.clear()
+            try:
+                await run_db(requeue_stale_jobs)
+                while len(self._running) < self.workers:
+                    job = await run_db(claim_job)
+                    if job is None:
+                        break
+                    self.metrics["claimed"] += 1
+                    task = asyncio.get_running_loop().create_task(self._execute(job))
+                    self._running.add(task)
+                    task.add_done_callback(self._job_done)
+            except sqlite3.Error as e:
+                logger.error(f"Error claiming jobs: {e}")
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.poll_interval)
+            except asyncio.TimeoutError:
+                pass
+
+    def _job_done(self, task):
+        self._running.discard(task)
+        self.notify()
+
+    # Any error fails the job; only cancelling the task (stop()) leaves it running for requeueing
+    async def _execute(self, job):
+        job_id = job["job_id"]
         try:
-            cursor = conn.cursor()
-            cursor.execute("SELECT description FROM grading_logic")
-            logic = cursor.fetchall()
-            logger.info(f"Grading logic fetched: {logic}")
-            if not logic:
-                logger.info("No grading logic found in the database.")
-            return logic
+            result = await JOB_KINDS[job["kind"]](self, job)
+            status = "done"
+        except JobCancelled as e:
+            status, result = "cancelled", " ".join([f"Job #{job_id} cancelled.", *e.args[1:]])
+        except JobLost:
+            # The runner that took the job over finishes and reports it
+            logger.warning(f"Job #{job_id} ({job['kind']}) was taken over by another runner.")
+            self.metrics["lost"] += 1
+            return
+        except Exception as e:
+            logger.error(f"Job #{job_id} ({job['kind']}) failed: {e!r}", exc_info=True)
+            status, result = "failed", f"Job #{job_id} failed: {e}"
+        self.metrics[status] += 1
+        try:
+            await run_db(finish_job, job_id, status, result)
         except sqlite3.Error as e:
-            logger.error(f"Error fetching grading logic: {e}")
-            return []
-        finally:
-            conn.close()
-    return []
+            logger.error(f"Error finishing job #{job_id}: {e}")
+        DISPATCHER.enqueue(job["chat_id"], result)
 
-# Command: Show Available Commands
-async def show_commands(role):
-    if role == "teacher":
-        return """
-Available commands for teachers:
-/add_grade <student_college_id> <subject> <homework> <quizzes> <midterm> <final> <attendance> <overall> - Add a grade for a student.
-/upload_grades <csv_file_path> - Upload grades from a CSV file.
-/view_all_grades - View all grades.
-/grading_logic <description> - Define grading logic.
-/view_grading_logic - View current grading logic.
-/reset - Reset grades and grading logic for all students.
-/logout - Log out.
-"""
-    else:  # role is "student"
-        return """
-Available commands for students:
-/view_grades - View your grades.
-/view_detailed_grades - View detailed grades during the term.
-/view_grading_logic - View current grading logic defined by the teacher.
-/logout - Log out.
-"""
+    def stats(self):
+        return {**self.metrics, "running": len(self._running)}
 
-# Command: Start and prompt for college ID
-async def start(update: Update, context: CallbackContext):
-    user_id = str(update.message.from_user.id)
-    if user_id in LOGGED_IN:
-        await update.message.reply_text("You are already logged in. Use /logout to log out.")
-    else:
-        await update.message.reply_text("Welcome! Please enter your college ID to proceed.")
-        return COLLEGE_ID
+JOBS = JobRunner()
 
-# Handle college ID and determine user role
-async def college_id(update: Update, context: CallbackContext):
+# Function to queue a job for a handler, replying with its ID straight away
+async def submit_job(update: Update, kind, course_id, user_id, params):
+    try:
+        job_id = await run_db(create_job, kind, course_id, user_id, update.effective_chat.id, params)
+    except sqlite3.Error as e:
+        logger.error(f"Error queueing {kind} job: {e}")
+        reply(update, "Error queueing the job.")
+        return None
+    JOBS.notify()
+    reply(update, f"Queued as job #{job_id}. You will be notified here when it finishes; use /jobs to check on it or /cancel {job_id} to stop it.")
+    return job_id
+
+# Teacher: Upload Grades from CSV
+@timed_command
+async def upload_grades(update: Update, context: CallbackContext):
     user_id = str(update.message.from_user.id)
-    college_id = update.message.text.strip()
 
-    # Determine role
-    if college_id == "123":
-        role = "teacher"
-    elif college_id in ["1", "2", "3"]:
-        role = "student"
-    else:
-        await update.message.reply_text("Access denied. Invalid college ID.")
-        return ConversationHandler.END
+    college_id, course_id = await teacher_session(user_id)
+    if course_id is None:
+        reply(update, "You are not authorized to upload grades.")
+        return
 
-    # Add user to database and log them in
-    add_user(user_id, college_id, role)
-    LOGGED_IN[user_id] = (college_id, role)
+    # Replying to a CSV document with /upload_grades imports that document
+    replied = update.message.reply_to_message
+    if replied and replied.document:
+        await upload_grades_document(update, context, replied.document)
+        return
 
-    commands = await show_commands(role)
-    await update.message.reply_text(f"College ID verified! You are logged in as a {role}.\n{commands}")
-    return ConversationHandler.END
+    if len(context.args) < 1:
+        reply(update, "Usage: /upload_grades <csv_file_path>, or send a .csv file")
+        return
 
-# Command: Logout
-async def logout(update: Update, context: CallbackContext):
+    csv_file_path = context.args[0]
+    await submit_job(update, "import", course_id, user_id, {"path": csv_file_path, "source": csv_file_path, "changed_by": college_id})
+
+# Teacher: Upload Grades from a CSV document sent to the bot. The file is kept
+# in JOB_DIR until its import job is over.
+@timed_command
+async def upload_grades_document(update: Update, context: CallbackContext, document=None):
     user_id = str(update.message.from_user.id)
-    if user_id in LOGGED_IN:
-        del LOGGED_IN[user_id]
-        await update.message.reply_text("You have been logged out.")
-    else:
-        await update.message.reply_text("You are not logged in.")
 
-# Teacher: Add Grade (continued)
-async def add_grade(update: Update, context: CallbackContext):
+    college_id, course_id = await teacher_session(user_id)
+    if course_id is None:
+        reply(update, "You are not authorized to upload grades.")
+        return
+
+    from telegram.error import TelegramError
+    document = document or update.message.document
+    source = document.file_name or "uploaded file"
+    os.makedirs(JOB_DIR, exist_ok=True)
+    fd, csv_file_path = tempfile.mkstemp(suffix=".csv", dir=JOB_DIR)
+    os.close(fd)
+    try:
+        telegram_file = await context.bot.get_file(document.file_id)
+        await telegram_file.download_to_drive(csv_file_path)
+    except (OSError, TelegramError) as e:
+        logger.error(f"Error downloading {source}: {e}")
+        os.remove(csv_file_path)
+        reply(update, f"Error uploading grades from {source}")
+        return
+    params = {"path": os.path.abspath(csv_file_path), "source": source, "owned": True, "changed_by": college_id}
+    job_id = await submit_job(update, "import", course_id, user_id, params)
+    if job_id is None:
+        os.remove(csv_file_path)
+
+# Function to describe one job for /jobs
+def describe_job(job_id, kind, course_id, status, params, checkpoint, result):
+    text = f"#{job_id} {kind}"
+    if kind == "import":
+        text += f" {json.loads(params)['source']}"
+    text += f" (course {course_id}): {status}"
+    if status == "running" and checkpoint:
+        text += f", {json.loads(checkpoint)['rows_read']} rows processed"
+    elif status in ("done", "failed") and result:
+        text += f"\n  {result.splitlines()[0]}"
+    return text
+
+# Teacher: List recent background jobs
+@timed_command
+async def jobs(update: Update, context: CallbackContext):
     user_id = str(update.message.from_user.id)
 
-    if not is_teacher(user_id):
-        await update.message.reply_text("You are not authorized to add grades.")
+    if await teacher_course(user_id) is None:
+        reply(update, "You are not authorized to view jobs.")
         return
 
-    # Check if grading logic is defined
-    logic = get_grading_logic()
-    if not logic:
-        await update.message.reply_text("Please set a grading logic before adding grades.")
+    rows = await run_db(list_jobs, user_id)
+    if not rows:
+        reply(update, "No jobs yet.")
         return
+    reply(update, "Recent jobs:\n" + "\n".join(describe_job(*row) for row in rows))
+
+# Teacher: Cancel a queued or running job
+@timed_command
+async def cancel(update: Update, context: CallbackContext):
+    user_id = str(update.message.from_user.id)
 
-    if len(context.args) < 8:  # Requires at least 7 grading components plus the overall grade
-        await update.message.reply_text("Usage: /add_grade <student_college_id> <subject> <homework> <quizzes> <midterm> <final> <attendance> <overall>")
+    if await teacher_course(user_id) is None:
+        reply(update, "You are not authorized to cancel jobs.")
         return
 
-    student_id, subject, homework, quizzes, midterm, final, attendance, overall = context.args[0], context.args[1], context.args[2], context.args[3], context.args[4], context.args[5], context.args[6], context.args[7]
-    
-    try:
-        homework = float(homework)
-        quizzes = float(quizzes)
-        midterm = float(midterm)
-        final = float(final)
-        attendance = float(attendance)
-        overall = float(overall)
-    except ValueError:
-        await update.message.reply_text("Invalid grade. Please provide numbers for all grading components.")
+    if len(context.args) != 1 or not context.args[0].lstrip("#").isdigit():
+        reply(update, "Usage: /cancel <job_id>")
         return
 
-    # Check if student exists
-    conn = db_connection()
-    if conn:
-        cursor = conn.cursor()
-        cursor.execute("SELECT * FROM users WHERE college_id = ?", (student_id,))
-        student_exists = cursor.fetchone()
-        conn.close()
+    job_id = int(context.args[0].lstrip("#"))
+    cancelled = await run_db(cancel_job, job_id, user_id)
+    if cancelled is None:
+        reply(update, f"Job #{job_id} is not one of your queued or running jobs.")
+    elif cancelled[0] == "cancelled":
+        reply(update, f"Job #{job_id} cancelled.")
+    elif cancelled[1] == "import":
+        reply(update, f"Job #{job_id} will stop at its next checkpoint. Rows imported by then are kept.")
+    else:
+        reply(update, f"Job #{job_id} is already running and cannot be stopped; it will complete.")
+
+# Export settings. Telegram bots cannot send documents over 50 MB; larger
+# dumps have to be taken with "python Final.py export".
+EXPORT_BATCH_SIZE = 5000
+EXPORT_MAX_DOCUMENT_BYTES = 50 * 1024 * 1024
+
+SELECT_EXPORT_SQL = "SELECT student_id, subject, homework, quizzes, midterm, final, attendance, overall FROM detailed_grades ORDER BY student_id, subject"
+
+# Columnar format: COLUMNAR_MAGIC, then one block per fetchmany batch. A block is
+# its row count (0 ends the file) followed by each column in IMPORT_COLUMNS order:
+# text columns as uint32 byte lengths plus the UTF-8 data, numeric columns as a
+# null bitmap plus little-endian float64 values.
+COLUMNAR_MAGIC = b"GBCOL1\n"
+COLUMNAR_TEXT_COLUMNS = 2
+
+# Function to stream the detailed grades of a course in fetchmany batches
+def iter_grade_batches(conn, batch_size=EXPORT_BATCH_SIZE):
+    cursor = conn.execute(SELECT_EXPORT_SQL)
+    while True:
+        rows = cursor.fetchmany(batch_size)
+        if not rows:
+            break
+        yield rows
 
-        if not student_exists:
-            await update.message.reply_text(f"Student with college ID {student_id} not found.")
+# Function to write batches of rows as CSV with the import header, so exports can be re-imported
+def write_grades_csv(fileobj, batches):
+    import csv
+    text = io.TextIOWrapper(fileobj, encoding="utf-8", newline="")
+    writer = csv.writer(text)
+    writer.writerow(IMPORT_COLUMNS)
+    count = 0
+    for rows in batches:
+        writer.writerows(rows)
+        count += len(rows)
+    text.flush()
+    text.detach()
+    return count
+
+# Function to serialise an array in little-endian byte order
+def little_endian(values):
+    if sys.byteorder != "little":
+        values.byteswap()
+    return values.tobytes()
+
+# Function to write batches of rows in the columnar format
+def write_grades_columnar(fileobj, batches):
+    fileobj.write(COLUMNAR_MAGIC)
+    count = 0
+    for rows in batches:
+        fileobj.write(struct.pack("<I", len(rows)))
+        for index, column in enumerate(zip(*rows)):
+            if index < COLUMNAR_TEXT_COLUMNS:
+                encoded = [str(value).encode("utf-8") for value in column]
+                fileobj.write(little_endian(array.array("I", map(len, encoded))))
+                fileobj.write(b"".join(encoded))
+            else:
+                bitmap = bytearray((len(rows) + 7) // 8)
+                for position, value in enumerate(column):
+                    if value is None:
+                        bitmap[position // 8] |= 1 << (position % 8)
+                fileobj.write(bytes(bitmap))
+                fileobj.write(little_endian(array.array("d", [0.0 if value is None else value for value in column])))
+        count += len(rows)
+    fileobj.write(struct.pack("<I", 0))
+    return count
+
+# Function to read a columnar export back as rows, one block at a time
+def read_grades_columnar(fileobj):
+    if fileobj.read(len(COLUMNAR_MAGIC)) != COLUMNAR_MAGIC:
+        raise ValueError("Not a gradebook columnar export")
+    while True:
+        (count,) = struct.unpack("<I", fileobj.read(4))
+        if count == 0:
             return
+        columns = []
+        for index in range(len(IMPORT_COLUMNS)):
+            if index < COLUMNAR_TEXT_COLUMNS:
+                lengths = array.array("I")
+                lengths.frombytes(fileobj.read(4 * count))
+                if sys.byteorder != "little":
+                    lengths.byteswap()
+                data = fileobj.read(sum(lengths))
+                offsets = list(itertools.accumulate(lengths, initial=0))
+                columns.append([data[offsets[i]:offsets[i + 1]].decode("utf-8") for i in range(count)])
+            else:
+                bitmap = fileobj.read((count + 7) // 8)
+                values = array.array("d")
+                values.frombytes(fileobj.read(8 * count))
+                if sys.byteorder != "little":
+                    values.byteswap()
+                columns.append([None if bitmap[i // 8] >> (i % 8) & 1 else value for i, value in enumerate(values)])
+        yield from zip(*columns)
 
-        # Add detailed grades and overall grade
-        add_detailed_grade_to_db(student_id, subject, homework, quizzes, midterm, final, attendance, overall)
-        await update.message.reply_text(f"Grades added: {student_id}, {subject} - Homework: {homework}, Quizzes: {quizzes}, Midterm: {midterm}, Final: {final}, Attendance: {attendance}, Overall: {overall}")
+EXPORT_FORMATS = {
+    "csv": (write_grades_csv, "csv"),
+    "columnar": (write_grades_columnar, "gbcol"),
+}
 
-# Teacher: Define Grading Logic
-async def grading_logic(update: Update, context: CallbackContext):
+# Function to dump a course's detailed grades to a binary file object, returning the row count.
+# The dump runs in one read transaction, so it sees a single WAL snapshot
+# while concurrent writers carry on; memory stays at one batch.
+@timed_query
+def export_grades(fileobj, fmt="csv", course_id=DEFAULT_COURSE, batch_size=EXPORT_BATCH_SIZE):
+    writer, _ = EXPORT_FORMATS[fmt]
+    start = time.perf_counter()
+    with course_connection(course_id) as conn:
+        conn.execute("BEGIN")
+        try:
+            count = writer(fileobj, iter_grade_batches(conn, batch_size))
+        finally:
+            conn.rollback()
+    logger.info(f"Exported {count} rows of course {course_id} as {fmt} in {time.perf_counter() - start:.2f}s")
+    return count
+
+# Teacher: Export the current course's grades as a document
+@timed_command
+async def export_grades_command(update: Update, context: CallbackContext):
     user_id = str(update.message.from_user.id)
 
-    if not is_teacher(user_id):
-        await update.message.reply_text("You are not authorized to define grading logic.")
+    course_id = await teacher_course(user_id)
+    if course_id is None:
+        reply(update, "You are not authorized to export grades.")
         return
 
-    if len(context.args) < 1:
-        await update.message.reply_text("Usage: /grading_logic <description>")
+    fmt = context.args[0].lower() if context.args else "csv"
+    if fmt not in EXPORT_FORMATS:
+        reply(update, f"Usage: /export_grades [{'|'.join(EXPORT_FORMATS)}]")
         return
 
-    description = " ".join(context.args)
-    define_grading_logic(description)
-    await update.message.reply_text("Grading logic defined.")
+    export_file = tempfile.TemporaryFile()
+    try:
+        count = await run_db(export_grades, export_file, fmt, course_id)
+    except (OSError, sqlite3.Error) as e:
+        export_file.close()
+        logger.error(f"Error exporting grades of course {course_id}: {e}")
+        reply(update, "Error exporting grades.")
+        return
 
-# Teacher: Upload Grades from CSV
-async def upload_grades(update: Update, context: CallbackContext):
+    size = export_file.tell()
+    if size > EXPORT_MAX_DOCUMENT_BYTES:
+        export_file.close()
+        reply(update, f"The export is {size / 1024 / 1024:.0f} MB, over Telegram's limit. Run \"python Final.py export --course {course_id}\" on the server instead.")
+        return
+    reply(update, f"Exported {count} rows of course {course_id}.")
+    DISPATCHER.enqueue_document(update.effective_chat.id, export_file, f"grades_{course_id}.{EXPORT_FORMATS[fmt][1]}")
+
+# CLI: python Final.py export [--course ID] [--format csv|columnar] [--output FILE]
+def export_main(argv):
+    import argparse
+    parser = argparse.ArgumentParser(prog="Final.py export", description="Dump detailed grades of a course")
+    parser.add_argument("--course", default=DEFAULT_COURSE)
+    parser.add_argument("--format", choices=list(EXPORT_FORMATS), default="csv")
+    parser.add_argument("--output", default="-", help="file to write, - for stdout")
+    parser.add_argument("--batch-size", type=int, default=EXPORT_BATCH_SIZE)
+    args = parser.parse_args(argv)
+
+    init_db()
+    if args.output == "-":
+        export_grades(sys.stdout.buffer, args.format, args.course, args.batch_size)
+        sys.stdout.flush()
+    else:
+        with open(args.output, "wb") as output:
+            export_grades(output, args.format, args.course, args.batch_size)
+
+# Function to format one detailed grade row for /view_all_grades
+def format_grade_entry(row):
+    student_id, subject, homework, quizzes, midterm, final, attendance, overall = row
+    return f"Student ID: {student_id}\nSubject: {subject}\nHomework: {homework}\nQuizzes: {quizzes}\nMidterm: {midterm}\nFinal: {final}\nAttendance: {attendance}\nOverall: {overall}"
+
+# Function to fit as many rows as possible into one Telegram message.
+# When paging backwards the rows nearest the cursor are kept.
+def render_grades_page(header, rows, from_end=False):
+    entries = [format_grade_entry(row)[:TELEGRAM_MESSAGE_LIMIT - len(header) - 2] for row in rows]
+    if from_end:
+        entries.reverse()
+    kept = []
+    length = len(header)
+    for entry in entries:
+        if length + 2 + len(entry) > TELEGRAM_MESSAGE_LIMIT:
+            break
+        kept.append(entry)
+        length += 2 + len(entry)
+    if from_end:
+        kept.reverse()
+    return "\n\n".join([header, *kept]), len(kept)
+
+# Function to parse "subject=<name>" / "student=<college_id>" filters
+def parse_grade_filters(args):
+    filters_ = {}
+    for arg in args:
+        key, sep, value = arg.partition("=")
+        if not sep or key not in ("subject", "student") or not value:
+            return None
+        filters_[key] = value
+    return filters_
+
+# Build the next or previous page for a /view_all_grades listing and update its state
+async def build_grades_page(state, direction=None):
+    after = tuple(state["last"]) if direction == "next" else None
+    before = tuple(state["first"]) if direction == "prev" else None
+    rows, has_more = await load_grades_page(after, before, state["filters"].get("subject"), state["filters"].get("student"), state["course"])
+    if not rows:
+        return None, None
+
+    from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+    text, shown = render_grades_page(f"All grades ({state['course']}):", rows, from_end=before is not None)
+    truncated = shown < len(rows)
+    if before is not None:
+        rows = rows[len(rows) - shown:]
+        has_prev, has_next = has_more or truncated, True
+    else:
+        rows = rows[:shown]
+        has_prev, has_next = after is not None, has_more or truncated
+    state["first"], state["last"] = rows[0][:2], rows[-1][:2]
+
+    buttons = []
+    if has_prev:
+        buttons.append(InlineKeyboardButton("« Prev", callback_data="view_all_grades:prev"))
+    if has_next:
+        buttons.append(InlineKeyboardButton("Next »", callback_data="view_all_grades:next"))
+    return text, InlineKeyboardMarkup([buttons]) if buttons else None
+
+# Teacher: View All Grades
+@timed_command
+async def view_all_grades(update: Update, context: CallbackContext):
     user_id = str(update.message.from_user.id)
 
-    if not is_teacher(user_id):
-        await update.message.reply_text("You are not authorized to upload grades.")
+    course_id = await teacher_course(user_id)
+    if course_id is None:
+        reply(update, "You are not authorized to view all grades.")
         return
 
-    if len(context.args) < 1:
-        await update.message.reply_text("Usage: /upload_grades <csv_file_path>")
+    grade_filters = parse_grade_filters(context.args)
+    if grade_filters is None:
+        reply(update, "Usage: /view_all_grades [subject=<subject>] [student=<student_college_id>]")
         return
 
-    csv_file_path = context.args[0]
+    state = {"course": course_id, "filters": grade_filters, "first": None, "last": None}
+    try:
+        text, markup = await build_grades_page(state)
+    except sqlite3.Error as e:
+        logger.error(f"Error fetching all grades: {e}")
+        reply(update, "Error fetching all grades.")
+        return
+
+    if text is None:
+        reply(update, "No grades found.")
+        logger.debug("No grades found in the database.")
+    else:
+        STATE.set("view_all_grades", user_id, state)
+        reply(update, text, reply_markup=markup)
+
+# Teacher: Next/Prev buttons under a /view_all_grades page
+@timed_command
+async def view_all_grades_page(update: Update, context: CallbackContext):
+    query = update.callback_query
+    await query.answer()
+    user_id = str(query.from_user.id)
 
+    if not await has_role(user_id, "teacher"):
+        await query.edit_message_text("You are not authorized to view all grades.")
+        return
+
+    state = await get_state("view_all_grades", user_id)
+    if not state or state.get("course") != await teacher_course(user_id):
+        await query.edit_message_text("This listing has expired. Send /view_all_grades again.")
+        return
+
+    direction = query.data.partition(":")[2]
+    state = dict(state)
     try:
-        with open(csv_file_path, newline='') as csvfile:
-            reader = csv.reader(csvfile)
-            for row in reader:
-                student_id, subject, homework, quizzes, midterm, final, attendance, overall = row
-                try:
-                    homework = float(homework)
-                    quizzes = float(quizzes)
-                    midterm = float(midterm)
-                    final = float(final)
-                    attendance = float(attendance)
-                    overall = float(overall)
-                    add_detailed_grade_to_db(student_id, subject, homework, quizzes, midterm, final, attendance, overall)
-                except ValueError:
-                    logger.error(f"Invalid grade value in CSV: {row}")
-        await update.message.reply_text(f"Grades uploaded from {csv_file_path}")
-    except Exception as e:
-        logger.error(f"Error reading CSV file {csv_file_path}: {e}")
-        await update.message.reply_text(f"Error uploading grades from {csv_file_path}")
+        text, markup = await build_grades_page(state, direction)
+    except sqlite3.Error as e:
+        logger.error(f"Error fetching all grades: {e}")
+        await query.edit_message_text("Error fetching all grades.")
+        return
 
-# Teacher: View All Grades
-async def view_all_grades(update: Update, context: CallbackContext):
+    if text is None:
+        await query.edit_message_text("No more grades.")
+    else:
+        STATE.set("view_all_grades", user_id, state)
+        await query.edit_message_text(text, reply_markup=markup)
+
+# Teacher: Course statistics
+@timed_command
+async def stats(update: Update, context: CallbackContext):
     user_id = str(update.message.from_user.id)
 
-    if not is_teacher(user_id):
-        await update.message.reply_text("You are not authorized to view all grades.")
+    course_id = await teacher_course(user_id)
+    if course_id is None:
+        reply(update, "You are not authorized to view statistics.")
         return
 
-    conn = db_connection()
-    if conn:
-        try:
-            cursor = conn.cursor()
-            cursor.execute("SELECT student_id, subject, homework, quizzes, midterm, final, attendance, overall FROM detailed_grades")
-            grades = cursor.fetchall()
-            if not grades:
-                await update.message.reply_text("No grades found.")
-                logger.info("No grades found in the database.")
-            else:
-                grade_list = ""
-                for student_id, subject, homework, quizzes, midterm, final, attendance, overall in grades:
-                    grade_list += f"Student ID: {student_id}\nSubject: {subject}\nHomework: {homework}\nQuizzes: {quizzes}\nMidterm: {midterm}\nFinal: {final}\nAttendance: {attendance}\nOverall: {overall}\n\n"
-                await update.message.reply_text(f"All grades:\n{grade_list}")
-        except sqlite3.Error as e:
-            logger.error(f"Error fetching all grades: {e}")
-            await update.message.reply_text("Error fetching all grades.")
-        finally:
-            conn.close()
+    subject = " ".join(context.args) or None
+    try:
+        text = await run_heavy(format_subject_stats, subject, course_id)
+    except sqlite3.Error as e:
+        logger.error(f"Error fetching statistics: {e}")
+        reply(update, "Error fetching statistics.")
+        return
+
+    if text is None:
+        reply(update, "No grades found.")
+    else:
+        reply(update, text[:TELEGRAM_MESSAGE_LIMIT])
 
 # Student: View Grades
+@timed_command
 async def view_grades(update: Update, context: CallbackContext):
     user_id = str(update.message.from_user.id)
-    college_id, role = LOGGED_IN.get(user_id, (None, None))
+    college_id, role, course_id = await authorize(user_id)
 
     if not college_id:
-        await update.message.reply_text("Error: Your college ID could not be found. Please log in again.")
+        reply(update, "Error: Your college ID could not be found. Please log in again.")
         return
 
     if role != "student":
-        await update.message.reply_text("You are not authorized to view grades.")
+        reply(update, "You are not authorized to view grades.")
         return
 
-    conn = db_connection()
-    if conn:
+    # A warm repeat is answered from the cache without touching the database
+    key = RESPONSES.student_key("view_grades", course_id, college_id)
+    found, text = RESPONSES.get(key)
+    if not found:
         try:
-            cursor = conn.cursor()
-            cursor.execute("SELECT overall FROM detailed_grades WHERE student_id = ?", (college_id,))
-            grades = cursor.fetchall()
-            logger.info(f"Grades fetched for student {college_id}: {grades}")
-            if not grades:
-                await update.message.reply_text("No grades found.")
-            else:
-                grade_list = "\n".join([f"Overall: {grade[0]}" for grade in grades])
-                await update.message.reply_text(f"Your overall grade:\n{grade_list}")
+            grades = await load_overall_grades(college_id, course_id)
         except sqlite3.Error as e:
             logger.error(f"Error fetching grades for student {college_id}: {e}")
-            await update.message.reply_text("Error fetching your grades.")
-        finally:
-            conn.close()
+            reply(update, "Error fetching your grades.")
+            return
+
+        if not grades:
+            text = "No grades found."
+        else:
+            grade_list = "\n".join([f"Overall: {grade[0]}" for grade in grades])
+            text = f"Your overall grade:\n{grade_list}"
+        RESPONSES.put(key, text)
+    reply(update, text)
             
 # Student: View Detailed Grades
+@timed_command
 async def view_detailed_grades(update: Update, context: CallbackContext):
     user_id = str(update.message.from_user.id)
-    college_id, role = LOGGED_IN.get(user_id, (None, None))
+    college_id, role, course_id = await authorize(user_id)
 
     if not college_id:
-        await update.message.reply_text("Error: Your college ID could not be found. Please log in again.")
+        reply(update, "Error: Your college ID could not be found. Please log in again.")
         return
 
     if role != "student":
-        await update.message.reply_text("You are not authorized to view grades.")
+        reply(update, "You are not authorized to view grades.")
         return
 
-    conn = db_connection()
-    if conn:
+    key = RESPONSES.student_key("view_detailed_grades", course_id, college_id)
+    found, text = RESPONSES.get(key)
+    if not found:
         try:
-            cursor = conn.cursor()
-            cursor.execute("SELECT subject, homework, quizzes, midterm, final, attendance, overall FROM detailed_grades WHERE student_id = ?", (college_id,))
-            grades = cursor.fetchall()
-            logger.info(f"Detailed grades fetched for student {college_id}: {grades}")
-            if not grades:
-                await update.message.reply_text("No grades found.")
-            else:
-                grade_list = "\n".join([f"Subject: {subject}, Homework: {homework}, Quizzes: {quizzes}, Midterm: {midterm}, Final: {final}, Attendance: {attendance}, Overall: {overall}" for subject, homework, quizzes, midterm, final, attendance, overall in grades])
-                await update.message.reply_text(f"Your detailed grades:\n{grade_list}")
+            grades = await load_detailed_grades(college_id, course_id)
         except sqlite3.Error as e:
             logger.error(f"Error fetching detailed grades for student {college_id}: {e}")
-            await update.message.reply_text("Error fetching your detailed grades.")
-        finally:
-            conn.close()
+            reply(update, "Error fetching your detailed grades.")
+            return
+
+        if not grades:
+            text = "No grades found."
+        else:
+            grade_list = "\n".join([f"Subject: {subject}, Homework: {homework}, Quizzes: {quizzes}, Midterm: {midterm}, Final: {final}, Attendance: {attendance}, Overall: {overall}" for subject, homework, quizzes, midterm, final, attendance, overall in grades])
+            text = f"Your detailed grades:\n{grade_list}"
+        RESPONSES.put(key, text)
+    reply(update, text)
 
 # Student/Teacher: View Grading Logic
+@timed_command
 async def view_grading_logic(update: Update, context: CallbackContext):
     user_id = str(update.message.from_user.id)
-    logic = get_grading_logic()
+    _, _, course_id = await authorize(user_id)
+    logic = await cached_grading_logic(course_id or DEFAULT_COURSE)
 
-    if not logic:
-        await update.message.reply_text("No grading logic defined yet.")
-        logger.info(f"No grading logic found for user {user_id}.")
-        await update.message.reply_text("Test message: No logic found.")
+    # Flatten the list of tuples and drop empty descriptions
+    logic_text = "\n".join(desc[0] for desc in logic if desc[0])
+    if not logic_text:
+        reply(update, "No grading logic defined yet.")
+        logger.debug("No grading logic found for user %s.", user_id)
     else:
-        # Flatten the list of tuples to a list of strings
-        logic_list = [desc[0] for desc in logic]
-        logger.info(f"Constructed logic list: {logic_list}")
-
-        # Join the list into a single string
-        logic_text = "\n".join(logic_list)
-        logger.info(f"Constructed logic text: {logic_text}")
-        await update.message.reply_text("Test message: Logic found.")
-        
-        # Check if the logic_text is empty or None
-        if not logic_text:
-            await update.message.reply_text("No grading logic found or unable to construct the list.")
-            logger.error(f"Failed to construct logic text for user {user_id}.")
-        else:
-            await update.message.reply_text(f"Current grading logic:\n{logic_text}")
-            logger.info(f"Grading logic sent to user {user_id}: {logic_text}")
+        reply(update, f"Current grading logic:\n{logic_text}")
             
-# Main: Start bot
-def main():
-    # Initialize database
-    init_db()
-
-    # Bot setup
-    application = Application.builder().token("token").build()
-
-    # Handlers
-    conversation_handler = ConversationHandler(
-        entry_points=[CommandHandler("start", start)],
-        states={COLLEGE_ID: [MessageHandler(filters.TEXT & ~filters.COMMAND, college_id)]},
-        fallbacks=[],
-    )
-    application.add_handler(conversation_handler)
+# Register every command and message handler on an application
+def register_handlers(application):
+    from telegram.ext import CommandHandler, MessageHandler, CallbackQueryHandler, filters
+    application.add_handler(CommandHandler("start", start))
+    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, college_id))
     application.add_handler(CommandHandler("logout", logout))
+    application.add_handler(CommandHandler("courses", courses))
+    application.add_handler(CommandHandler("course", course))
+    application.add_handler(CommandHandler("create_course", new_course))
+    application.add_handler(CommandHandler("enroll", enroll))
     application.add_handler(CommandHandler("add_grade", add_grade))
     application.add_handler(CommandHandler("upload_grades", upload_grades))
+    application.add_handler(MessageHandler(filters.Document.FileExtension("csv"), upload_grades_document))
+    application.add_handler(CommandHandler("jobs", jobs))
+    application.add_handler(CommandHandler("cancel", cancel))
+    application.add_handler(CommandHandler("export_grades", export_grades_command))
     application.add_handler(CommandHandler("view_all_grades", view_all_grades))
+    application.add_handler(CallbackQueryHandler(view_all_grades_page, pattern="^view_all_grades:"))
     application.add_handler(CommandHandler("view_grades", view_grades))
     application.add_handler(CommandHandler("view_detailed_grades", view_detailed_grades))
     application.add_handler(CommandHandler("grading_logic", grading_logic))
     application.add_handler(CommandHandler("view_grading_logic", view_grading_logic))  # Add this line
     application.add_handler(CommandHandler("reset", reset))
+    application.add_handler(CommandHandler("history", history))
+    application.add_handler(CommandHandler("grades_as_of", grades_as_of))
+    application.add_handler(CommandHandler("stats", stats))
+
+# Function to find the chat an update belongs to; updates of one chat always
+# go to the same worker, so each user's updates are handled in order
+def update_partition_key(data):
+    for field in ("message", "edited_message", "channel_post", "edited_channel_post", "my_chat_member", "chat_member", "chat_join_request"):
+        if field in data:
+            return data[field]["chat"]["id"]
+    if "callback_query" in data:
+        message = data["callback_query"].get("message")
+        return message["chat"]["id"] if message else data["callback_query"]["from"]["id"]
+    for value in data.values():
+        if isinstance(value, dict) and "from" in value:
+            return value["from"]["id"]
+    return 0
+
+# Function to build the receiver's dispatch(): every update goes to the queue
+# of the worker its chat belongs to
+def partitioned_dispatch(queues):
+    def dispatch(data):
+        queues[update_partition_key(data) % len(queues)].put(data)
+    return dispatch
+
+# The chat an update belongs to, or its sender when it has no chat
+def update_chat_id(update):
+    if update.effective_chat:
+        return update.effective_chat.id
+    return update.effective_user.id if update.effective_user else None
+
+# Runs each chat's updates one after another, in the order they were passed in;
+# updates of different chats (and updates without one) run concurrently
+class ChatOrder:
+    def __init__(self):
+        self._last = {}
+
+    async def run(self, chat, coroutine):
+        if chat is None:
+            await coroutine
+            return
+        previous = self._last.get(chat)
+        done = asyncio.get_running_loop().create_future()
+        self._last[chat] = done
+        try:
+            if previous is not None:
+                await asyncio.wait([previous])
+            await coroutine
+        finally:
+            # Never started if we were cancelled while waiting
+            coroutine.close()
+            done.set_result(None)
+            if self._last.get(chat) is done:
+                del self._last[chat]
+
+# Function to build the Application's update processor: at most `limit`
+# updates are handled at once, in order within each chat. The Application
+# starts updates in arrival order and slots are handed out first come first
+# served, so an update always holds its slot before a later update of its
+# chat waits on it.
+def chat_ordered_update_processor(limit=UPDATE_CONCURRENCY):
+    from telegram import Update
+    from telegram.ext import BaseUpdateProcessor
+
+    class ChatOrderedUpdateProcessor(BaseUpdateProcessor):
+        def __init__(self, max_concurrent_updates):
+            super().__init__(max_concurrent_updates)
+            self.chats = ChatOrder()
+
+        async def do_process_update(self, update, coroutine):
+            await self.chats.run(update_chat_id(update) if isinstance(update, Update) else None, coroutine)
+
+        async def initialize(self):
+            pass
+
+        async def shutdown(self):
+            pass
+
+    return ChatOrderedUpdateProcessor(limit)
+
+# Worker process loop: take raw updates from this worker's queue and handle
+# them concurrently across chats, in arrival order within a chat
+async def worker_loop(application, update_queue):
+    from telegram import Update
+    loop = asyncio.get_running_loop()
+    chats = ChatOrder()
+    tasks = set()
+    await application.initialize()
+    await post_init(application)
+    await application.start()
+    try:
+        while True:
+            data = await loop.run_in_executor(None, update_queue.get)
+            if data is None:
+                break
+            task = loop.create_task(chats.run(update_partition_key(data), application.process_update(Update.de_json(data, application.bot))))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+        if tasks:
+            await asyncio.wait(tasks)
+    finally:
+        await application.stop()
+        await post_shutdown(application)
+        await application.shutdown()
+
+def worker_main(index, update_queue, workers, db_file, shard_dir):
+    global DISPATCHER
+    from telegram.ext import Application
+    configure_process(db_file, shard_dir)
+    # The Bot API's global send limit is shared by every worker
+    DISPATCHER = MessageDispatcher(global_rate=SEND_GLOBAL_RATE / workers, background_rate=SEND_BACKGROUND_RATE / workers)
+    start_heavy_executor()
+    if METRICS_PORT is not None:
+        start_metrics_server(port=METRICS_PORT + 1 + index)
+    application = Application.builder().token(BOT_TOKEN).base_url(BOT_API_URL).updater(None).build()
+    register_handlers(application)
+    try:
+        asyncio.run(worker_loop(application, update_queue))
+    finally:
+        stop_heavy_executor()
+        DB_EXECUTOR.shutdown(wait=True)
+        close_pools()
+
+# Long-poll the Bot API and hand every update to `dispatch` as a dict
+async def poll_updates(dispatch):
+    from telegram import Bot, Update
+    from telegram.error import NetworkError, RetryAfter
+    offset = None
+    async with Bot(BOT_TOKEN, base_url=BOT_API_URL) as bot:
+        await bot.delete_webhook()
+        while True:
+            try:
+                updates = await bot.get_updates(offset=offset, timeout=30, allowed_updates=Update.ALL_TYPES)
+            except RetryAfter as e:
+                delay = e.retry_after.total_seconds() if isinstance(e.retry_after, timedelta) else e.retry_after
+                await asyncio.sleep(delay)
+                continue
+            except NetworkError as e:
+                logger.warning(f"Network error polling for updates: {e}")
+                await asyncio.sleep(1)
+                continue
+            for update in updates:
+                dispatch(update.to_dict())
+                offset = update.update_id + 1
+
+async def set_webhook(url, secret):
+    from telegram import Bot, Update
+    async with Bot(BOT_TOKEN, base_url=BOT_API_URL) as bot:
+        await bot.set_webhook(url=url, secret_token=secret, allowed_updates=Update.ALL_TYPES)
+
+# Receives Bot API webhook calls at WEBHOOK_PATH and hands them to the server's
+# dispatch(). Calls without the server's secret token are refused, since an
+# update's sender is whatever the caller claims.
+class WebhookRequestHandler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        if self.path.split("?")[0] != WEBHOOK_PATH:
+            self.send_error(404)
+            return
+        token = self.headers.get("X-Telegram-Bot-Api-Secret-Token", "")
+        if not hmac.compare_digest(token.encode(), self.server.secret.encode()):
+            self.send_error(403)
+            return
+        try:
+            data = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+        except ValueError:
+            self.send_error(400)
+            return
+        self.server.dispatch(data)
+        self.send_response(200)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        pass
+
+# CLI: python Final.py workers [--workers N] [--webhook-url URL]
+def workers_main(argv):
+    import argparse
+    parser = argparse.ArgumentParser(prog="Final.py workers", description="Run the bot as a receiver plus worker processes")
+    parser.add_argument("--workers", type=int, default=WORKER_COUNT)
+    parser.add_argument("--webhook-url", help="public HTTPS URL of this server; long polling is used when omitted")
+    parser.add_argument("--port", type=int, default=WEBHOOK_PORT)
+    args = parser.parse_args(argv)
+
+    # Migrate once, before any worker opens the database
+    init_db()
+    context = multiprocessing.get_context("spawn")
+    queues = [context.Queue(maxsize=WORKER_QUEUE_SIZE) for _ in range(args.workers)]
+    processes = [context.Process(target=worker_main, args=(index, queues[index], args.workers, DB_FILE, SHARD_DIR), name=f"worker-{index}")
+                 for index in range(args.workers)]
+    for process in processes:
+        process.start()
+
+    dispatch = partitioned_dispatch(queues)
+
+    logger.info(f"Started {args.workers} workers")
+    try:
+        if args.webhook_url:
+            secret = WEBHOOK_SECRET or secrets.token_urlsafe(32)
+            asyncio.run(set_webhook(args.webhook_url, secret))
+            server = ThreadingHTTPServer((WEBHOOK_HOST, args.port), WebhookRequestHandler)
+            server.dispatch, server.secret = dispatch, secret
+            logger.info(f"Receiving updates at {args.webhook_url} (port {args.port})")
+            server.serve_forever()
+        else:
+            asyncio.run(poll_updates(dispatch))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for update_queue in queues:
+            update_queue.put(None)
+        for process in processes:
+            process.join()
+
+# Main: Start bot
+def main():
+    # Initialize database
+    init_db()
+
+    # Bot setup
+    from telegram.ext import Application
+    application = (Application.builder().token(BOT_TOKEN).base_url(BOT_API_URL).post_init(post_init).post_shutdown(post_shutdown)
+                   .concurrent_updates(chat_ordered_update_processor()).build())
+    register_handlers(application)
+    start_heavy_executor()
+
+    if METRICS_PORT is not None:
+        start_metrics_server()
 
     # Run bot
-    application.run_polling()
+    try:
+        application.run_polling()
+    finally:
+        logger.info(f"Session cache: {SESSIONS.stats()}")
+        stop_heavy_executor()
+        DB_EXECUTOR.shutdown(wait=True)
+        close_pools()
+
+COMMANDS = {
+    "export": export_main,
+    "workers": workers_main,
+}
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    if sys.argv[1:2] and sys.argv[1] in COMMANDS:
+        COMMANDS[sys.argv[1]](sys.argv[2:])
+    else:
+        main()
\ No newline at end of file
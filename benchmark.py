@@ -0,0 +1,1440 @@
+# Benchmarks for the Gradebook bot
+#
+# Every benchmark runs the real handlers from Final.py against a throwaway
+# database with fake Telegram updates, so it never touches gradebook.db.
+#
+# Usage:
+#   python benchmark.py db [--updates N] [--students N] [--concurrency N] [--latency-ms N]
+#   python benchmark.py import [--rows N] [--legacy-rows N]
+#   python benchmark.py plans
+#   python benchmark.py recompute [--rows N]
+#   python benchmark.py ingest [--grades N] [--teachers N] [--concurrency N]
+#   python benchmark.py export [--rows N]
+#   python benchmark.py cache [--students N]
+#   python benchmark.py state [--users N]
+#   python benchmark.py startup [--runs N] [--target SECONDS]
+#   python benchmark.py jobs [--rows N]
+#   python benchmark.py snapshot [--rows N]
+#   python benchmark.py history [--rows N] [--rounds N]
+#   python benchmark.py notify [--rows N] [--students N] [--backlog N]
+#   python benchmark.py load [--updates N] [--mix cmd=weight,...] [--output FILE] [--baseline FILE]
+#   python benchmark.py workers [--workers 1,2,4] [--updates N]
+import argparse
+import asyncio
+import contextvars
+import multiprocessing
+import csv
+import functools
+import http.client
+import json
+import logging
+import math
+import os
+import queue
+import random
+import secrets
+import signal
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from collections import deque
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from types import SimpleNamespace
+from urllib.parse import parse_qs
+
+import Final
+
+SUBJECTS = ["Math", "Physics", "Chemistry", "Biology", "History"]
+
+
+# Fake Telegram objects
+class FakeMessage:
+    def __init__(self, user_id, text="", latency=0.0):
+        self.from_user = SimpleNamespace(id=user_id)
+        self.chat = SimpleNamespace(id=user_id)
+        self.chat_id = user_id
+        self.text = text
+        self.latency = latency
+        self.reply_to_message = None
+        self.replies = []
+
+    async def reply_text(self, text, **kwargs):
+        # Simulate the round trip to the Bot API
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        self.replies.append(text)
+
+
+class FakeBot:
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.sent = []
+
+    async def send_message(self, chat_id, text, reply_markup=None, **kwargs):
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        self.sent.append((chat_id, text))
+
+    async def send_document(self, chat_id, document, filename=None, **kwargs):
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        self.sent.append((chat_id, filename))
+
+
+def make_update(user_id, text="", latency=0.0):
+    message = FakeMessage(user_id, text, latency)
+    return SimpleNamespace(message=message, effective_user=message.from_user, effective_chat=message.chat, callback_query=None)
+
+
+def make_context(args=()):
+    return SimpleNamespace(args=list(args), user_data={}, chat_data={}, bot=None)
+
+
+# Use a throwaway database so benchmarks never touch gradebook.db
+@contextmanager
+def temp_database():
+    tmp = tempfile.TemporaryDirectory()
+    old_db_file, old_shard_dir = Final.DB_FILE, Final.SHARD_DIR
+    Final.close_pools()
+    Final.DB_FILE = os.path.join(tmp.name, "benchmark.db")
+    Final.SHARD_DIR = os.path.join(tmp.name, "shards")
+    try:
+        Final.init_db()
+        yield Final.DB_FILE
+    finally:
+        Final.SESSIONS.clear()
+        Final.ENROLLMENTS.clear()
+        Final.RESPONSES = Final.ResponseCache()
+        Final.STATE = Final.StateStore()
+        Final.JOBS = Final.JobRunner()
+        Final.SNAPSHOTS = Final.SnapshotStore()
+        Final.NOTIFIER = Final.GradeNotifier()
+        Final.close_pools()
+        Final.DB_FILE, Final.SHARD_DIR = old_db_file, old_shard_dir
+        tmp.cleanup()
+
+
+def seed_grades(students, subjects=SUBJECTS):
+    rows = [
+        (str(student), subject, 80.0, 75.0, 70.0, 85.0, 100.0, 80.0)
+        for student in range(1, students + 1)
+        for subject in subjects
+    ]
+    with sqlite3.connect(Final.DB_FILE) as conn:
+        conn.executemany("INSERT OR REPLACE INTO detailed_grades (student_id, subject, homework, quizzes, midterm, final, attendance, overall) VALUES (?, ?, ?, ?, ?, ?, ?, ?)", rows)
+    return len(rows)
+
+
+def log_in_students(students):
+    Final.enroll_students(Final.DEFAULT_COURSE, [str(student) for student in range(1, students + 1)])
+    for student in range(1, students + 1):
+        Final.add_user(str(student), str(student), "student")
+
+
+# Replace the bot-wide dispatcher with one that sends to a FakeBot without
+# Telegram's rate limits, so benchmarks measure the bot rather than the limiter
+def fake_dispatcher(latency=0.0):
+    Final.DISPATCHER = Final.MessageDispatcher(global_rate=1e9, chat_rate=1e9, chat_burst=1e9, concurrency=1000, background_rate=1e9)
+    return FakeBot(latency)
+
+
+# A Bot API request backend for in-process Applications: answers getMe, and
+# every send after `latency` seconds, without a network or an HTTP server
+# competing with the bot for the CPU
+def local_bot_api(latency=0.0):
+    from telegram.request import BaseRequest
+
+    class LocalBotAPI(BaseRequest):
+        async def initialize(self):
+            pass
+
+        async def shutdown(self):
+            pass
+
+        async def do_request(self, url, method, request_data=None, read_timeout=None, write_timeout=None,
+                             connect_timeout=None, pool_timeout=None):
+            api_method = url.rsplit("/", 1)[-1]
+            if api_method == "getMe":
+                result = BOT_USER
+            elif api_method.startswith(("send", "edit")):
+                await asyncio.sleep(latency)
+                chat_id = int(request_data.parameters.get("chat_id", 0))
+                result = {"message_id": 2, "date": int(time.time()), "chat": {"id": chat_id, "type": "private"}, "from": BOT_USER, "text": ""}
+            else:
+                result = True
+            return 200, json.dumps({"ok": True, "result": result}).encode()
+
+    return LocalBotAPI()
+
+
+# True while an update's handlers run, so counters can leave out the
+# Application's background work (job runner, state flushes)
+HANDLING_UPDATE = contextvars.ContextVar("handling_update", default=False)
+
+
+# Run raw updates through an Application built as Final.main() builds it, with
+# Final's handlers (or `handlers`) and `concurrency` updates in flight, against
+# local_bot_api(latency). Returns the seconds from the first update until every
+# one was handled and every reply sent, and each update's handler time by
+# update_id.
+async def run_application(updates, concurrency, handlers=None, latency=0.0):
+    from telegram import Update
+    from telegram.ext import Application, TypeHandler
+    application = (Application.builder().token(Final.BOT_TOKEN).request(local_bot_api(latency)).updater(None)
+                   .concurrent_updates(Final.chat_ordered_update_processor(concurrency)).build())
+    started, handled = {}, {}
+
+    async def start_clock(update, context):
+        HANDLING_UPDATE.set(True)
+        started[update.update_id] = time.perf_counter()
+
+    async def stop_clock(update, context):
+        handled[update.update_id] = time.perf_counter() - started[update.update_id]
+
+    application.add_handler(TypeHandler(Update, start_clock), group=-1)
+    if handlers is None:
+        Final.register_handlers(application)
+    else:
+        application.add_handlers(handlers)
+    application.add_handler(TypeHandler(Update, stop_clock), group=1)
+
+    await application.initialize()
+    updates = [Update.de_json(data, application.bot) for data in updates]
+    await Final.post_init(application)
+    await application.start()
+    start = time.perf_counter()
+    for update in updates:
+        application.update_queue.put_nowait(update)
+    await application.update_queue.join()
+    await application.stop()
+    # Flushes buffered grade writes and delivers every queued reply
+    await Final.post_shutdown(application)
+    elapsed = time.perf_counter() - start
+    await application.shutdown()
+    return elapsed, handled
+
+
+def report(name, count, elapsed, unit="msgs/sec"):
+    print(f"{name:<28} {count:>8} in {elapsed:8.3f}s  {count / elapsed:10.1f} {unit}")
+
+
+# db: per-call connections on the event loop vs the pooled executor, both
+# through the Application with --concurrency updates in flight and
+# --latency-ms per Bot API send, plus the pooled handlers one update at a time
+async def legacy_view_detailed_grades(update, context):
+    user_id = str(update.message.from_user.id)
+    conn = sqlite3.connect(Final.DB_FILE)
+    try:
+        college_id, role = conn.execute("SELECT college_id, role FROM users WHERE id = ?", (user_id,)).fetchone()
+        grades = conn.execute("SELECT subject, homework, quizzes, midterm, final, attendance, overall FROM detailed_grades WHERE student_id = ?", (college_id,)).fetchall()
+    finally:
+        conn.close()
+    grade_list = "\n".join(f"Subject: {row[0]}, Overall: {row[6]}" for row in grades)
+    await update.message.reply_text(f"Your detailed grades:\n{grade_list}")
+
+
+def bench_db(args):
+    from telegram.ext import CommandHandler
+    with temp_database():
+        seed_grades(args.students)
+        log_in_students(args.students)
+        updates = [command_update(i + 1, i % args.students + 1, "/view_detailed_grades") for i in range(args.updates)]
+        latency = args.latency_ms / 1000
+
+        legacy, _ = asyncio.run(run_application(updates, args.concurrency,
+                                                [CommandHandler("view_detailed_grades", legacy_view_detailed_grades)], latency))
+        fake_dispatcher()
+        serial, _ = asyncio.run(run_application(updates, 1, latency=latency))
+        fake_dispatcher()
+        pooled, _ = asyncio.run(run_application(updates, args.concurrency, latency=latency))
+        report("per-call connection", args.updates, legacy)
+        report("pooled, one update at a time", args.updates, serial)
+        report("pooled + executor", args.updates, pooled)
+        print(f"speedup: {legacy / pooled:.2f}x")
+        print(f"session cache: {Final.SESSIONS.stats()}")
+
+
+# import: streaming bulk import vs one add_detailed_grade_to_db call per row
+def write_grades_csv(path, rows, students=1000):
+    with open(path, "w", newline="") as csvfile:
+        writer = csv.writer(csvfile)
+        writer.writerow(["student_id", "subject", "homework", "quizzes", "midterm", "final", "attendance", "overall"])
+        for i in range(rows):
+            writer.writerow([str(i % students + 1), f"{SUBJECTS[i % len(SUBJECTS)]}-{i // students}", 80, 75.5, 70, 85, 100, 80.5])
+
+
+def bench_import(args):
+    with temp_database() as db_file:
+        csv_path = os.path.join(os.path.dirname(db_file), "grades.csv")
+
+        write_grades_csv(csv_path, args.legacy_rows)
+        start = time.perf_counter()
+        with open(csv_path, newline="") as csvfile:
+            reader = csv.reader(csvfile)
+            next(reader)
+            for row in reader:
+                Final.add_detailed_grade_to_db(row[0], row[1], *map(float, row[2:]))
+        report("per-row import", args.legacy_rows, time.perf_counter() - start, "rows/sec")
+
+        write_grades_csv(csv_path, args.rows)
+        result = Final.import_grades_file(csv_path)
+        report("bulk import", result.rows_read, result.elapsed, "rows/sec")
+        if result.errors:
+            print(f"{len(result.errors)} rows rejected")
+
+
+# ingest: /add_grade from --teachers chats through the Application, each chat's
+# updates in order, with a commit per grade vs the write-behind buffer
+async def legacy_add_grade(update, context):
+    student_id, subject, *components = context.args
+    components = [float(value) for value in components]
+    overall = Final.compute_overall(INGEST_WEIGHTS, components)
+    if not await Final.run_db(Final.load_enrollment, (Final.DEFAULT_COURSE, student_id)):
+        return
+    await Final.run_db(legacy_write, (student_id, subject, *components, overall))
+    Final.reply(update, f"Grades added: {student_id}, {subject} - Overall: {overall}")
+
+
+# One transaction per grade, with the same durability as a buffered flush
+def legacy_write(row):
+    with Final.course_connection(Final.DEFAULT_COURSE) as conn:
+        conn.execute(f"PRAGMA synchronous={Final.GRADE_FLUSH_SYNCHRONOUS}")
+        try:
+            with conn:
+                Final.upsert_detailed_grades(conn, [row])
+        finally:
+            conn.execute("PRAGMA synchronous=NORMAL")
+
+
+INGEST_WEIGHTS = {"homework": 20, "quizzes": 10, "midterm": 25, "final": 35, "attendance": 10}
+
+
+def bench_ingest(args):
+    from telegram.ext import CommandHandler
+    # Measure the writes, not the messages telling students their grades changed
+    Final.NOTIFY_STUDENTS = False
+    with temp_database():
+        students = max(1, args.grades // len(SUBJECTS))
+        log_in_students(students)
+        for teacher in range(1, args.teachers + 1):
+            Final.add_user(str(TEACHER_CHAT_BASE + teacher), "123", "teacher")
+        Final.define_grading_weights(INGEST_WEIGHTS)
+
+        def updates(round_):
+            return [
+                command_update(i + 1, TEACHER_CHAT_BASE + i % args.teachers + 1,
+                               f"/add_grade {i // len(SUBJECTS) + 1} {SUBJECTS[i % len(SUBJECTS)]} {80 + round_} 75 70 85 100")
+                for i in range(args.grades)
+            ]
+
+        fake_dispatcher()
+        legacy, _ = asyncio.run(run_application(updates(0), args.concurrency, [CommandHandler("add_grade", legacy_add_grade)]))
+        fake_dispatcher()
+        buffered, _ = asyncio.run(run_application(updates(1), args.concurrency))
+        report("commit per grade", args.grades, legacy, "grades/sec")
+        report("write-behind buffer", args.grades, buffered, "grades/sec")
+        print(f"speedup: {legacy / buffered:.2f}x")
+        stats = Final.GRADE_WRITES.stats()
+        print(f"flushes: {stats['flushes']}, mean batch {stats['written'] / max(1, stats['flushes']):.1f}, max batch {stats['max_batch']}, "
+              f"max flush {stats['max_flush_seconds'] * 1000:.1f} ms, failed {stats['failed']}")
+
+
+# plans: every handler query must be answered through an index.
+# Exits non-zero when a plan falls back to a table scan or a temp sort.
+def handler_queries():
+    page = Final.detailed_grades_page_query
+    return [
+        ("authorize", Final.SELECT_SESSION_SQL, ("1",)),
+        ("bot state", Final.SELECT_STATE_SQL, ("conversation", "1")),
+        ("course routing", Final.SELECT_COURSE_FILE_SQL, ("default",)),
+        ("courses: teacher", Final.SELECT_TEACHER_COURSES_SQL, ("123",)),
+        ("courses: student", Final.SELECT_STUDENT_COURSES_SQL, ("1",)),
+        ("add_grade: student lookup", Final.STUDENT_EXISTS_SQL, ("default", "1")),
+        ("view_grades", Final.SELECT_OVERALL_GRADES_SQL, ("1",)),
+        ("view_detailed_grades", Final.SELECT_DETAILED_GRADES_SQL, ("1",)),
+        ("view_all_grades: first page", *page()),
+        ("view_all_grades: next page", *page(after=("1", "Math"))),
+        ("view_all_grades: prev page", *page(before=("1", "Math"))),
+        ("view_all_grades: subject", *page(subject="Math")),
+        ("view_all_grades: subject next", *page(after=("1", "Math"), subject="Math")),
+        ("view_all_grades: student", *page(student_id="1")),
+        ("stats: ranking", Final.SELECT_SUBJECT_RANKING_SQL, ("Math", 5)),
+        ("export_grades", Final.SELECT_EXPORT_SQL, ()),
+        ("snapshot: changes", Final.SELECT_GRADE_CHANGES_SQL, (0, 10001)),
+        ("history: student subject", Final.SELECT_KEY_HISTORY_SQL, (0, 10, "1", "Math", 15)),
+        ("history: key checkpoints", Final.SELECT_KEY_CHECKPOINTS_SQL, ("1", "Math")),
+        ("history: previous checkpoint", Final.SELECT_PREVIOUS_CHECKPOINT_SQL, (2,)),
+        ("history: changeset", Final.SELECT_CHANGESET_SQL, (10,)),
+        ("history: course events", Final.SELECT_COURSE_EVENTS_SQL, (0, 15)),
+        ("as of: checkpoint", Final.SELECT_CHECKPOINT_AS_OF_SQL, (0,)),
+        ("as of: checkpoint rows", Final.SELECT_CHECKPOINT_ROWS_SQL, (1,)),
+        ("as of: student checkpoint", Final.SELECT_STUDENT_CHECKPOINT_ROWS_SQL, (1, "1")),
+        ("as of: cut", Final.SELECT_HISTORY_CUT_SQL, (0,)),
+        ("as of: changes", Final.SELECT_HISTORY_SINCE_SQL, (0, 10)),
+        ("as of: student changes", Final.SELECT_STUDENT_HISTORY_SINCE_SQL, (0, 10, "1")),
+        ("as of: last event", Final.SELECT_LAST_EVENT_SINCE_SQL, (0, 0)),
+        ("as of: checkpoint after event", Final.SELECT_CHECKPOINT_AFTER_SQL, (0,)),
+        ("as of: undo", Final.SELECT_HISTORY_UNDO_SQL, (0, 10)),
+        ("history: last checkpoint", Final.SELECT_LAST_CHECKPOINT_SQL, ()),
+        ("history: keys since checkpoint", Final.INSERT_HISTORY_KEYS_SQL, (1, 0, 10)),
+        ("history: event since checkpoint", Final.SELECT_EVENT_AFTER_SQL, (0,)),
+        ("jobs: list", Final.SELECT_JOBS_SQL, ("123", 10)),
+        ("jobs: claim", Final.CLAIM_JOB_SQL, {"now": 0, "owner": "host:1", "lease": 60}),
+        ("jobs: requeue expired", Final.REQUEUE_EXPIRED_JOBS_SQL, (0,)),
+        ("jobs: running", Final.SELECT_RUNNING_JOBS_SQL, ()),
+        ("jobs: requeue one", Final.REQUEUE_JOB_SQL, (1, "host:1")),
+        ("jobs: heartbeat", Final.HEARTBEAT_JOB_SQL, {"now": 0, "lease": 60, "job_id": 1, "owner": "host:1"}),
+        ("notify: changed students", Final.SELECT_CHANGED_STUDENTS_SQL, (0, 1000)),
+        ("notify: chats", Final.SELECT_NOTIFY_CHATS_SQL.format("?, ?"), ("1", "2")),
+        ("notify: last notified", Final.SELECT_LAST_NOTIFIED_SQL.format("?, ?"), ("default", "1", "2")),
+        ("upsert: previous rows", Final.SELECT_KEYS_DETAILED_GRADES_SQL.format("(?, ?), (?, ?)"), ("1", "Math", "2", "Math")),
+    ]
+
+
+def plan_problems(plan):
+    # Scans of a query's own VALUES list (and the subquery it is materialized
+    # as) read the parameters, not a table
+    materialized = {row[-1].split(" ", 1)[1] for row in plan if row[-1].startswith("MATERIALIZE ")}
+    problems = []
+    for row in plan:
+        detail = row[-1]
+        if detail.endswith("CONSTANT ROWS") or detail.removeprefix("SCAN ") in materialized:
+            continue
+        if (detail.startswith("SCAN") and "INDEX" not in detail) or "TEMP B-TREE" in detail:
+            problems.append(detail)
+    return problems
+
+
+# Fill a temp_database() with enough grades, users and history for the planner
+# to choose as it would in use
+def seed_plan_database(db_file):
+    seed_grades(200)
+    for student in range(1, 201):
+        Final.add_user(str(student), str(student), "student")
+    with Final.course_connection(Final.DEFAULT_COURSE) as conn, conn:
+        # Rewrite the grades so grade_history and the checkpoints are as large as in use
+        for round_ in range(3):
+            rows = conn.execute(Final.SELECT_EXPORT_SQL).fetchall()
+            Final.upsert_detailed_grades(conn, [(*row[:2], row[2] + round_ + 1, *row[3:]) for row in rows])
+            Final.take_history_checkpoint(conn)
+    with sqlite3.connect(db_file) as conn:
+        conn.execute("ANALYZE")
+
+
+def bench_plans(args):
+    failures = 0
+    with temp_database() as db_file:
+        seed_plan_database(db_file)
+        with sqlite3.connect(db_file) as conn:
+            for name, sql, params in handler_queries():
+                plan = conn.execute(f"EXPLAIN QUERY PLAN {sql}", params).fetchall()
+                problems = plan_problems(plan)
+                failures += bool(problems)
+                print(f"{'FAIL' if problems else 'ok':<5}{name:<32} {' | '.join(row[-1] for row in plan)}")
+    if failures:
+        sys.exit(f"{failures} handler queries are not index-backed")
+
+
+# notify: students told about an import, once each, and how a fan-out under
+# Telegram's rate limits delays replies with and without the background queue
+class TimedBot(FakeBot):
+    async def send_message(self, chat_id, text, reply_markup=None, **kwargs):
+        self.sent.append((chat_id, text, time.perf_counter()))
+
+
+def notified_chats(bot):
+    counts = {}
+    for chat_id, text, *_ in bot.sent:
+        if "were updated" in text:
+            counts[chat_id] = counts.get(chat_id, 0) + 1
+    return counts
+
+
+async def wait_for_job(done=1):
+    while Final.JOBS.stats()["done"] + Final.JOBS.stats()["failed"] < done:
+        await asyncio.sleep(0.01)
+
+
+# Replies to other chats every `interval` seconds while `backlog` notifications
+# wait; returns each reply's enqueue-to-send latency
+async def reply_latencies(backlog, background, replies=20, interval=0.25):
+    bot = TimedBot()
+    Final.DISPATCHER = Final.MessageDispatcher()
+    Final.DISPATCHER.start(bot)
+    for chat_id in range(1, backlog + 1):
+        if background:
+            Final.DISPATCHER.enqueue_background(chat_id, "Your grades were updated.")
+        else:
+            Final.DISPATCHER.enqueue(chat_id, "Your grades were updated.")
+    enqueued = {}
+    for i in range(replies):
+        chat_id = -(i + 1)
+        enqueued[chat_id] = time.perf_counter()
+        Final.DISPATCHER.enqueue(chat_id, "reply")
+        await asyncio.sleep(interval)
+    while len([sent for sent in bot.sent if sent[0] < 0]) < replies:
+        await asyncio.sleep(0.01)
+    await Final.DISPATCHER.stop(timeout=0)
+    return [sent_at - enqueued[chat_id] for chat_id, _, sent_at in bot.sent if chat_id < 0]
+
+
+def bench_notify(args):
+    with temp_database() as db_file:
+        csv_path = os.path.join(os.path.dirname(db_file), "grades.csv")
+        write_grades_csv(csv_path, args.rows, students=args.students)
+        with sqlite3.connect(db_file) as conn:
+            # Chats apart from the college IDs, clear of the seeded users
+            conn.executemany("INSERT INTO users (id, college_id, role, logged_in) VALUES (?, ?, 'student', 1)",
+                             [(str(1000000 + student), str(student)) for student in range(1, args.students + 1)])
+        Final.add_user("123", "123", "teacher")
+
+        async def fan_out():
+            bot = fake_dispatcher()
+            Final.NOTIFIER = Final.GradeNotifier(interval=0.05)
+            Final.DISPATCHER.start(bot)
+            Final.JOBS.start()
+            Final.NOTIFIER.start()
+            await Final.upload_grades(make_update("123"), make_context([csv_path]))
+            await wait_for_job()
+            start = time.perf_counter()
+            while Final.NOTIFIER.stats()["notified"] + Final.NOTIFIER.stats()["skipped"] < args.students or Final.DISPATCHER.depth:
+                await asyncio.sleep(0.005)
+            await Final.DISPATCHER.stop(timeout=60)
+            elapsed = time.perf_counter() - start
+            first = notified_chats(bot)
+
+            # The same students again, inside the window: nothing is sent until it is over
+            write_grades_csv(csv_path, args.rows, students=args.students)
+            with open(csv_path, "a", newline="") as csvfile:
+                csv.writer(csvfile).writerows([[student, "Extra", 90, 90, 90, 90, 90, 90] for student in range(1, args.students + 1)])
+            Final.DISPATCHER.start(bot)
+            await Final.upload_grades(make_update("123"), make_context([csv_path]))
+            await wait_for_job(2)
+            await asyncio.sleep(0.2)
+            await Final.JOBS.stop()
+            await Final.NOTIFIER.stop()
+            await Final.DISPATCHER.stop(timeout=60)
+            return elapsed, first, notified_chats(bot), Final.NOTIFIER.stats()
+
+        elapsed, first, both, stats = asyncio.run(fan_out())
+        report("fan-out after import", len(first), elapsed)
+        print(f"{args.rows} rows over {args.students} students: {len(first)} students notified, at most {max(first.values(), default=0)} message each")
+        print(f"second import inside the window: {sum(both.values()) - sum(first.values())} more messages, {stats['pending']} deferred")
+        if len(first) != args.students or set(first.values()) != {1} or both != first or stats["pending"] != args.students:
+            sys.exit("notifications were not sent exactly once per student")
+
+    async def both_modes():
+        return await reply_latencies(args.backlog, background=False), await reply_latencies(args.backlog, background=True)
+
+    ordinary, background = asyncio.run(both_modes())
+    print(f"{'reply latency, ' + str(args.backlog) + ' queued':<28} {'p50 ms':>8} {'p95 ms':>8} {'max ms':>8}")
+    for label, values in (("same queue", ordinary), ("background queue", background)):
+        print(f"{label:<28} {percentile(values, 50) * 1000:8.2f} {percentile(values, 95) * 1000:8.2f} {max(values) * 1000:8.2f}")
+
+    dispatcher = Final.MessageDispatcher()
+    start = time.perf_counter()
+    for chat_id in range(1, 100001):
+        dispatcher.enqueue_background(chat_id, "Your grades were updated.")
+    report("enqueue 100k background", 100000, time.perf_counter() - start)
+
+
+# recompute: one set-based UPDATE vs computing overall row by row in Python
+def bench_recompute(args):
+    weights = {"homework": 20, "quizzes": 10, "midterm": 25, "final": 35, "attendance": 10}
+    with temp_database() as db_file:
+        seed_grades(args.rows // len(SUBJECTS))
+        rows = args.rows // len(SUBJECTS) * len(SUBJECTS)
+
+        with sqlite3.connect(db_file) as conn:
+            start = time.perf_counter()
+            current = conn.execute("SELECT student_id, subject, homework, quizzes, midterm, final, attendance FROM detailed_grades").fetchall()
+            conn.executemany("UPDATE detailed_grades SET overall = ? WHERE student_id = ? AND subject = ?",
+                             [(Final.compute_overall(weights, row[2:]), row[0], row[1]) for row in current])
+            conn.commit()
+            report("row-by-row recompute", rows, time.perf_counter() - start, "rows/sec")
+
+        start = time.perf_counter()
+        version, updated = Final.define_grading_weights(weights)
+        report("batched recompute", updated, time.perf_counter() - start, "rows/sec")
+
+
+# export: streaming dump throughput, peak Python memory, and how a writer
+# running alongside the dump is affected
+def bench_export(args):
+    with temp_database() as db_file:
+        rows = seed_grades(args.rows // len(SUBJECTS))
+        for fmt in Final.EXPORT_FORMATS:
+            path = os.path.join(os.path.dirname(db_file), f"export.{fmt}")
+            start = time.perf_counter()
+            with open(path, "wb") as output:
+                exported = Final.export_grades(output, fmt)
+            report(f"export {fmt}", exported, time.perf_counter() - start, "rows/sec")
+            if exported != rows:
+                sys.exit(f"export {fmt} wrote {exported} rows, expected {rows}")
+            if fmt == "columnar":
+                with open(path, "rb") as exported_file:
+                    if sum(1 for _ in Final.read_grades_columnar(exported_file)) != rows:
+                        sys.exit("columnar export does not read back")
+
+            # Second pass under tracemalloc, with a writer committing grades throughout
+            writes, worst = [0], [0.0]
+            stop = threading.Event()
+
+            def writer():
+                while not stop.is_set():
+                    start = time.perf_counter()
+                    Final.add_detailed_grade_to_db("1", "Math", 90.0, 90.0, 90.0, 90.0, 90.0, float(writes[0] % 100))
+                    worst[0] = max(worst[0], time.perf_counter() - start)
+                    writes[0] += 1
+
+            thread = threading.Thread(target=writer)
+            tracemalloc.start()
+            thread.start()
+            with open(path, "wb") as output:
+                Final.export_grades(output, fmt)
+            stop.set()
+            thread.join()
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            print(f"  {os.path.getsize(path) / 1024 / 1024:.1f} MB, peak Python memory {peak / 1024 / 1024:.1f} MB, "
+                  f"{writes[0]} concurrent writes committed (slowest {worst[0] * 1000:.1f} ms)")
+
+
+# cache: student views cold vs warm, counting every trip to the DB executor
+def bench_cache(args):
+    with temp_database():
+        seed_grades(args.students)
+        log_in_students(args.students)
+        Final.define_grading_weights({"homework": 20, "quizzes": 10, "midterm": 25, "final": 35, "attendance": 10})
+
+        calls = [0]
+        run_db = Final.run_db
+
+        async def counting_run_db(func, *func_args, **kwargs):
+            calls[0] += HANDLING_UPDATE.get()
+            return await run_db(func, *func_args, **kwargs)
+
+        Final.run_db = counting_run_db
+        try:
+            for command in ("view_grades", "view_detailed_grades", "view_grading_logic"):
+                for label in ("cold", "warm"):
+                    calls[0] = 0
+                    updates = [command_update(i + 1, i + 1, f"/{command}") for i in range(args.students)]
+                    fake_dispatcher()
+                    elapsed, _ = asyncio.run(run_application(updates, args.concurrency))
+                    report(f"{command} {label}", args.students, elapsed)
+                    print(f"  {calls[0]} database calls")
+
+            # A write must be visible on the very next view
+            Final.add_detailed_grade_to_db("1", "Math", 1.0, 1.0, 1.0, 1.0, 1.0, 12.34)
+            bot = fake_dispatcher()
+
+            async def view():
+                Final.DISPATCHER.start(bot)
+                await Final.view_detailed_grades(make_update("1"), make_context())
+                await Final.DISPATCHER.stop(timeout=5)
+
+            asyncio.run(view())
+            if "12.34" not in bot.sent[-1][1]:
+                sys.exit("view_detailed_grades served a stale response after a write")
+        finally:
+            Final.run_db = run_db
+        print(f"response cache: {Final.RESPONSES.stats()}")
+
+
+# snapshot: memory of the columnar snapshot vs fetchall() tuples, reads
+# served from it vs SQLite, and identical answers before and after writes
+def snapshot_mismatches(snapshot, students):
+    mismatches = 0
+    for student in students:
+        mismatches += snapshot.overall_grades(student) != Final.get_overall_grades_for_student(student)
+        mismatches += snapshot.detailed_grades(student) != Final.get_detailed_grades_for_student(student)
+    for filters in ({}, {"subject": "Math"}, {"student_id": students[0]}, {"subject": "Math", "student_id": students[0]}, {"subject": "Nope"}):
+        for cursor in ({}, {"after": (students[0], "Math")}, {"before": (students[-1], "Physics")}, {"after": (students[-1], "~")}):
+            mismatches += snapshot.page(**cursor, **filters) != Final.get_detailed_grades_page(**cursor, **filters)
+    return mismatches
+
+
+def bench_snapshot(args):
+    with temp_database() as db_file:
+        students = args.rows // len(SUBJECTS)
+        with sqlite3.connect(db_file) as conn:
+            conn.executemany(
+                "INSERT INTO detailed_grades (student_id, subject, homework, quizzes, midterm, final, attendance, overall) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                ((str(i // len(SUBJECTS) + 1), SUBJECTS[i % len(SUBJECTS)], i % 100, i % 97 + 0.5, i % 89, i % 83, 100.0, None if i % 50 == 0 else i % 79 + 0.25)
+                 for i in range(students * len(SUBJECTS))))
+        rows = students * len(SUBJECTS)
+
+        tracemalloc.start()
+        with Final.course_connection(Final.DEFAULT_COURSE) as conn:
+            fetched = conn.execute(Final.SELECT_EXPORT_SQL).fetchall()
+        tuples = tracemalloc.get_traced_memory()[0]
+        del fetched
+        tracemalloc.stop()
+        tracemalloc.start()
+        snapshot = Final.GradeSnapshot.load(Final.DEFAULT_COURSE)
+        columnar = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        start = time.perf_counter()
+        snapshot = Final.GradeSnapshot.load(Final.DEFAULT_COURSE)
+        elapsed = time.perf_counter() - start
+        per = 100000 / rows / 1024 / 1024
+        print(f"fetchall() tuples:  {tuples * per:8.1f} MB per 100k rows")
+        print(f"columnar snapshot:  {columnar * per:8.1f} MB per 100k rows ({snapshot.nbytes() * per:.1f} MB by nbytes(), built in {elapsed:.2f}s)")
+
+        sample = [str(student) for student in random.Random(1).sample(range(1, students + 1), min(200, students))]
+        sample.sort()
+        if snapshot_mismatches(snapshot, sample):
+            sys.exit("snapshot answers differ from SQLite")
+
+        for label, read in (("sqlite", Final.get_detailed_grades_for_student), ("snapshot", snapshot.detailed_grades)):
+            start = time.perf_counter()
+            for _ in range(10):
+                for student in sample:
+                    read(student)
+            report(f"detailed read {label}", 10 * len(sample), time.perf_counter() - start, "reads/sec")
+        for label, page in (("sqlite", Final.get_detailed_grades_page), ("snapshot", snapshot.page)):
+            start = time.perf_counter()
+            for student in sample:
+                page(after=(student, ""), subject="Math")
+            report(f"view_all_grades page {label}", len(sample), time.perf_counter() - start, "pages/sec")
+
+        async def refreshed():
+            return await Final.SNAPSHOTS.get(Final.DEFAULT_COURSE)
+
+        seed_students = min(students, 2000)
+        log_in_students(seed_students)
+        asyncio.run(refreshed())
+        for serving in (False, True):
+            Final.SNAPSHOT_SERVING = serving
+            for command in ("view_grades", "view_detailed_grades"):
+                Final.RESPONSES = Final.ResponseCache()
+                updates = [command_update(i + 1, i + 1, f"/{command}") for i in range(seed_students)]
+                fake_dispatcher()
+                elapsed, _ = asyncio.run(run_application(updates, 100))
+                report(f"{command} {'snapshot' if serving else 'sqlite'}", seed_students, elapsed)
+        Final.SNAPSHOT_SERVING = False
+
+        # Writes, then an incremental refresh must match SQLite again
+        asyncio.run(refreshed())
+        Final.add_detailed_grade_to_db(sample[0], "Math", 1.0, 2.0, 3.0, 4.0, 5.0, 6.0)
+        Final.add_detailed_grade_to_db(sample[0], "Art", 1.0, 2.0, 3.0, 4.0, None, 7.0)
+        Final.add_detailed_grade_to_db("0", "Zoology", 1.0, 2.0, 3.0, 4.0, 5.0, 6.0)
+        start = time.perf_counter()
+        snapshot = asyncio.run(refreshed())
+        print(f"incremental refresh of 3 changes: {(time.perf_counter() - start) * 1000:.2f} ms, {Final.SNAPSHOTS.stats()}")
+        if snapshot_mismatches(snapshot, ["0", *sample]):
+            sys.exit("snapshot answers differ from SQLite after an incremental refresh")
+        Final.define_grading_weights(INGEST_WEIGHTS)
+        snapshot = asyncio.run(refreshed())
+        if snapshot_mismatches(snapshot, sample):
+            sys.exit("snapshot answers differ from SQLite after recomputing overall grades")
+        print(f"after recompute: {Final.SNAPSHOTS.stats()}")
+
+
+# history: what the audit log costs a bulk import, and point-in-time queries
+# answered from a checkpoint plus the changes after it
+def current_grades():
+    with Final.course_connection(Final.DEFAULT_COURSE) as conn:
+        return conn.execute(Final.SELECT_EXPORT_SQL).fetchall()
+
+
+def bench_history(args):
+    with temp_database() as db_file:
+        csv_path = os.path.join(os.path.dirname(db_file), "grades.csv")
+        write_grades_csv(csv_path, args.rows)
+
+        # The checkpoint after an import runs once it has committed, so it is timed on its own
+        log, due, checkpoint = Final.log_grade_history, Final.checkpoint_history_if_due, Final.checkpoint_course_history
+        checkpoint_times = []
+
+        def timed_checkpoint(course_id):
+            start = time.perf_counter()
+            checkpoint(course_id)
+            checkpoint_times.append(time.perf_counter() - start)
+
+        best = {}
+        for _ in range(3):
+            for label in ("without history", "with history"):
+                if label == "without history":
+                    Final.log_grade_history = Final.checkpoint_history_if_due = lambda *a, **k: None
+                Final.checkpoint_course_history = timed_checkpoint
+                try:
+                    Final.reset_gradebook()
+                    result = Final.import_grades_file(csv_path)
+                finally:
+                    Final.log_grade_history, Final.checkpoint_history_if_due, Final.checkpoint_course_history = log, due, checkpoint
+                best[label] = min(best.get(label, math.inf), result.elapsed)
+                if label == "with history":
+                    best["checkpoint"] = min(best.get("checkpoint", math.inf), checkpoint_times[-1])
+        report("import without history", args.rows, best["without history"], "rows/sec")
+        report("import with history", args.rows, best["with history"], "rows/sec")
+        report("checkpoint after import", args.rows, best["checkpoint"], "rows/sec")
+        print(f"history overhead on import: {(best['with history'] / best['without history'] - 1) * 100:.0f}%")
+
+        # Rounds of changes to a random tenth of the grades, remembering what the course looked like before each
+        marks = []
+        rng = random.Random(1)
+        for round_ in range(args.rounds):
+            time.sleep(0.01)
+            marks.append((time.time(), current_grades()))
+            time.sleep(0.01)
+            rows = [(row[0], row[1], *(rng.uniform(0, 100) for _ in range(6))) for row in rng.sample(marks[-1][1], args.rows // 10)]
+            with Final.course_connection(Final.DEFAULT_COURSE) as conn, conn:
+                Final.upsert_detailed_grades(conn, rows, "bench", f"round {round_}")
+                Final.checkpoint_history_if_due(conn)
+        with Final.course_connection(Final.DEFAULT_COURSE) as conn:
+            entries, checkpoints = (conn.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0] for table in ("grade_history", "grade_checkpoints"))
+        print(f"{entries} history entries, {checkpoints} checkpoints")
+
+        start = time.perf_counter()
+        for as_of, expected in marks:
+            if Final.get_grades_as_of(as_of) != expected:
+                sys.exit("grades as of an earlier time do not match")
+        report("course as of", len(marks), time.perf_counter() - start, "queries/sec")
+
+        students = [str(student) for student in rng.sample(range(1, 1001), 100)]
+        start = time.perf_counter()
+        for as_of, expected in marks:
+            for student in students:
+                if Final.get_grades_as_of(as_of, student) != [row for row in expected if row[0] == student]:
+                    sys.exit(f"grades of {student} as of an earlier time do not match")
+        report("student as of", len(marks) * len(students), time.perf_counter() - start, "queries/sec")
+
+        start = time.perf_counter()
+        for student in students:
+            Final.get_grade_history(student, "Math-0")
+        report("student subject history", len(students), time.perf_counter() - start, "queries/sec")
+
+
+# jobs: /upload_grades must answer with a job ID straight away, interactive
+# commands must stay fast while the import runs, and an import interrupted
+# after a checkpoint must resume without losing or repeating rows
+class SimulatedCrash(Exception):
+    pass
+
+
+async def interactive_latencies(until, interval=0.01, minimum=100):
+    latencies = []
+    i = 0
+    while not until() or len(latencies) < minimum:
+        i += 1
+        if i % 2:
+            update, context, handler = make_update("123"), make_context([str(i % 1000 + 1), "Math", 80, 75, 70, 85, 100, 80]), Final.add_grade
+        else:
+            update, context, handler = make_update(str(i % 1000 + 1)), make_context(), Final.view_detailed_grades
+        start = time.perf_counter()
+        await handler(update, context)
+        latencies.append(time.perf_counter() - start)
+        await asyncio.sleep(interval)
+    await Final.GRADE_WRITES.stop()
+    return latencies
+
+
+def bench_jobs(args):
+    with temp_database() as db_file:
+        csv_path = os.path.join(os.path.dirname(db_file), "grades.csv")
+        write_grades_csv(csv_path, args.rows)
+        seed_grades(1000, ["Math"])
+        log_in_students(1000)
+        Final.add_user("123", "123", "teacher")
+
+        async def idle():
+            fake_dispatcher()
+            return await interactive_latencies(lambda: True)
+
+        async def with_import():
+            bot = fake_dispatcher()
+            Final.DISPATCHER.start(bot)
+            Final.JOBS.start()
+            start = time.perf_counter()
+            await Final.upload_grades(make_update("123"), make_context([csv_path]))
+            enqueue = time.perf_counter() - start
+            latencies = await interactive_latencies(lambda: Final.JOBS.stats()["done"] + Final.JOBS.stats()["failed"] > 0)
+            elapsed = time.perf_counter() - start
+            await Final.JOBS.stop()
+            await Final.DISPATCHER.stop(timeout=60)
+            return enqueue, elapsed, latencies, bot
+
+        baseline = asyncio.run(idle())
+        enqueue, elapsed, during, bot = asyncio.run(with_import())
+        print(f"/upload_grades reply after {enqueue * 1000:.1f} ms; import of {args.rows} rows finished after {elapsed:.2f}s")
+        print(f"{'interactive latency':<28} {'p50 ms':>8} {'p95 ms':>8} {'max ms':>8}")
+        for label, values in (("idle", baseline), ("during import", during)):
+            print(f"{label:<28} {percentile(values, 50) * 1000:8.2f} {percentile(values, 95) * 1000:8.2f} {max(values) * 1000:8.2f}")
+        print(f"{sum('processed' in text for _, text in bot.sent)} progress notifications, last message: {bot.sent[-1][1].splitlines()[0]}")
+
+        # Crash after the first checkpoint, then let a runner pick the job up again
+        Final.reset_gradebook()
+        job_id = Final.create_job("import", Final.DEFAULT_COURSE, "123", 123, {"path": csv_path, "source": csv_path})
+        job = Final.claim_job()
+        record = Final.record_job_checkpoint
+
+        def crash(job_id, report, owner):
+            record(job_id, report, owner)
+            raise SimulatedCrash()
+
+        Final.record_job_checkpoint = crash
+        try:
+            Final.import_job(job_id, csv_path, csv_path)
+        except SimulatedCrash:
+            pass
+        finally:
+            Final.record_job_checkpoint = record
+        with sqlite3.connect(db_file) as conn:
+            checkpoint = json.loads(conn.execute("SELECT checkpoint FROM jobs WHERE job_id = ?", (job_id,)).fetchone()[0])
+            conn.execute("UPDATE jobs SET lease_until = 0 WHERE job_id = ?", (job_id,))
+
+        async def resume():
+            bot = fake_dispatcher()
+            Final.JOBS = Final.JobRunner()
+            Final.DISPATCHER.start(bot)
+            Final.JOBS.start()
+            while not Final.JOBS.stats()["done"] + Final.JOBS.stats()["failed"]:
+                await asyncio.sleep(0.05)
+            await Final.JOBS.stop()
+            await Final.DISPATCHER.stop(timeout=60)
+            return bot
+
+        bot = asyncio.run(resume())
+        with Final.course_connection(Final.DEFAULT_COURSE) as conn:
+            imported = conn.execute("SELECT COUNT(*) FROM detailed_grades").fetchone()[0]
+        print(f"resumed job #{job['job_id']} after {checkpoint['rows_read']} rows: {imported} of {args.rows} rows present")
+        if imported != args.rows or f"{args.rows} of {args.rows} rows imported" not in bot.sent[-1][1]:
+            sys.exit(f"resumed import is wrong: {bot.sent[-1][1]}")
+
+
+# startup: cold starts of the bot, from exec to its reply to the first update,
+# against an offline Bot API on localhost; plus what importing Final costs
+# (python -X importtime), which every spawned process pays
+BOT_USER = {"id": 1, "is_bot": True, "first_name": "Gradebook", "username": "gradebook_bot"}
+STARTUP_CHILD = "import sys, Final; Final.DB_FILE, Final.SHARD_DIR, Final.BOT_API_URL = sys.argv[1:4]; Final.main()"
+
+
+# Answers the Bot API calls of a starting bot: getMe, deleteWebhook, then
+# server.updates one per getUpdates call. Records when each method was first
+# called (server.calls) and, per chat, when its update was handed out
+# (server.delivered) and first answered (server.answered).
+class OfflineBotAPI(BaseHTTPRequestHandler):
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        method = self.path.rsplit("/", 1)[-1]
+        now = time.perf_counter()
+        self.server.calls.setdefault(method, now)
+        if method == "getMe":
+            result = BOT_USER
+        elif method == "getUpdates":
+            result, self.server.updates = self.server.updates[:1], self.server.updates[1:]
+            for update in result:
+                self.server.delivered[update["message"]["chat"]["id"]] = now
+            if not result:
+                time.sleep(0.2)
+        elif method == "sendMessage":
+            chat_id = int(parse_qs(body.decode()).get("chat_id", ["0"])[0])
+            self.server.answered.setdefault(chat_id, now)
+            if len(self.server.answered) == len(self.server.delivered) and not self.server.updates:
+                self.server.done.set()
+            result = {"message_id": 2, "date": int(time.time()), "chat": {"id": chat_id, "type": "private"}, "from": BOT_USER, "text": ""}
+        else:
+            result = True
+        body = json.dumps({"ok": True, "result": result}).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        try:
+            self.wfile.write(body)
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+
+    def log_message(self, format, *args):
+        pass
+
+
+def command_update(update_id, user_id, text):
+    command = text.split()[0]
+    return {"update_id": update_id, "message": {
+        "message_id": update_id, "date": int(time.time()), "chat": {"id": user_id, "type": "private"},
+        "from": {"id": user_id, "is_bot": False, "first_name": str(user_id)}, "text": text,
+        "entities": [{"type": "bot_command", "offset": 0, "length": len(command)}],
+    }}
+
+
+# Run Python in a scratch directory with Final.py importable
+def child_python(args, cwd, **kwargs):
+    package_dir = os.path.dirname(os.path.abspath(Final.__file__))
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, [package_dir, os.environ.get("PYTHONPATH")])))
+    return subprocess.Popen([sys.executable, *args], cwd=cwd, env=env, **kwargs)
+
+
+# Start "Final.main()" in a new interpreter, send /view_grades from student 1
+# and then /stats from teacher 123 (the first heavy job, which spawns the pool
+# process). Returns seconds after the exec for each Bot API method's first call,
+# plus the time from handing out /stats to its reply.
+def cold_start(server, db_file):
+    server.calls, server.delivered, server.answered, server.done = {}, {}, {}, threading.Event()
+    server.updates = [command_update(1, 1, "/view_grades"), command_update(2, 123, "/stats")]
+    url = f"http://127.0.0.1:{server.server_port}/bot"
+    start = time.perf_counter()
+    child = child_python(["-c", STARTUP_CHILD, db_file, Final.SHARD_DIR, url], os.path.dirname(db_file),
+                         stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        if not server.done.wait(60):
+            sys.exit("the bot never answered its first updates")
+    finally:
+        child.send_signal(signal.SIGINT)
+        child.wait(60)
+    times = {method: at - start for method, at in server.calls.items()}
+    times["first reply"] = server.answered[1] - start
+    times["first heavy job"] = server.answered[123] - server.delivered[123]
+    return times
+
+
+# Parse python -X importtime output for `module` into (total, {direct import: cumulative}), in seconds
+def import_times(module, cwd):
+    child = child_python(["-X", "importtime", "-c", f"import {module}"], cwd, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+    _, stderr = child.communicate()
+    # A module's imports are listed before it, one level deeper
+    total, direct, children = 0.0, {}, {}
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "[us]" in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        if depth == 0:
+            if name.strip() == module:
+                total, direct = int(cumulative) / 1e6, children
+            children = {}
+        elif depth == 1:
+            children[name.strip()] = int(cumulative) / 1e6
+    return total, direct
+
+
+def bench_startup(args):
+    with temp_database() as db_file:
+        seed_grades(10)
+        Final.add_user("1", "1", "student")
+        Final.add_user("123", "123", "teacher")
+        Final.close_pools()
+        workdir = os.path.dirname(db_file)
+
+        totals = [import_times("Final", workdir)[0] for _ in range(args.runs)]
+        _, direct = import_times("Final", workdir)
+        print(f"import Final: {percentile(totals, 50) * 1000:.0f} ms (median of {args.runs}); slowest imports it triggers:")
+        for name, elapsed in sorted(direct.items(), key=lambda item: -item[1])[:8]:
+            print(f"  {name:<28} {elapsed * 1000:7.1f} ms")
+
+        server = ThreadingHTTPServer(("127.0.0.1", 0), OfflineBotAPI)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        try:
+            runs = [cold_start(server, db_file) for _ in range(args.runs)]
+        finally:
+            server.shutdown()
+        print(f"cold start, median of {args.runs} runs     ms after exec")
+        for label, key in (("bot initialized (getMe)", "getMe"), ("polling (first getUpdates)", "getUpdates"), ("first reply (/view_grades)", "first reply")):
+            print(f"  {label:<36} {percentile([run[key] for run in runs], 50) * 1000:7.0f}")
+        print(f"first /stats after start (spawns the heavy-job process): {percentile([run['first heavy job'] for run in runs], 50) * 1000:.0f} ms")
+
+    first_reply = percentile([run["first reply"] for run in runs], 50)
+    if first_reply > args.target:
+        sys.exit(f"time to first update {first_reply:.2f}s is over the {args.target:.2f}s target")
+    print(f"time to first update {first_reply:.2f}s (target {args.target:.2f}s)")
+
+
+# state: restart cost of loading every user's state up front vs lazily,
+# and how many row writes coalescing saves
+def bench_state(args):
+    with temp_database() as db_file:
+        paging = {"course": "default", "filters": {}, "first": ["1", "Math"], "last": ["20", "Math"]}
+        with sqlite3.connect(db_file) as conn:
+            conn.executemany("INSERT INTO bot_state (kind, key, data, updated_at) VALUES ('view_all_grades', ?, ?, 0)",
+                             [(str(user), json.dumps(paging)) for user in range(args.users)])
+
+        start = time.perf_counter()
+        with sqlite3.connect(db_file) as conn:
+            eager = {(kind, key): json.loads(data) for kind, key, data in conn.execute("SELECT kind, key, data FROM bot_state")}
+        report("eager load at startup", len(eager), time.perf_counter() - start, "states/sec")
+
+        Final.STATE = Final.StateStore()
+        start = time.perf_counter()
+        value = Final.STATE.get("view_all_grades", str(args.users // 2))
+        print(f"lazy: first access after restart {(time.perf_counter() - start) * 1000:.2f} ms ({'ok' if value == paging else 'MISMATCH'})")
+
+        users = min(args.users, 100)
+        start = time.perf_counter()
+        for step in range(args.updates):
+            Final.STATE.set("view_all_grades", str(step % users), {**paging, "last": [str(step), "Math"]})
+        flushed = Final.STATE.flush()
+        report("coalesced updates", args.updates, time.perf_counter() - start, "updates/sec")
+        print(f"{args.updates} updates to {users} users written as {flushed} rows in one transaction")
+
+
+# load: a mixed stream of student and teacher commands fed as raw updates
+# through an Application built like Final.main()'s (run_application), with
+# teachers in chats TEACHER_CHAT_BASE + n. Reports p50/p95/p99 handler latency
+# and throughput per command; with --baseline it compares against an earlier
+# --output and fails on regressions.
+STUDENT_COMMANDS = {"view_grades", "view_detailed_grades", "view_grading_logic"}
+LOAD_COMMANDS = ("view_grades", "view_detailed_grades", "view_grading_logic", "add_grade", "view_all_grades", "stats")
+TEACHER_CHAT_BASE = 1000000
+DEFAULT_MIX = "view_grades=50,view_detailed_grades=30,view_grading_logic=10,add_grade=5,view_all_grades=3,stats=2"
+
+
+def parse_mix(text):
+    mix = {}
+    for part in text.split(","):
+        name, _, weight = part.partition("=")
+        if name not in LOAD_COMMANDS:
+            raise argparse.ArgumentTypeError(f"unknown command {name!r}; choose from {', '.join(LOAD_COMMANDS)}")
+        mix[name] = float(weight or 1)
+    return mix
+
+
+# The load mix as raw updates, (chat_id, command, update dict)
+def generate_traffic(mix, updates, students, teachers, seed):
+    rng = random.Random(seed)
+    names, weights = list(mix), list(mix.values())
+    traffic = []
+    for update_id, command in enumerate(rng.choices(names, weights, k=updates), 1):
+        if command in STUDENT_COMMANDS:
+            chat_id = rng.randint(1, students)
+        else:
+            chat_id = TEACHER_CHAT_BASE + rng.randint(1, teachers)
+        args = []
+        if command == "add_grade":
+            args = [str(rng.randint(1, students)), rng.choice(SUBJECTS), *(str(rng.randint(40, 100)) for _ in range(5))]
+        elif command == "stats" and rng.random() < 0.5:
+            args = [rng.choice(SUBJECTS)]
+        traffic.append((chat_id, command, command_update(update_id, chat_id, " ".join([f"/{command}", *args]))))
+    return traffic
+
+
+def percentile(values, p):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(p / 100 * (len(ordered) - 1))))] if ordered else 0.0
+
+
+async def run_load(traffic, concurrency, latency):
+    elapsed, handled = await run_application([data for _, _, data in traffic], concurrency, latency=latency)
+    latencies = {}
+    for _, command, data in traffic:
+        latencies.setdefault(command, []).append(handled[data["update_id"]])
+    return latencies, elapsed
+
+
+def summarize_load(latencies, elapsed):
+    summary = {}
+    for command, values in sorted(latencies.items()):
+        summary[command] = {
+            "count": len(values),
+            "p50_ms": percentile(values, 50) * 1000,
+            "p95_ms": percentile(values, 95) * 1000,
+            "p99_ms": percentile(values, 99) * 1000,
+            "throughput": len(values) / elapsed,
+        }
+    every = [value for values in latencies.values() for value in values]
+    summary["all"] = {
+        "count": len(every),
+        "p50_ms": percentile(every, 50) * 1000,
+        "p95_ms": percentile(every, 95) * 1000,
+        "p99_ms": percentile(every, 99) * 1000,
+        "throughput": len(every) / elapsed,
+    }
+    return summary
+
+
+def print_load_summary(summary, baseline=None):
+    print(f"{'command':<22} {'count':>7} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'upd/s':>10}")
+    for command, row in summary.items():
+        line = f"{command:<22} {row['count']:>7} {row['p50_ms']:>9.2f} {row['p95_ms']:>9.2f} {row['p99_ms']:>9.2f} {row['throughput']:>10.1f}"
+        if baseline and command in baseline:
+            before = baseline[command]
+            line += f"   p95 {row['p95_ms'] - before['p95_ms']:+.2f}ms, throughput {(row['throughput'] / before['throughput'] - 1) * 100:+.1f}%"
+        print(line)
+
+
+def load_regressions(summary, baseline, tolerance):
+    problems = []
+    for command, row in summary.items():
+        before = baseline.get(command)
+        if not before:
+            continue
+        if row["p95_ms"] > before["p95_ms"] * (1 + tolerance) and row["p95_ms"] - before["p95_ms"] > 0.5:
+            problems.append(f"{command}: p95 {before['p95_ms']:.2f}ms -> {row['p95_ms']:.2f}ms")
+        if row["throughput"] < before["throughput"] * (1 - tolerance):
+            problems.append(f"{command}: throughput {before['throughput']:.1f} -> {row['throughput']:.1f} updates/s")
+    return problems
+
+
+def prepare_load_database(args):
+    seed_grades(args.students)
+    log_in_students(args.students)
+    for teacher in range(1, args.teachers + 1):
+        Final.add_user(str(TEACHER_CHAT_BASE + teacher), "123", "teacher")
+    Final.define_grading_weights({"homework": 20, "quizzes": 10, "midterm": 25, "final": 35, "attendance": 10})
+
+
+def bench_load(args):
+    # As in the workers benchmark, students are not told about the grades added
+    Final.NOTIFY_STUDENTS = False
+    with temp_database():
+        prepare_load_database(args)
+
+        traffic = generate_traffic(args.mix, args.updates, args.students, args.teachers, args.seed)
+        fake_dispatcher()
+        latencies, elapsed = asyncio.run(run_load(traffic, args.concurrency, args.latency_ms / 1000))
+
+    summary = summarize_load(latencies, elapsed)
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)["summary"]
+    print_load_summary(summary, baseline)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"args": {k: v for k, v in vars(args).items() if k != "func"}, "summary": summary}, f, indent=2)
+    if baseline:
+        problems = load_regressions(summary, baseline, args.tolerance)
+        if problems:
+            sys.exit("Regressions against baseline:\n" + "\n".join(problems))
+
+
+# workers: the load mix sent as webhook calls to the receiver that
+# "python Final.py workers" runs, partitioned by chat onto the worker queues
+# and handled by worker_loop() in 1..N worker processes, whose replies go to
+# a local stand-in for the Bot API. Each chat has one update in flight at a
+# time, so every reply answers exactly one update.
+class LoadBotAPI(BaseHTTPRequestHandler):
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        method = self.path.rsplit("/", 1)[-1]
+        if method == "getMe":
+            result = BOT_USER
+            self.server.started.release()
+        elif method.startswith("send"):
+            chat_id = int(parse_qs(body.decode()).get("chat_id", ["0"])[0])
+            time.sleep(self.server.latency)
+            self.server.replied(chat_id)
+            result = {"message_id": 2, "date": int(time.time()), "chat": {"id": chat_id, "type": "private"}, "from": BOT_USER, "text": ""}
+        else:
+            result = True
+        body = json.dumps({"ok": True, "result": result}).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        try:
+            self.wfile.write(body)
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+
+    def log_message(self, format, *args):
+        pass
+
+
+# Worker process: Final.worker_main() against the stand-in Bot API, without
+# Telegram's send limits (as in fake_dispatcher) or grade notifications
+def load_worker(index, update_queue, workers, db_file, shard_dir, api_url):
+    logging.getLogger().setLevel(logging.WARNING)
+    Final.BOT_API_URL, Final.METRICS_PORT, Final.NOTIFY_STUDENTS = api_url, None, False
+    Final.SEND_GLOBAL_RATE = Final.SEND_BACKGROUND_RATE = 1e9
+    Final.MessageDispatcher = functools.partial(Final.MessageDispatcher, chat_rate=1e9, chat_burst=1e9, concurrency=1000)
+    Final.worker_main(index, update_queue, workers, db_file, shard_dir)
+
+
+def post_webhook(port, data, secret):
+    body = json.dumps(data).encode()
+    conn = http.client.HTTPConnection("127.0.0.1", port)
+    try:
+        conn.request("POST", Final.WEBHOOK_PATH, body, {"Content-Type": "application/json", "X-Telegram-Bot-Api-Secret-Token": secret})
+        if conn.getresponse().status != 200:
+            sys.exit("the receiver rejected an update")
+    finally:
+        conn.close()
+
+
+def run_workers_load(args, workers, db_file, traffic):
+    api = ThreadingHTTPServer(("127.0.0.1", 0), LoadBotAPI)
+    api.latency, api.started = args.latency_ms / 1000, threading.Semaphore(0)
+    context = multiprocessing.get_context("spawn")
+    queues = [context.Queue(maxsize=Final.WORKER_QUEUE_SIZE) for _ in range(workers)]
+    receiver = ThreadingHTTPServer(("127.0.0.1", 0), Final.WebhookRequestHandler)
+    receiver.dispatch, receiver.secret = Final.partitioned_dispatch(queues), secrets.token_urlsafe(32)
+
+    pending = {}
+    for chat_id, command, data in traffic:
+        pending.setdefault(chat_id, deque()).append((command, data))
+    ready = queue.Queue()
+    for chat_id in pending:
+        ready.put(chat_id)
+    slots = threading.Semaphore(args.concurrency * workers)
+    in_flight, lock, done = {}, threading.Lock(), threading.Event()
+    latencies, remaining = {}, [len(traffic)]
+
+    def replied(chat_id):
+        with lock:
+            sent = in_flight.pop(chat_id, None)
+            if sent is None:
+                return
+            command, start = sent
+            latencies.setdefault(command, []).append(time.perf_counter() - start)
+            remaining[0] -= 1
+            if pending[chat_id]:
+                ready.put(chat_id)
+            if not remaining[0]:
+                done.set()
+        slots.release()
+
+    api.replied = replied
+    for server in (api, receiver):
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f"http://127.0.0.1:{api.server_port}/bot"
+    processes = [context.Process(target=load_worker, args=(index, queues[index], workers, db_file, Final.SHARD_DIR, url))
+                 for index in range(workers)]
+    for process in processes:
+        process.start()
+    try:
+        for _ in range(workers):
+            if not api.started.acquire(timeout=60):
+                sys.exit("a worker never started")
+        start = time.perf_counter()
+        for _ in range(len(traffic)):
+            chat_id = ready.get()
+            slots.acquire()
+            with lock:
+                command, data = pending[chat_id].popleft()
+                in_flight[chat_id] = (command, time.perf_counter())
+            post_webhook(receiver.server_port, data, receiver.secret)
+        if not done.wait(600):
+            sys.exit(f"{remaining[0]} updates were never answered")
+        elapsed = time.perf_counter() - start
+    finally:
+        for update_queue in queues:
+            update_queue.put(None)
+        for process in processes:
+            process.join(60)
+        receiver.shutdown()
+        api.shutdown()
+    return latencies, elapsed
+
+
+def bench_workers(args):
+    counts = [int(count) for count in args.workers.split(",")]
+    traffic = generate_traffic(args.mix, args.updates, args.students, args.teachers, args.seed)
+    print(f"{'workers':>8} {'updates/s':>10} {'speedup':>8} {'p95 ms':>8}   ({os.cpu_count()} CPUs)")
+    baseline = None
+    for workers in counts:
+        with temp_database() as db_file:
+            prepare_load_database(args)
+            Final.close_pools()
+            latencies, elapsed = run_workers_load(args, workers, db_file, traffic)
+        every = [value for values in latencies.values() for value in values]
+        throughput = len(every) / elapsed
+        baseline = baseline or throughput
+        print(f"{workers:>8} {throughput:>10.1f} {throughput / baseline:>7.2f}x {percentile(every, 95) * 1000:>8.2f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Gradebook benchmarks")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    db_parser = subparsers.add_parser("db", help="messages/sec with per-call connections vs the connection pool")
+    db_parser.add_argument("--updates", type=int, default=5000)
+    db_parser.add_argument("--students", type=int, default=500)
+    db_parser.add_argument("--concurrency", type=int, default=100)
+    db_parser.add_argument("--latency-ms", type=float, default=5.0)
+    db_parser.set_defaults(func=bench_db)
+
+    import_parser = subparsers.add_parser("import", help="rows/sec for bulk CSV import vs per-row inserts")
+    import_parser.add_argument("--rows", type=int, default=50000)
+    import_parser.add_argument("--legacy-rows", type=int, default=2000)
+    import_parser.set_defaults(func=bench_import)
+
+    plans_parser = subparsers.add_parser("plans", help="check that every handler query uses an index")
+    plans_parser.set_defaults(func=bench_plans)
+
+    recompute_parser = subparsers.add_parser("recompute", help="time to recompute overall grades for a whole course")
+    recompute_parser.add_argument("--rows", type=int, default=100000)
+    recompute_parser.set_defaults(func=bench_recompute)
+
+    export_parser = subparsers.add_parser("export", help="rows/sec and memory for streaming CSV and columnar exports")
+    export_parser.add_argument("--rows", type=int, default=1000000)
+    export_parser.set_defaults(func=bench_export)
+
+    ingest_parser = subparsers.add_parser("ingest", help="grades/sec for parallel /add_grade with and without group commit")
+    ingest_parser.add_argument("--grades", type=int, default=5000)
+    ingest_parser.add_argument("--teachers", type=int, default=50)
+    ingest_parser.add_argument("--concurrency", type=int, default=50)
+    ingest_parser.set_defaults(func=bench_ingest)
+
+    cache_parser = subparsers.add_parser("cache", help="student views with a cold vs warm response cache")
+    cache_parser.add_argument("--students", type=int, default=2000)
+    cache_parser.add_argument("--concurrency", type=int, default=100)
+    cache_parser.set_defaults(func=bench_cache)
+
+    state_parser = subparsers.add_parser("state", help="restart cost of eager vs lazy state loading, and write coalescing")
+    state_parser.add_argument("--users", type=int, default=100000)
+    state_parser.add_argument("--updates", type=int, default=10000)
+    state_parser.set_defaults(func=bench_state)
+
+    jobs_parser = subparsers.add_parser("jobs", help="enqueue latency, interactive latency during an import, and import resume")
+    jobs_parser.add_argument("--rows", type=int, default=200000)
+    jobs_parser.set_defaults(func=bench_jobs)
+
+    snapshot_parser = subparsers.add_parser("snapshot", help="memory and read speed of the in-memory columnar snapshot vs SQLite")
+    snapshot_parser.add_argument("--rows", type=int, default=500000)
+    snapshot_parser.set_defaults(func=bench_snapshot)
+
+    history_parser = subparsers.add_parser("history", help="import overhead of the grade history, and point-in-time queries")
+    history_parser.add_argument("--rows", type=int, default=100000)
+    history_parser.add_argument("--rounds", type=int, default=5)
+    history_parser.set_defaults(func=bench_history)
+
+    notify_parser = subparsers.add_parser("notify", help="grade notification fan-out, per-student dedup, and reply latency during a fan-out")
+    notify_parser.add_argument("--rows", type=int, default=10000)
+    notify_parser.add_argument("--students", type=int, default=5000)
+    notify_parser.add_argument("--backlog", type=int, default=300, help="notifications queued under real rate limits")
+    notify_parser.set_defaults(func=bench_notify)
+
+    startup_parser = subparsers.add_parser("startup", help="cold start to first reply, and what importing Final costs")
+    startup_parser.add_argument("--runs", type=int, default=5)
+    startup_parser.add_argument("--target", type=float, default=1.0, help="seconds from exec to the reply to the first update")
+    startup_parser.set_defaults(func=bench_startup)
+
+    load_parser = subparsers.add_parser("load", help="latency percentiles and throughput per command under mixed traffic")
+    load_parser.add_argument("--updates", type=int, default=10000)
+    load_parser.add_argument("--students", type=int, default=500)
+    load_parser.add_argument("--teachers", type=int, default=5)
+    load_parser.add_argument("--concurrency", type=int, default=100)
+    load_parser.add_argument("--latency-ms", type=float, default=5.0, help="simulated Bot API round trip")
+    load_parser.add_argument("--mix", type=parse_mix, default=parse_mix(DEFAULT_MIX))
+    load_parser.add_argument("--seed", type=int, default=1)
+    load_parser.add_argument("--output", help="write results as JSON")
+    load_parser.add_argument("--baseline", help="compare with an earlier --output and exit non-zero on regressions")
+    load_parser.add_argument("--tolerance", type=float, default=0.20, help="allowed relative regression (default 20%%)")
+    load_parser.set_defaults(func=bench_load)
+
+    workers_parser = subparsers.add_parser("workers", help="load throughput with updates partitioned across 1..N worker processes")
+    workers_parser.add_argument("--workers", default="1,2,4", help="comma-separated worker counts to compare")
+    workers_parser.add_argument("--updates", type=int, default=10000)
+    workers_parser.add_argument("--students", type=int, default=500)
+    workers_parser.add_argument("--teachers", type=int, default=5)
+    workers_parser.add_argument("--concurrency", type=int, default=100, help="in-flight updates per worker, at most one per chat")
+    workers_parser.add_argument("--latency-ms", type=float, default=5.0, help="simulated Bot API round trip")
+    workers_parser.add_argument("--mix", type=parse_mix, default=parse_mix(DEFAULT_MIX))
+    workers_parser.add_argument("--seed", type=int, default=1)
+    workers_parser.set_defaults(func=bench_workers)
+
+    args = parser.parse_args()
+    logging.getLogger().setLevel(logging.WARNING)
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,54 @@
+import asyncio
+
+import pytest
+
+import benchmark
+import Final
+
+
+# Keeps the documents it is given, and can fail every send the way Telegram would
+class DocumentBot(benchmark.FakeBot):
+    def __init__(self, error=None):
+        super().__init__()
+        self.error = error
+        self.documents = []
+
+    async def send_document(self, chat_id, document, filename=None, **kwargs):
+        self.documents.append((document, document.read()))
+        if self.error:
+            raise self.error
+        await super().send_document(chat_id, document, filename)
+
+
+def export(bot):
+    Final.add_user("123", "T-1", "teacher")
+    with Final.course_connection(Final.DEFAULT_COURSE) as conn, conn:
+        Final.upsert_detailed_grades(conn, [("1", "Math", *[50.0] * 6)])
+    benchmark.fake_dispatcher()
+
+    async def main():
+        Final.DISPATCHER.start(bot)
+        await Final.export_grades_command(benchmark.make_update(123), benchmark.make_context(["csv"]))
+        await Final.DISPATCHER.stop(timeout=5)
+
+    asyncio.run(main())
+
+
+def test_export_file_is_closed_once_sent(db):
+    bot = DocumentBot()
+    export(bot)
+    [(document, data)] = bot.documents
+    assert b"1,Math,50.0" in data
+    assert document.closed
+    assert (123, f"grades_{Final.DEFAULT_COURSE}.csv") in bot.sent
+
+
+@pytest.mark.parametrize("error", ["rejected", "network"])
+def test_export_file_is_closed_when_the_send_fails(db, monkeypatch, error):
+    from telegram.error import NetworkError, TelegramError
+
+    monkeypatch.setattr(Final, "SEND_MAX_RETRIES", 1)
+    bot = DocumentBot(TelegramError("rejected") if error == "rejected" else NetworkError("down"))
+    export(bot)
+    assert len(bot.documents) == (1 if error == "rejected" else 2)
+    assert all(document.closed for document, _ in bot.documents)
@@ -0,0 +1,129 @@
+import asyncio
+
+import benchmark
+import Final
+
+
+def row(student_id, subject, value):
+    return (student_id, subject, value, value, value, value, value, value)
+
+
+def detailed_grades():
+    with Final.course_connection(Final.DEFAULT_COURSE) as conn:
+        return conn.execute(Final.SELECT_EXPORT_SQL).fetchall()
+
+
+def test_concurrent_grades_share_one_flush(db):
+    buffer = Final.GradeWriteBuffer(interval=0.05)
+
+    async def main():
+        futures = [buffer.submit(Final.DEFAULT_COURSE, row(str(student), "Math", 50 + student), "t1", "/add_grade") for student in range(1, 21)]
+        results = await asyncio.gather(*futures)
+        await buffer.stop()
+        return results
+
+    assert asyncio.run(main()) == [True] * 20
+    assert buffer.stats()["flushes"] == 1
+    assert buffer.stats()["written"] == 20
+    assert detailed_grades() == sorted(row(str(student), "Math", 50.0 + student) for student in range(1, 21))
+
+
+def test_latest_grade_for_a_key_wins(db):
+    buffer = Final.GradeWriteBuffer(interval=0.05)
+
+    async def main():
+        first = buffer.submit(Final.DEFAULT_COURSE, row("1", "Math", 60))
+        second = buffer.submit(Final.DEFAULT_COURSE, row("1", "Math", 70))
+        results = await asyncio.gather(first, second)
+        await buffer.stop()
+        return results
+
+    assert asyncio.run(main()) == [True, True]
+    assert detailed_grades() == [row("1", "Math", 70.0)]
+
+
+def test_failed_course_does_not_fail_the_others(db):
+    buffer = Final.GradeWriteBuffer(interval=0.05)
+
+    async def main():
+        good = buffer.submit(Final.DEFAULT_COURSE, row("1", "Math", 80))
+        bad = buffer.submit("no-such-course", row("1", "Math", 80))
+        results = await asyncio.gather(good, bad)
+        await buffer.stop()
+        return results
+
+    assert asyncio.run(main()) == [True, False]
+    assert buffer.stats()["failed"] == 1
+    assert detailed_grades() == [row("1", "Math", 80.0)]
+
+
+def test_stop_flushes_what_is_queued(db):
+    buffer = Final.GradeWriteBuffer(interval=60)
+
+    async def main():
+        future = buffer.submit(Final.DEFAULT_COURSE, row("1", "Math", 90))
+        await buffer.stop()
+        return future.result()
+
+    assert asyncio.run(main()) is True
+    assert detailed_grades() == [row("1", "Math", 90.0)]
+
+
+def test_full_buffer_flushes_without_waiting_for_the_interval(db):
+    buffer = Final.GradeWriteBuffer(interval=60, max_rows=5)
+
+    async def main():
+        futures = [buffer.submit(Final.DEFAULT_COURSE, row(str(student), "Math", 75)) for student in range(1, 6)]
+        results = await asyncio.wait_for(asyncio.gather(*futures), timeout=5)
+        await buffer.stop()
+        return results
+
+    assert asyncio.run(main()) == [True] * 5
+
+
+def test_unexpected_error_fails_the_batch_instead_of_hanging(db):
+    buffer = Final.GradeWriteBuffer(interval=0.05)
+
+    async def main():
+        good = buffer.submit(Final.DEFAULT_COURSE, row("1", "Math", 80))
+        bad = buffer.submit(Final.DEFAULT_COURSE, row("2", "Math", float("nan")))
+        results = await asyncio.wait_for(asyncio.gather(good, bad), timeout=5)
+        # The buffer is still running afterwards
+        later = await asyncio.wait_for(buffer.submit(Final.DEFAULT_COURSE, row("3", "Math", 70)), timeout=5)
+        await buffer.stop()
+        return results, later
+
+    assert asyncio.run(main()) == ([False, False], True)
+    assert detailed_grades() == [row("3", "Math", 70.0)]
+
+
+def test_add_grade_rejects_non_finite_values(db):
+    Final.add_user("123", "T-1", "teacher")
+    Final.enroll_students(Final.DEFAULT_COURSE, ["1"])
+    Final.define_grading_logic("Weighted average")
+    bot = benchmark.fake_dispatcher()
+
+    async def main():
+        Final.DISPATCHER.start(bot)
+        for value in ["nan", "inf"]:
+            await asyncio.wait_for(Final.add_grade(benchmark.make_update(123), benchmark.make_context(["1", "Math", value, "1", "1", "1", "1", "1"])), timeout=5)
+        await Final.GRADE_WRITES.stop()
+        await Final.DISPATCHER.stop(timeout=5)
+
+    asyncio.run(main())
+    assert [text for _, text in bot.sent] == ["Invalid grade. Please provide numbers for all grading components."] * 2
+    assert detailed_grades() == []
+
+
+def test_grades_from_different_teachers_apply_in_submission_order(db):
+    buffer = Final.GradeWriteBuffer(interval=0.05)
+
+    async def main():
+        futures = [buffer.submit(Final.DEFAULT_COURSE, row("1", "Math", value), teacher, "/add_grade")
+                   for value, teacher in [(60, "A"), (70, "B"), (80, "A")]]
+        await asyncio.gather(*futures)
+        await buffer.stop()
+
+    asyncio.run(main())
+    assert detailed_grades() == [row("1", "Math", 80.0)]
+    assert [(entry[2], entry[5]) for entry in Final.get_grade_history("1", "Math")] == [("A", 80.0), ("B", 70.0), ("A", 60.0)]
@@ -0,0 +1,39 @@
+import asyncio
+import os
+
+import pytest
+
+import benchmark
+import Final
+
+
+@pytest.fixture
+def heavy_pool(db):
+    Final.start_heavy_executor()
+    yield
+    Final.stop_heavy_executor()
+
+
+# Value of one sample line in the /metrics text, 0 when absent
+def sample(name):
+    for line in Final.METRICS.render().splitlines():
+        if line.startswith(name + " "):
+            return float(line.rsplit(" ", 1)[1])
+    return 0.0
+
+
+def test_metrics_recorded_in_the_pool_reach_the_parent(heavy_pool):
+    csv_path = os.path.join(os.path.dirname(Final.DB_FILE), "grades.csv")
+    benchmark.write_grades_csv(csv_path, 100)
+    imported = sample('gradebook_import_rows_total{result="imported"}')
+    timed = sample('gradebook_db_query_seconds_count{helper="bulk_import_grades"}')
+
+    report = asyncio.run(Final.run_heavy(Final.import_grades_file, csv_path))
+    assert report.rows_imported == 100
+    assert sample('gradebook_import_rows_total{result="imported"}') == imported + 100
+    assert sample('gradebook_db_query_seconds_count{helper="bulk_import_grades"}') == timed + 1
+
+    # A failed job's metrics come back with its exception
+    with pytest.raises(Exception):
+        asyncio.run(Final.run_heavy(Final.import_grades_file, csv_path, course_id="no-such-course"))
+    assert sample('gradebook_db_query_seconds_count{helper="bulk_import_grades"}') == timed + 2
@@ -0,0 +1,105 @@
+import asyncio
+
+import benchmark
+import Final
+
+
+def write(rows, changed_by=None, source=None):
+    with Final.course_connection(Final.DEFAULT_COURSE) as conn, conn:
+        Final.upsert_detailed_grades(conn, rows, changed_by, source)
+
+
+def checkpoint():
+    with Final.course_connection(Final.DEFAULT_COURSE) as conn, conn:
+        Final.take_history_checkpoint(conn)
+
+
+def grade(student_id, subject, value):
+    return (student_id, subject, *[float(value)] * len(Final.STAT_COMPONENTS))
+
+
+def test_changes_after_the_checkpoint_are_replayed(db, clock):
+    start = clock.now
+    checkpoint()
+    clock.advance(10)
+    write([grade("1", "Math", 50)])
+    clock.advance(10)
+    write([grade("1", "Math", 60), grade("2", "Math", 70)])
+
+    assert Final.get_grades_as_of(start - 1) is None
+    assert Final.get_grades_as_of(start + 5) == []
+    assert Final.get_grades_as_of(start + 15) == [grade("1", "Math", 50)]
+    assert Final.get_grades_as_of(start + 25) == [grade("1", "Math", 60), grade("2", "Math", 70)]
+    assert Final.get_grades_as_of(start + 25, student_id="2") == [grade("2", "Math", 70)]
+
+
+# A recompute logs its course-wide event and leaves the checkpoint until after it
+# has committed, so grades in between are rebuilt by undoing from that checkpoint
+def test_changes_after_a_course_event_are_undone_from_the_next_checkpoint(db, clock):
+    start = clock.now
+    checkpoint()
+    clock.advance(10)
+    write([grade("1", "Math", 50)])
+    clock.advance(10)
+    with Final.course_connection(Final.DEFAULT_COURSE) as conn, conn:
+        conn.execute("UPDATE detailed_grades SET overall = 0")
+        Final.log_course_event(conn, "recompute")
+    clock.advance(10)
+    write([grade("1", "Math", 90), grade("2", "Physics", 40)])
+
+    recomputed = [("1", "Math", *[50.0] * (len(Final.STAT_COMPONENTS) - 1), 0.0)]
+    # Until the event's checkpoint is taken there is nothing to undo from
+    assert Final.get_grades_as_of(start + 25) is None
+    clock.advance(10)
+    Final.checkpoint_course_history(Final.DEFAULT_COURSE)
+
+    assert Final.get_grades_as_of(start + 15) == [grade("1", "Math", 50)]
+    assert Final.get_grades_as_of(start + 25) == recomputed
+    assert Final.get_grades_as_of(start + 35) == [grade("1", "Math", 90), grade("2", "Physics", 40)]
+    assert Final.get_grades_as_of(start + 25, student_id="2") == []
+
+
+def test_grade_history_spans_checkpoints_and_course_events(db, clock):
+    write([grade("1", "Math", 10)], "t1", "/add_grade")
+    checkpoint()
+    clock.advance()
+    for value in range(5):
+        write([grade("2", "Math", value)], "t1", "/add_grade")
+    checkpoint()
+    clock.advance()
+    write([grade("1", "Math", 20)], "t2", "/import")
+    clock.advance()
+    Final.reset_gradebook(changed_by="t1")
+    clock.advance()
+    write([grade("1", "Math", 30)], "t2", "/add_grade")
+
+    entries = Final.get_grade_history("1", "Math")
+    assert [entry[3] for entry in entries] == ["/add_grade", "/reset", "/import", "/add_grade"]
+    # Course-wide events carry no values
+    assert [len(entry) for entry in entries] == [5 + len(Final.STAT_COMPONENTS), 4, 5 + len(Final.STAT_COMPONENTS), 5 + len(Final.STAT_COMPONENTS)]
+    assert [entry[5] for entry in entries if len(entry) > 4] == [30.0, 20.0, 10.0]
+    assert [entry[4] for entry in entries if len(entry) > 4] == [None, '[10.0, 10.0, 10.0, 10.0, 10.0, 10.0]', None]
+    assert [entry[2] for entry in entries] == ["t2", "t1", "t2", "t1"]
+    assert entries == sorted(entries, reverse=True)
+
+    assert [entry[3] for entry in Final.get_grade_history("1", "Math", limit=2)] == ["/add_grade", "/reset"]
+    assert Final.get_grade_history("9", "Math") == []
+
+
+# Telegram account 123 belongs to the teacher with college ID T-1
+def test_changes_are_recorded_under_the_teachers_college_id(db):
+    Final.add_user("123", "T-1", "teacher")
+    Final.enroll_students(Final.DEFAULT_COURSE, ["1"])
+    benchmark.fake_dispatcher()
+
+    async def main():
+        Final.define_grading_logic("Weighted average")
+        await Final.add_grade(benchmark.make_update(123), benchmark.make_context(["1", "Math", "80", "70", "60", "50", "40", "75"]))
+        await Final.GRADE_WRITES.stop()
+        await Final.grading_logic(benchmark.make_update(123), benchmark.make_context(["homework=1", "quizzes=0", "midterm=0", "final=0", "attendance=0"]))
+        await Final.reset(benchmark.make_update(123), benchmark.make_context())
+
+    asyncio.run(main())
+    assert [(entry[2], entry[3]) for entry in Final.get_grade_history("1", "Math")] == [("T-1", "/grading_logic version 1"), ("T-1", "/add_grade")]
+    job = Final.claim_job()
+    assert job["requested_by"] == "123" and job["params"]["changed_by"] == "T-1"
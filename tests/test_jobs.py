@@ -0,0 +1,166 @@
+import asyncio
+import json
+import os
+import socket
+
+import pytest
+
+import benchmark
+import Final
+
+
+def job_row(job_id, *columns):
+    with Final.db_connection() as conn:
+        return conn.execute(f"SELECT {', '.join(columns)} FROM jobs WHERE job_id = ?", (job_id,)).fetchone()
+
+
+def set_job(job_id, **values):
+    with Final.db_connection() as conn, conn:
+        conn.execute(f"UPDATE jobs SET {', '.join(f'{column} = ?' for column in values)} WHERE job_id = ?", (*values.values(), job_id))
+
+
+# Runs a JobRunner until `count` jobs have finished, returning what it sent
+def run_jobs(count=1):
+    bot = benchmark.fake_dispatcher()
+
+    async def main():
+        runner = Final.JOBS = Final.JobRunner(poll_interval=0.05)
+        Final.DISPATCHER.start(bot)
+        runner.start()
+        # A job counts as finished before its outcome is written; wait for its task too
+        while sum(runner.stats()[status] for status in ("done", "failed", "cancelled")) < count or runner.stats()["running"]:
+            await asyncio.sleep(0.02)
+        await runner.stop()
+        await Final.DISPATCHER.stop(timeout=5)
+
+    asyncio.run(asyncio.wait_for(main(), timeout=60))
+    return bot.sent
+
+
+def test_unexpected_error_fails_the_job(db, monkeypatch):
+    async def broken(runner, job):
+        raise RuntimeError("boom")
+
+    monkeypatch.setitem(Final.JOB_KINDS, "broken", broken)
+    job_id = Final.create_job("broken", Final.DEFAULT_COURSE, "123", 123, {})
+    sent = run_jobs()
+    assert job_row(job_id, "status", "result") == ("failed", f"Job #{job_id} failed: boom")
+    assert sent == [(123, f"Job #{job_id} failed: boom")]
+
+
+def test_reset_job_runs_and_reports(db):
+    with Final.course_connection(Final.DEFAULT_COURSE) as conn, conn:
+        Final.upsert_detailed_grades(conn, [("1", "Math", *[50.0] * 6)])
+    job_id = Final.create_job("reset", Final.DEFAULT_COURSE, "123", 123, {})
+    sent = run_jobs()
+    assert job_row(job_id, "status")[0] == "done"
+    assert "have been reset" in sent[-1][1]
+    assert Final.get_detailed_grades_for_student("1") == []
+
+
+def test_claim_records_owner_and_lease(db, clock):
+    job_id = Final.create_job("reset", Final.DEFAULT_COURSE, "123", 123, {})
+    job = Final.claim_job()
+    assert job["job_id"] == job_id and job["owner"] == Final.JOB_OWNER
+    assert job_row(job_id, "status", "lease_until") == ("running", clock.now + Final.JOB_LEASE_SECONDS)
+    assert Final.claim_job() is None
+
+
+def test_live_owner_keeps_its_job_until_the_lease_runs_out(db, clock):
+    job_id = Final.create_job("reset", Final.DEFAULT_COURSE, "123", 123, {})
+    Final.claim_job()
+    clock.advance(Final.JOB_LEASE_SECONDS - 1)
+    assert Final.requeue_stale_jobs() == 0
+    Final.heartbeat_job(job_id)
+    clock.advance(Final.JOB_LEASE_SECONDS - 1)
+    assert Final.requeue_stale_jobs() == 0
+    clock.advance(2)
+    assert Final.requeue_stale_jobs() == 1
+    assert job_row(job_id, "status", "owner") == ("queued", None)
+
+
+def test_job_of_an_exited_owner_is_requeued_at_once(db):
+    job_id = Final.create_job("reset", Final.DEFAULT_COURSE, "123", 123, {})
+    # A process ID that cannot belong to a running process
+    Final.claim_job(owner=f"{socket.gethostname()}:{2 ** 31 - 1}")
+    assert Final.requeue_stale_jobs() == 1
+    assert job_row(job_id, "status")[0] == "queued"
+
+
+def test_owner_on_another_host_is_left_to_its_lease(db):
+    Final.create_job("reset", Final.DEFAULT_COURSE, "123", 123, {})
+    Final.claim_job(owner="elsewhere:1")
+    assert Final.requeue_stale_jobs() == 0
+
+
+def test_previous_owner_learns_it_lost_the_job(db):
+    job_id = Final.create_job("reset", Final.DEFAULT_COURSE, "123", 123, {})
+    Final.claim_job(owner="elsewhere:1")
+    set_job(job_id, lease_until=0)
+    Final.requeue_stale_jobs()
+    Final.claim_job()
+    with pytest.raises(Final.JobLost):
+        Final.heartbeat_job(job_id, "elsewhere:1")
+    with pytest.raises(Final.JobLost):
+        Final.record_job_checkpoint(job_id, Final.ImportReport("grades.csv"), "elsewhere:1")
+    assert Final.heartbeat_job(job_id) is False
+
+
+def test_cancel_stops_a_running_import_at_its_checkpoint(db):
+    job_id = Final.create_job("import", Final.DEFAULT_COURSE, "123", 123, {})
+    Final.claim_job()
+    assert Final.cancel_job(job_id, "123") == ("running", "import")
+    with pytest.raises(Final.JobCancelled):
+        Final.record_job_checkpoint(job_id, Final.ImportReport("grades.csv"))
+
+
+def test_cancelled_import_reports_the_rows_it_kept(db):
+    csv_path = os.path.join(os.path.dirname(db), "grades.csv")
+    rows = 2 * Final.JOB_CHECKPOINT_CHUNKS * Final.IMPORT_CHUNK_SIZE
+    benchmark.write_grades_csv(csv_path, rows)
+    job_id = Final.create_job("import", Final.DEFAULT_COURSE, "123", 123, {"path": csv_path, "source": csv_path})
+    # Cancelled before it starts, so it stops at its first checkpoint
+    set_job(job_id, cancel_requested=1)
+    sent = run_jobs()
+    with Final.course_connection(Final.DEFAULT_COURSE) as conn:
+        kept = conn.execute("SELECT COUNT(*) FROM detailed_grades").fetchone()[0]
+    assert 0 < kept < rows
+    assert job_row(job_id, "status")[0] == "cancelled"
+    assert sent == [(123, f"Job #{job_id} cancelled. The {kept} rows imported before it stopped have been kept.")]
+
+
+def test_running_reset_cannot_be_cancelled(db):
+    job_id = Final.create_job("reset", Final.DEFAULT_COURSE, "123", 123, {})
+    Final.claim_job()
+    assert Final.cancel_job(job_id, "123") == ("running", "reset")
+    assert Final.heartbeat_job(job_id) is False
+    assert Final.cancel_job(Final.create_job("reset", Final.DEFAULT_COURSE, "123", 123, {}), "123") == ("cancelled", "reset")
+
+
+def test_interrupted_import_resumes_from_its_checkpoint(db, monkeypatch):
+    csv_path = os.path.join(os.path.dirname(db), "grades.csv")
+    # Checkpoints come every JOB_CHECKPOINT_CHUNKS chunks of IMPORT_CHUNK_SIZE rows
+    rows = 2 * Final.JOB_CHECKPOINT_CHUNKS * Final.IMPORT_CHUNK_SIZE + 1
+    benchmark.write_grades_csv(csv_path, rows)
+    job_id = Final.create_job("import", Final.DEFAULT_COURSE, "123", 123, {"path": csv_path, "source": csv_path})
+    job = Final.claim_job()
+    record = Final.record_job_checkpoint
+
+    def crash(job_id, report, owner):
+        record(job_id, report, owner)
+        raise KeyboardInterrupt
+
+    monkeypatch.setattr(Final, "record_job_checkpoint", crash)
+    with pytest.raises(KeyboardInterrupt):
+        Final.import_job(job_id, csv_path, csv_path, resume=job["checkpoint"], owner=job["owner"])
+    monkeypatch.setattr(Final, "record_job_checkpoint", record)
+
+    checkpoint = json.loads(job_row(job_id, "checkpoint")[0])
+    assert 0 < checkpoint["rows_read"] < rows
+    set_job(job_id, lease_until=0)
+    assert Final.requeue_stale_jobs() == 1
+    job = Final.claim_job()
+    report = Final.import_job(job_id, csv_path, csv_path, resume=job["checkpoint"], owner=job["owner"])
+    assert report.rows_read == rows
+    with Final.course_connection(Final.DEFAULT_COURSE) as conn:
+        assert conn.execute("SELECT COUNT(*) FROM detailed_grades").fetchone()[0] == rows
@@ -0,0 +1,67 @@
+import asyncio
+
+import pytest
+
+import benchmark
+import Final
+
+
+@pytest.fixture
+def students(db):
+    # Chat 103 belongs to a student who has logged out
+    with Final.db_connection() as conn, conn:
+        conn.executemany("INSERT INTO users (id, college_id, role, logged_in) VALUES (?, ?, 'student', ?)",
+                         [("101", "1", 1), ("102", "2", 1), ("103", "3", 0)])
+
+
+def test_changed_students_skip_course_events(db):
+    with Final.course_connection(Final.DEFAULT_COURSE) as conn, conn:
+        after = conn.execute(Final.SELECT_LAST_HISTORY_SQL).fetchone()[0]
+        Final.upsert_detailed_grades(conn, [("1", "Math", *[50.0] * 6), ("2", "Math", *[60.0] * 6), ("1", "Physics", *[70.0] * 6)])
+        Final.log_course_event(conn, "recompute")
+        upto = conn.execute(Final.SELECT_LAST_HISTORY_SQL).fetchone()[0]
+    assert Final.get_changed_students(Final.DEFAULT_COURSE, after, upto) == {"1", "2"}
+    assert Final.get_changed_students(Final.DEFAULT_COURSE, upto, upto) == set()
+
+
+def test_claim_skips_logged_out_students(students):
+    chats, deferred = Final.claim_grade_notifications(Final.DEFAULT_COURSE, {"1": 100, "3": 100, "4": 100}, now=200)
+    assert (chats, deferred) == (["101"], {})
+
+
+def test_claim_skips_students_told_since_the_change(students):
+    Final.claim_grade_notifications(Final.DEFAULT_COURSE, {"1": 100}, now=200)
+    assert Final.claim_grade_notifications(Final.DEFAULT_COURSE, {"1": 150}, now=210) == ([], {})
+
+
+def test_claim_defers_students_told_within_the_window(students):
+    Final.claim_grade_notifications(Final.DEFAULT_COURSE, {"1": 100}, now=200, window=600)
+    assert Final.claim_grade_notifications(Final.DEFAULT_COURSE, {"1": 300, "2": 300}, now=400, window=600) == (["102"], {"1": 800})
+    assert Final.claim_grade_notifications(Final.DEFAULT_COURSE, {"1": 300}, now=800, window=600) == (["101"], {})
+
+
+def test_claims_are_per_course(students):
+    Final.claim_grade_notifications(Final.DEFAULT_COURSE, {"1": 100}, now=200)
+    assert Final.claim_grade_notifications("physics", {"1": 100}, now=200) == (["101"], {})
+
+
+def test_notifier_sends_one_message_per_student(students):
+    bot = benchmark.fake_dispatcher()
+    notifier = Final.GradeNotifier(window=600)
+
+    async def main():
+        Final.DISPATCHER.start(bot)
+        for _ in range(3):
+            notifier.notify(Final.DEFAULT_COURSE, ["1", "2", "3"], changed_at=100)
+        first = await notifier.flush(now=200)
+        notifier.notify(Final.DEFAULT_COURSE, {"1": 300})
+        second = await notifier.flush(now=400)
+        third = await notifier.flush(now=800)
+        await Final.DISPATCHER.stop(timeout=5)
+        return first, second, third
+
+    assert asyncio.run(main()) == (2, 0, 1)
+    text = Final.NOTIFY_TEXT.format(course_id=Final.DEFAULT_COURSE)
+    assert sorted(bot.sent) == [("101", text), ("101", text), ("102", text)]
+    assert notifier.stats()["pending"] == 0
+    assert notifier.stats()["deferred"] == 1
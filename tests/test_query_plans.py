@@ -0,0 +1,31 @@
+import sqlite3
+
+import pytest
+
+import benchmark
+
+
+@pytest.fixture(scope="module")
+def plan_db():
+    with benchmark.temp_database() as db_file:
+        benchmark.seed_plan_database(db_file)
+        yield db_file
+
+
+@pytest.mark.parametrize("name, sql, params", benchmark.handler_queries(), ids=[query[0] for query in benchmark.handler_queries()])
+def test_handler_query_is_index_backed(plan_db, name, sql, params):
+    with sqlite3.connect(plan_db) as conn:
+        plan = conn.execute(f"EXPLAIN QUERY PLAN {sql}", params).fetchall()
+    assert not benchmark.plan_problems(plan), " | ".join(row[-1] for row in plan)
+
+
+def test_full_scan_of_a_hot_table_is_flagged(plan_db):
+    with sqlite3.connect(plan_db) as conn:
+        plan = conn.execute("EXPLAIN QUERY PLAN SELECT * FROM detailed_grades WHERE homework > 50").fetchall()
+    assert benchmark.plan_problems(plan) == ["SCAN detailed_grades"]
+
+
+def test_sort_without_an_index_is_flagged(plan_db):
+    with sqlite3.connect(plan_db) as conn:
+        plan = conn.execute("EXPLAIN QUERY PLAN SELECT * FROM grade_history ORDER BY homework").fetchall()
+    assert any("TEMP B-TREE" in problem for problem in benchmark.plan_problems(plan))
@@ -0,0 +1,86 @@
+import asyncio
+
+import pytest
+
+import benchmark
+import Final
+
+STUDENTS = [str(student) for student in range(1, 31)]
+
+
+def write(rows):
+    with Final.course_connection(Final.DEFAULT_COURSE) as conn, conn:
+        Final.upsert_detailed_grades(conn, rows)
+
+
+@pytest.fixture
+def grades(db):
+    # Tied overall grades and a missing one, which must not affect the order
+    write([(student, subject, 60.0, 70.0, 80.0, 90.0, 100.0, None if (student, subject) == ("3", "Math") else 50.0 + int(student) % 3)
+           for student in STUDENTS for subject in benchmark.SUBJECTS])
+
+
+def test_loaded_snapshot_answers_like_sqlite(grades):
+    snapshot = Final.GradeSnapshot.load(Final.DEFAULT_COURSE)
+    assert len(snapshot) == len(STUDENTS) * len(benchmark.SUBJECTS)
+    assert benchmark.snapshot_mismatches(snapshot, sorted(STUDENTS)) == 0
+
+
+def test_changes_are_applied_in_place(grades):
+    snapshot = Final.GradeSnapshot.load(Final.DEFAULT_COURSE)
+    write([("2", "Math", 1.0, 2.0, 3.0, 4.0, 5.0, 6.0), ("99", "Art", 10.0, 20.0, 30.0, 40.0, 50.0, 60.0)])
+
+    changes = snapshot.read_changes()
+    assert changes is not None
+    assert snapshot.apply(*changes)
+    assert snapshot.seq == changes[1]
+    assert benchmark.snapshot_mismatches(snapshot, sorted([*STUDENTS, "99"])) == 0
+    # A second apply of the same changes is refused
+    assert not snapshot.apply(*changes)
+
+
+def test_course_wide_event_forces_a_reload(grades):
+    snapshot = Final.GradeSnapshot.load(Final.DEFAULT_COURSE)
+    Final.reset_gradebook()
+    assert snapshot.read_changes() is None
+
+
+def test_store_refreshes_stale_courses(grades, monkeypatch):
+    store = Final.SnapshotStore(refresh_interval=3600)
+
+    async def main():
+        first = await store.get(Final.DEFAULT_COURSE)
+        write([("1", "Math", 0.0, 0.0, 0.0, 0.0, 0.0, 0.0)])
+        unchanged = (await store.get(Final.DEFAULT_COURSE)).detailed_grades("1")
+        store.mark_stale(Final.DEFAULT_COURSE)
+        second = await store.get(Final.DEFAULT_COURSE)
+        return first, unchanged, second
+
+    first, unchanged, second = asyncio.run(main())
+    assert second is first
+    assert ("Math", 60.0, 70.0, 80.0, 90.0, 100.0, 51.0) in unchanged
+    assert second.detailed_grades("1") == Final.get_detailed_grades_for_student("1")
+    assert store.stats()["loads"] == 1
+    assert store.stats()["refreshes"] == 1
+
+
+def test_serving_mode_reads_from_the_snapshot(grades, monkeypatch):
+    monkeypatch.setattr(Final, "SNAPSHOT_SERVING", True)
+    monkeypatch.setattr(Final, "SNAPSHOTS", Final.SnapshotStore())
+
+    async def main():
+        return (await Final.load_overall_grades("1", Final.DEFAULT_COURSE),
+                await Final.load_grades_page(None, None, "Math", None, Final.DEFAULT_COURSE))
+
+    overall, page = asyncio.run(main())
+    assert overall == Final.get_overall_grades_for_student("1")
+    assert page == Final.get_detailed_grades_page(subject="Math")
+    assert Final.SNAPSHOTS.stats()["courses"] == 1
+
+
+def test_student_views_list_subjects_in_order(grades):
+    snapshot = Final.GradeSnapshot.load(Final.DEFAULT_COURSE)
+    subjects = [row[0] for row in Final.get_detailed_grades_for_student("3")]
+    assert subjects == sorted(benchmark.SUBJECTS)
+    assert [row[0] for row in snapshot.detailed_grades("3")] == subjects
+    assert snapshot.overall_grades("3") == Final.get_overall_grades_for_student("3")
@@ -0,0 +1,76 @@
+import math
+import random
+
+import pytest
+
+import Final
+
+
+def recomputed_stats(conn):
+    expected = {}
+    for subject, in conn.execute("SELECT DISTINCT subject FROM detailed_grades").fetchall():
+        for component in Final.STAT_COMPONENTS:
+            values = [value for value, in conn.execute(f"SELECT {component} FROM detailed_grades WHERE subject = ? AND {component} IS NOT NULL", (subject,))]
+            if values:
+                mean = sum(values) / len(values)
+                expected[(subject, component)] = (len(values), mean, math.sqrt(max(0.0, sum(v * v for v in values) / len(values) - mean * mean)),
+                                                  min(values), max(values))
+    return expected
+
+
+def recomputed_histogram(conn, subject, component):
+    histogram = {}
+    for value, in conn.execute(f"SELECT {component} FROM detailed_grades WHERE subject = ? AND {component} IS NOT NULL", (subject,)):
+        bucket = max(0, min(Final.HISTOGRAM_BUCKETS, int(value // Final.HISTOGRAM_BUCKET_WIDTH)))
+        histogram[bucket] = histogram.get(bucket, 0) + 1
+    return histogram
+
+
+def test_deltas_match_a_full_recompute(db):
+    rng = random.Random(7)
+    for _ in range(20):
+        rows = [(str(rng.randint(1, 30)), rng.choice(["Math", "Art", "Physics"]),
+                 *(rng.choice([None, rng.uniform(0, 100)]) for _ in Final.STAT_COMPONENTS)) for _ in range(15)]
+        with Final.course_connection(Final.DEFAULT_COURSE) as conn, conn:
+            Final.upsert_detailed_grades(conn, rows)
+
+    stats = {(entry["subject"], entry["component"]): entry for entry in Final.get_subject_stats()}
+    with Final.course_connection(Final.DEFAULT_COURSE) as conn:
+        expected = recomputed_stats(conn)
+        assert set(stats) == set(expected)
+        for key, (count, mean, stddev, low, high) in expected.items():
+            assert stats[key]["count"] == count
+            assert stats[key]["mean"] == pytest.approx(mean)
+            assert stats[key]["stddev"] == pytest.approx(stddev, abs=1e-6)
+            assert (stats[key]["min"], stats[key]["max"]) == (low, high)
+        for subject, component in expected:
+            assert Final.get_subject_histogram(subject, component) == recomputed_histogram(conn, subject, component)
+
+
+def test_replacing_the_extreme_recomputes_it(db):
+    with Final.course_connection(Final.DEFAULT_COURSE) as conn, conn:
+        Final.upsert_detailed_grades(conn, [("1", "Math", *[10.0] * 6), ("2", "Math", *[50.0] * 6), ("3", "Math", *[90.0] * 6)])
+    with Final.course_connection(Final.DEFAULT_COURSE) as conn, conn:
+        Final.upsert_detailed_grades(conn, [("1", "Math", *[40.0] * 6), ("3", "Math", *[60.0] * 6)])
+
+    overall = next(entry for entry in Final.get_subject_stats("Math") if entry["component"] == "overall")
+    assert (overall["count"], overall["min"], overall["max"]) == (3, 40.0, 60.0)
+    assert overall["mean"] == pytest.approx(50.0)
+
+
+def test_unchanged_rows_leave_the_aggregates_alone(db):
+    rows = [("1", "Math", *[70.0] * 6)]
+    with Final.course_connection(Final.DEFAULT_COURSE) as conn, conn:
+        Final.upsert_detailed_grades(conn, rows)
+    version = Final.get_subject_stats("Math")[0]["version"]
+    with Final.course_connection(Final.DEFAULT_COURSE) as conn, conn:
+        Final.upsert_detailed_grades(conn, rows)
+    assert Final.get_subject_stats("Math")[0]["version"] == version
+
+
+def test_reset_empties_the_aggregates(db):
+    with Final.course_connection(Final.DEFAULT_COURSE) as conn, conn:
+        Final.upsert_detailed_grades(conn, [("1", "Math", *[70.0] * 6)])
+    Final.reset_gradebook()
+    assert Final.get_subject_stats() == []
+    assert Final.get_subject_histogram("Math") == {}
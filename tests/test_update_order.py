@@ -0,0 +1,54 @@
+import asyncio
+
+from telegram import Update
+
+import benchmark
+import Final
+
+
+def update(update_id, chat_id):
+    return Update.de_json(benchmark.command_update(update_id, chat_id, "/view_grades"), None)
+
+
+# Handles every update the way Application's update fetcher does: one task per
+# update, started in arrival order. Returns (chat_id, update_id) in the order
+# the updates finished and the most that were running at once.
+def process(updates, limit, delays):
+    finished, running, most = [], [0], [0]
+
+    async def handle(update):
+        running[0] += 1
+        most[0] = max(most[0], running[0])
+        await asyncio.sleep(delays.get(update.update_id, 0))
+        running[0] -= 1
+        finished.append((update.effective_chat.id, update.update_id))
+
+    async def main():
+        processor = Final.chat_ordered_update_processor(limit)
+        async with processor:
+            await asyncio.gather(*(processor.process_update(update, handle(update)) for update in updates))
+
+    asyncio.run(main())
+    return finished, most[0]
+
+
+def test_updates_of_one_chat_are_handled_in_order():
+    updates = [update(1, 10), update(2, 10), update(3, 20), update(4, 10)]
+    finished, _ = process(updates, limit=4, delays={1: 0.05, 2: 0.01})
+    assert [update_id for chat_id, update_id in finished if chat_id == 10] == [1, 2, 4]
+    # Chat 20 is not held up behind chat 10
+    assert finished[0] == (20, 3)
+
+
+def test_updates_of_different_chats_are_bounded_by_the_limit():
+    updates = [update(update_id, update_id) for update_id in range(1, 11)]
+    finished, most = process(updates, limit=3, delays=dict.fromkeys(range(1, 11), 0.01))
+    assert len(finished) == 10
+    assert most == 3
+
+
+def test_a_busy_chat_filling_every_slot_still_finishes():
+    updates = [update(update_id, 10) for update_id in range(1, 6)] + [update(6, 20)]
+    finished, _ = process(updates, limit=5, delays=dict.fromkeys(range(1, 7), 0.01))
+    assert [update_id for chat_id, update_id in finished if chat_id == 10] == [1, 2, 3, 4, 5]
+    assert (20, 6) in finished
@@ -0,0 +1,44 @@
+import http.client
+import json
+import threading
+from http.server import ThreadingHTTPServer
+
+import pytest
+
+import Final
+
+
+@pytest.fixture
+def receiver():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Final.WebhookRequestHandler)
+    server.secret, server.received = "s3cret", []
+    server.dispatch = server.received.append
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def post(server, headers, path=Final.WEBHOOK_PATH):
+    conn = http.client.HTTPConnection("127.0.0.1", server.server_port)
+    try:
+        conn.request("POST", path, json.dumps({"update_id": 1}), {"Content-Type": "application/json", **headers})
+        return conn.getresponse().status
+    finally:
+        conn.close()
+
+
+def test_update_with_the_secret_is_dispatched(receiver):
+    assert post(receiver, {"X-Telegram-Bot-Api-Secret-Token": "s3cret"}) == 200
+    assert receiver.received == [{"update_id": 1}]
+
+
+@pytest.mark.parametrize("headers", [{}, {"X-Telegram-Bot-Api-Secret-Token": ""}, {"X-Telegram-Bot-Api-Secret-Token": "guess"}])
+def test_update_without_the_secret_is_refused(receiver, headers):
+    assert post(receiver, headers) == 403
+    assert receiver.received == []
+
+
+def test_other_paths_are_not_found(receiver):
+    assert post(receiver, {"X-Telegram-Bot-Api-Secret-Token": "s3cret"}, "/other") == 404